@@ -0,0 +1,15 @@
+import numpy as np
+from dataset import Dataset
+from overlay_renderer import OverlayRenderer, OverlayStyle
+
+class BoxAnnotator:
+    def __init__(self, dataset: Dataset, thickness: int = 2):
+        self.dataset = dataset
+        self.renderer = OverlayRenderer(dataset, OverlayStyle(fill=False, outline_thickness=0, boxes=True, box_thickness=thickness))
+
+    def annotate(self, image_id: int) -> np.ndarray:
+        """
+        Returns the image with the bbox of every annotation drawn in the color
+        of its class.
+        """
+        return self.renderer.render(image_id)
@@ -1,14 +1,15 @@
-import cv2
 import numpy as np
 from dataset import Dataset
+from overlay_renderer import OverlayRenderer, OverlayStyle
 
 class LabelAnnotator:
-    def __init__(self, dataset: Dataset):
+    def __init__(self, dataset: Dataset, font_scale: float = 0.5):
         self.dataset = dataset
+        self.renderer = OverlayRenderer(dataset, OverlayStyle(fill=False, outline_thickness=0, labels=True, font_scale=font_scale))
 
-    def annotate(self, image_id: int):
-        image = self.dataset[image_id]
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-        mask = cv2.putText(mask, 'Label', (10, 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
-        mask = cv2.addWeighted(image, 0.5, mask, 0.5, 0)
-        return mask
\ No newline at end of file
+    def annotate(self, image_id: int) -> np.ndarray:
+        """
+        Returns the image with the class name of every annotation written above
+        its bbox. Image-level labels are listed in the top-left corner.
+        """
+        return self.renderer.render(image_id)
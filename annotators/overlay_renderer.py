@@ -0,0 +1,216 @@
+import os
+import colorsys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, Optional, Union
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from dataset import Dataset
+from dataset_view import DatasetView
+from image_cache import ImageCache
+from annotation_store import AnnotationStore, KIND_CLASSIFICATION, KIND_MASK, KIND_SEGMENTATION, counts_to_offsets
+from rle import decode_rle
+
+GOLDEN_RATIO_CONJUGATE = 0.618033988749895
+
+@dataclass(frozen=True)
+class OverlayStyle:
+    alpha: float = 0.5
+    fill: bool = True
+    outline_thickness: int = 1
+    boxes: bool = False
+    box_thickness: int = 2
+    labels: bool = False
+    font_scale: float = 0.5
+
+def class_colors(class_ids: np.ndarray) -> np.ndarray:
+    """
+    `(N, 3)` RGB color of every class. Hues are spread with the golden ratio,
+    so a class has the same color in every image and close ids stay apart.
+    """
+    return np.array(
+        [[round(channel * 255) for channel in colorsys.hsv_to_rgb((class_id * GOLDEN_RATIO_CONJUGATE) % 1, 0.75, 0.95)] for class_id in np.asarray(class_ids).tolist()],
+        dtype=np.uint8
+    ).reshape(-1, 3)
+
+def overlay_columns(store: AnnotationStore, rows: np.ndarray) -> tuple:
+    """
+    Everything `draw_overlay` needs from the given rows, as plain arrays that
+    can be sent to a worker process.
+    """
+    masks = rows[store.kinds[rows] == KIND_MASK]
+    return (
+        store.class_ids[rows],
+        store.kinds[rows],
+        store.bboxes[rows],
+        store.vertex_counts()[rows],
+        store.vertices[store.vertex_indices(rows)],
+        [store.get_rle(row) for row in masks.tolist()]
+    )
+
+def draw_overlay(image: np.ndarray, columns: tuple, class_names: dict[int, str], style: OverlayStyle) -> np.ndarray:
+    """
+    Draws the annotations of one image over a copy of it. Polygons and masks
+    are first drawn into a map of class indices, which is blended with the
+    image in a single pass through a color lookup table; outlines and boxes
+    are then drawn with one `polylines` call per class.
+    """
+    class_ids, kinds, bboxes, vertex_counts, vertices, rles = columns
+    if image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    elif image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_RGBA2RGB)
+    overlay = np.array(image, dtype=np.uint8, copy=True)
+    if len(class_ids) == 0:
+        return overlay
+
+    classes, class_positions = np.unique(class_ids, return_inverse=True)
+    class_positions = class_positions.reshape(-1)
+    colors = class_colors(classes)
+    vertex_offsets = counts_to_offsets(vertex_counts)
+    points = np.round(vertices).astype(np.int32)
+    polygon_rows = np.flatnonzero((kinds == KIND_SEGMENTATION) & (vertex_counts >= 3))
+    polygons_by_class = [[] for _ in classes]
+    for row in polygon_rows.tolist():
+        polygons_by_class[class_positions[row]].append(points[vertex_offsets[row]:vertex_offsets[row + 1]])
+
+    if style.fill and style.alpha > 0:
+        class_map = np.zeros(overlay.shape[:2], dtype=np.uint8 if len(classes) < 256 else np.uint16)
+        # One fillPoly call per polygon: a single call fills with the even-odd
+        # rule, which would leave the overlap of two polygons of a class unpainted.
+        for position, polygons in enumerate(polygons_by_class):
+            for polygon in polygons:
+                cv2.fillPoly(class_map, [polygon], position + 1)
+        for row, rle in zip(np.flatnonzero(kinds == KIND_MASK).tolist(), rles):
+            mask = decode_rle(rle)
+            if mask.shape == class_map.shape:
+                class_map[mask.astype(bool)] = class_positions[row] + 1
+        color_table = np.zeros((max(256, len(classes) + 1), 3), dtype=np.uint8)
+        color_table[1:len(classes) + 1] = colors
+        if class_map.dtype == np.uint8:
+            color_layer = cv2.LUT(cv2.merge([class_map] * 3), color_table.reshape(256, 1, 3))
+        else:
+            color_layer = color_table[class_map]
+        blended = cv2.addWeighted(overlay, 1 - style.alpha, color_layer, style.alpha, 0)
+        cv2.copyTo(blended, (class_map > 0).view(np.uint8), overlay)
+
+    boxes_by_class = [[] for _ in classes]
+    if style.boxes:
+        for row in np.flatnonzero(kinds != KIND_CLASSIFICATION).tolist():
+            x, y, width, height = bboxes[row]
+            boxes_by_class[class_positions[row]].append(
+                np.round([[x, y], [x + width, y], [x + width, y + height], [x, y + height]]).astype(np.int32)
+            )
+    for position, color in enumerate(colors.tolist()):
+        if style.outline_thickness > 0 and polygons_by_class[position]:
+            cv2.polylines(overlay, polygons_by_class[position], True, color, style.outline_thickness, cv2.LINE_AA)
+        if boxes_by_class[position]:
+            cv2.polylines(overlay, boxes_by_class[position], True, color, style.box_thickness, cv2.LINE_AA)
+
+    if style.labels:
+        line_height = int(round(25 * style.font_scale)) + 4
+        next_image_label = line_height
+        for row in range(len(class_ids)):
+            color = colors[class_positions[row]].tolist()
+            text = class_names.get(int(class_ids[row]), str(class_ids[row]))
+            if kinds[row] == KIND_CLASSIFICATION:
+                origin = (4, next_image_label)
+                next_image_label += line_height
+            else:
+                origin = (int(bboxes[row, 0]), max(int(bboxes[row, 1]) - 3, line_height))
+            cv2.putText(overlay, text, origin, cv2.FONT_HERSHEY_SIMPLEX, style.font_scale, color, 1, cv2.LINE_AA)
+    return overlay
+
+def _render_files(tasks: list[tuple[str, str, tuple]], class_names: dict[int, str], style: OverlayStyle) -> int:
+    for image_path, output_path, columns in tasks:
+        image = np.array(Image.open(image_path))
+        overlay = draw_overlay(image, columns, class_names, style)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        cv2.imwrite(output_path, cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR))
+    return len(tasks)
+
+class OverlayRenderer:
+    """
+    Renders annotation overlays of a dataset, or of a view of one. Overlays are
+    cached per image, class filter and style, and follow edits of the
+    annotations since the cache key includes the store version.
+    """
+    def __init__(self, dataset: Union[Dataset, DatasetView], style: OverlayStyle = OverlayStyle(), cache: Optional[ImageCache] = None):
+        self.dataset = dataset
+        self.source = dataset.dataset if isinstance(dataset, DatasetView) else dataset
+        self.style = style
+        self.cache = cache if cache is not None else ImageCache(256 * 1024 * 1024)
+
+    def _class_filter(self, classes: Optional[Iterable[Union[int, str]]]) -> Optional[tuple[int, ...]]:
+        if classes is None:
+            return None
+        return tuple(sorted({self.source.class2id[value] if isinstance(value, str) else int(value) for value in classes}))
+
+    def _rows(self, image_id: int, class_filter: Optional[tuple[int, ...]]) -> np.ndarray:
+        store = self.source.annotation_store
+        rows = store.rows_for_image(image_id)
+        if isinstance(self.dataset, DatasetView):
+            rows = rows[np.isin(rows, self.dataset.annotation_rows)]
+        if class_filter is not None:
+            rows = rows[np.isin(store.class_ids[rows], class_filter)]
+        return rows
+
+    def render(self, image_id: int, classes: Optional[Iterable[Union[int, str]]] = None, style: Optional[OverlayStyle] = None) -> np.ndarray:
+        """
+        RGB overlay of one image, restricted to `classes` (ids or names) when
+        given. The returned array is shared with the cache and read-only.
+        """
+        style = style or self.style
+        class_filter = self._class_filter(classes)
+        store = self.source.annotation_store
+        key = ('overlay', image_id, class_filter, style, id(store), store.version)
+
+        def load() -> np.ndarray:
+            columns = overlay_columns(store, self._rows(image_id, class_filter))
+            overlay = draw_overlay(self.source.get_image(image_id), columns, self.source.id2class, style)
+            overlay.setflags(write=False)
+            return overlay
+
+        return self.cache.get(key, load)
+
+    def render_to_directory(self,
+                output_path: str,
+                classes: Optional[Iterable[Union[int, str]]] = None,
+                style: Optional[OverlayStyle] = None,
+                workers: Optional[int] = None,
+                chunk_size: int = 32,
+                extension: str = '.jpg'
+                ) -> int:
+        """
+        Renders every image of the dataset or view to `output_path`, keeping
+        the image names (with `extension`), in chunks across a process pool.
+        Returns the number of images written.
+        """
+        style = style or self.style
+        workers = workers or os.cpu_count() or 1
+        class_filter = self._class_filter(classes)
+        image_ids = list(self.dataset.image_id2image_name.keys())
+        chunks = [image_ids[start:start + chunk_size] for start in range(0, len(image_ids), chunk_size)]
+
+        written = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            in_flight = deque()
+            next_chunk = 0
+            while next_chunk < len(chunks) or in_flight:
+                while next_chunk < len(chunks) and len(in_flight) < 2 * workers:
+                    tasks = [
+                        (
+                            os.path.join(self.source.data_path, self.source.image_id2image_name[image_id]),
+                            os.path.join(output_path, os.path.splitext(self.source.image_id2image_name[image_id])[0] + extension),
+                            overlay_columns(self.source.annotation_store, self._rows(image_id, class_filter))
+                        )
+                        for image_id in chunks[next_chunk]
+                    ]
+                    in_flight.append(executor.submit(_render_files, tasks, dict(self.source.id2class), style))
+                    next_chunk += 1
+                written += in_flight.popleft().result()
+        return written
@@ -1,14 +1,15 @@
-import cv2
 import numpy as np
 from dataset import Dataset
+from overlay_renderer import OverlayRenderer, OverlayStyle
 
 class SegmentationAnnotator:
-    def __init__(self, dataset: Dataset):
+    def __init__(self, dataset: Dataset, alpha: float = 0.5):
         self.dataset = dataset
+        self.renderer = OverlayRenderer(dataset, OverlayStyle(alpha=alpha))
 
-    def annotate(self, image_id: int):
-        image = self.dataset[image_id]
-        mask = np.zeros(image.shape, dtype=np.uint8)
-        mask = cv2.fillPoly(mask, )
-        mask = cv2.addWeighted(image, 0.5, mask, 0.5, 0)
-        return mask
\ No newline at end of file
+    def annotate(self, image_id: int) -> np.ndarray:
+        """
+        Returns the image with its polygons and masks filled with the color of
+        their class and outlined.
+        """
+        return self.renderer.render(image_id)
@@ -0,0 +1,67 @@
+"""
+Compares the streaming and in-memory paths of `COCOAdapter.load`.
+
+Each path runs in its own subprocess so that peak RSS is measured independently.
+
+    python benchmarks/coco_load.py --images 20000 --annotations-per-image 10
+    python benchmarks/coco_load.py --json-path /data/coco/instances_train.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataset'))
+
+from synthetic import generate_coco_json
+
+def run_single(json_path: str, streaming: bool) -> dict:
+    from coco import COCOAdapter
+
+    start = time.perf_counter()
+    dataset = COCOAdapter.load(json_path, os.path.dirname(json_path), streaming=streaming, use_cache=False)
+    elapsed = time.perf_counter() - start
+    return {
+        "mode": "streaming" if streaming else "in_memory",
+        "seconds": elapsed,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "images": len(dataset),
+        "annotations": len(dataset.annotation_store),
+        "index_mb": dataset.annotation_store.nbytes / (1024 * 1024)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--json-path', help="Existing COCO file. A synthetic one is generated when omitted.")
+    parser.add_argument('--images', type=int, default=10000)
+    parser.add_argument('--annotations-per-image', type=int, default=10)
+    parser.add_argument('--vertices', type=int, default=32)
+    parser.add_argument('--run', choices=['streaming', 'in_memory'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_single(args.json_path, args.run == 'streaming')))
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        json_path = args.json_path
+        if json_path is None:
+            json_path = os.path.join(temp_dir, 'annotations.json')
+            generate_coco_json(json_path, args.images, args.annotations_per_image, args.vertices)
+
+        print(f"{json_path}: {os.path.getsize(json_path) / (1024 * 1024):.1f} MB")
+        for mode in ('in_memory', 'streaming'):
+            output = subprocess.run(
+                [sys.executable, __file__, '--json-path', json_path, '--run', mode],
+                check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{result['mode']:>10}: {result['seconds']:.2f} s, peak RSS {result['peak_rss_mb']:.0f} MB, "
+                  f"{result['annotations']} annotations, index {result['index_mb']:.1f} MB")
+
+if __name__ == '__main__':
+    main()
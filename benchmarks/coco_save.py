@@ -0,0 +1,80 @@
+"""
+Compares the in-memory and streaming paths of `COCOAdapter.save`, with the
+pretty-printed, compact and fast JSON outputs.
+
+Each mode runs in its own subprocess so that peak RSS is measured independently.
+
+    python benchmarks/coco_save.py --images 20000 --annotations-per-image 10
+    python benchmarks/coco_save.py --json-path /data/coco/instances_train.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataset'))
+
+from synthetic import generate_coco_json
+
+MODES = {
+    'in_memory': {'streaming': False, 'indent': 4, 'fast_json': False},
+    'streaming': {'streaming': True, 'indent': 4, 'fast_json': False},
+    'compact': {'streaming': True, 'indent': None, 'fast_json': False},
+    'compact_fast': {'streaming': True, 'indent': None, 'fast_json': True}
+}
+
+def run_single(json_path: str, output_path: str, mode: str) -> dict:
+    from coco import COCOAdapter
+
+    dataset = COCOAdapter.load(json_path, os.path.dirname(json_path), use_cache=False)
+    loaded_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    start = time.perf_counter()
+    COCOAdapter.save(dataset, output_path, **MODES[mode])
+    elapsed = time.perf_counter() - start
+    return {
+        "mode": mode,
+        "seconds": elapsed,
+        "loaded_rss_mb": loaded_rss,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "annotations": len(dataset.annotation_store),
+        "output_mb": os.path.getsize(output_path) / (1024 * 1024)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--json-path', help="Existing COCO file. A synthetic one is generated when omitted.")
+    parser.add_argument('--images', type=int, default=10000)
+    parser.add_argument('--annotations-per-image', type=int, default=10)
+    parser.add_argument('--vertices', type=int, default=32)
+    parser.add_argument('--output-path', help=argparse.SUPPRESS)
+    parser.add_argument('--run', choices=list(MODES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_single(args.json_path, args.output_path, args.run)))
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        json_path = args.json_path
+        if json_path is None:
+            json_path = os.path.join(temp_dir, 'annotations.json')
+            generate_coco_json(json_path, args.images, args.annotations_per_image, args.vertices)
+
+        print(f"{json_path}: {os.path.getsize(json_path) / (1024 * 1024):.1f} MB")
+        for mode in MODES:
+            output = subprocess.run(
+                [sys.executable, __file__, '--json-path', json_path, '--output-path', os.path.join(temp_dir, f'{mode}.json'), '--run', mode],
+                check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{result['mode']:>12}: {result['seconds']:.2f} s, peak RSS {result['peak_rss_mb']:.0f} MB "
+                  f"(after load {result['loaded_rss_mb']:.0f} MB), {result['annotations']} annotations, "
+                  f"output {result['output_mb']:.1f} MB")
+
+if __name__ == '__main__':
+    main()
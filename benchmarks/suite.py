@@ -0,0 +1,314 @@
+"""
+Benchmark suite: loaders, savers, dataset construction, statistics, splits,
+crops and image decoding on synthetic datasets.
+
+Every benchmark runs in its own subprocess so that peak RSS is measured
+independently, and is repeated `--repeat` times; the fastest run is kept.
+The peak RSS of the worker processes (crops, image decoding) is reported
+separately, and regressions are checked on the larger of the two.
+Results, with the stage timings reported by the loaders, are written as JSON
+so that two versions can be compared:
+
+    python benchmarks/suite.py --images 20000 --output before.json
+    python benchmarks/suite.py --images 20000 --output after.json --compare before.json
+    python benchmarks/suite.py --benchmarks coco_load yolo_load --data-dir /tmp/bench
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+import resource
+import subprocess
+import tempfile
+from typing import Callable
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_PATH, 'dataset'))
+
+from synthetic import generate_coco_json, generate_image_files, generate_yolo_dataset
+
+# Time differences below this are timer noise, whatever their ratio.
+MIN_SECONDS_DIFFERENCE = 0.005
+
+def peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    """
+    Peak RSS of this process, or with `RUSAGE_CHILDREN` of the largest of its
+    finished child processes, such as the workers of a process pool.
+    """
+    return resource.getrusage(who).ru_maxrss / 1024
+
+def max_peak_rss_mb(result: dict) -> float:
+    return max(result['peak_rss_mb'], result.get('children_peak_rss_mb', 0.0))
+
+def coco_json_path(data_dir: str) -> str:
+    return os.path.join(data_dir, 'coco', 'annotations.json')
+
+def coco_images_path(data_dir: str) -> str:
+    return os.path.join(data_dir, 'coco', 'images')
+
+def load_coco(data_dir: str):
+    from coco import COCOAdapter
+
+    return COCOAdapter.load(coco_json_path(data_dir), coco_images_path(data_dir), use_cache=False)
+
+def image_file_subset(data_dir: str):
+    """
+    The images of the synthetic COCO dataset that have a file on disk.
+    """
+    dataset = load_coco(data_dir)
+    existing = set(os.listdir(coco_images_path(data_dir)))
+    return dataset.view().filter_by_image_ids(
+        [image_id for image_id, image_name in dataset.image_id2image_name.items() if image_name in existing]
+    ).materialize()
+
+# Every benchmark prepares its inputs and returns the timed function, which
+# returns the number of items it processed, and the name of the items.
+
+def bench_coco_load(data_dir: str) -> tuple[Callable[[], int], str]:
+    return lambda: len(load_coco(data_dir).annotation_store), 'annotations'
+
+def bench_coco_load_in_memory(data_dir: str) -> tuple[Callable[[], int], str]:
+    from coco import COCOAdapter
+
+    def run() -> int:
+        dataset = COCOAdapter.load(coco_json_path(data_dir), coco_images_path(data_dir), streaming=False, use_cache=False)
+        return len(dataset.annotation_store)
+    return run, 'annotations'
+
+def bench_coco_load_cached(data_dir: str) -> tuple[Callable[[], int], str]:
+    from coco import COCOAdapter
+
+    COCOAdapter.load(coco_json_path(data_dir), coco_images_path(data_dir))
+    return lambda: len(COCOAdapter.load(coco_json_path(data_dir), coco_images_path(data_dir)).annotation_store), 'annotations'
+
+def bench_coco_save(data_dir: str) -> tuple[Callable[[], int], str]:
+    from coco import COCOAdapter
+
+    dataset = load_coco(data_dir)
+    output_path = os.path.join(data_dir, 'output', 'coco_save.json')
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    def run() -> int:
+        COCOAdapter.save(dataset, output_path)
+        return len(dataset.annotation_store)
+    return run, 'annotations'
+
+def bench_yolo_load(data_dir: str) -> tuple[Callable[[], int], str]:
+    from yolov8 import YOLOv8Adapter
+
+    yaml_path = os.path.join(data_dir, 'yolo', 'data.yaml')
+    return lambda: len(YOLOv8Adapter.load(yaml_path, use_cache=False)), 'images'
+
+def bench_construction(data_dir: str) -> tuple[Callable[[], int], str]:
+    from dataset import Dataset
+
+    dataset = load_coco(data_dir)
+    annotation_id2annotation = dict(dataset.annotation_id2annotation.items())
+    annotation_id2image_id = dict(dataset.annotation_id2image_id.items())
+
+    def run() -> int:
+        constructed = Dataset(
+            dataset.id2class,
+            dataset.data_path,
+            dataset.image_id2image_name,
+            dataset.image_id2image_dimensions,
+            annotation_id2image_id,
+            annotation_id2annotation
+        )
+        return len(constructed.annotation_store)
+    return run, 'annotations'
+
+def bench_count_classe_instances(data_dir: str) -> tuple[Callable[[], int], str]:
+    dataset = load_coco(data_dir)
+
+    def run() -> int:
+        dataset.statistics.invalidate()
+        dataset.count_classe_instances()
+        return len(dataset.annotation_store)
+    return run, 'annotations'
+
+def bench_split_dataset(data_dir: str) -> tuple[Callable[[], int], str]:
+    dataset = load_coco(data_dir)
+
+    def run() -> int:
+        dataset.split_dataset(0.8, 0.1, 0.1)
+        return len(dataset)
+    return run, 'images'
+
+def bench_split_dataset_stratified(data_dir: str) -> tuple[Callable[[], int], str]:
+    dataset = load_coco(data_dir)
+
+    def run() -> int:
+        dataset.split_dataset(0.8, 0.1, 0.1, stratify=True)
+        return len(dataset)
+    return run, 'images'
+
+def bench_crop(data_dir: str) -> tuple[Callable[[], int], str]:
+    dataset = image_file_subset(data_dir)
+    output_path = os.path.join(data_dir, 'output', 'crop')
+    width, height = next(iter(dataset.image_id2image_dimensions.values()))
+
+    def run() -> int:
+        dataset.crop_multiple_images(width // 4, height // 4, 3 * width // 4, 3 * height // 4, output_path=output_path)
+        return len(dataset)
+    return run, 'images'
+
+def bench_decode(data_dir: str) -> tuple[Callable[[], int], str]:
+    dataset = image_file_subset(data_dir)
+
+    def run() -> int:
+        return sum(len(batch.image_ids) for batch in dataset.iter_images(batch_size=32))
+    return run, 'images'
+
+def bench_get_image(data_dir: str) -> tuple[Callable[[], int], str]:
+    dataset = image_file_subset(data_dir)
+
+    def run() -> int:
+        dataset.image_cache.clear()
+        for image_id in dataset.image_id2image_name.keys():
+            dataset.get_image(image_id)
+        return len(dataset)
+    return run, 'images'
+
+BENCHMARKS = {
+    'coco_load': bench_coco_load,
+    'coco_load_in_memory': bench_coco_load_in_memory,
+    'coco_load_cached': bench_coco_load_cached,
+    'coco_save': bench_coco_save,
+    'yolo_load': bench_yolo_load,
+    'construction': bench_construction,
+    'count_classe_instances': bench_count_classe_instances,
+    'split_dataset': bench_split_dataset,
+    'split_dataset_stratified': bench_split_dataset_stratified,
+    'crop': bench_crop,
+    'decode': bench_decode,
+    'get_image': bench_get_image
+}
+
+def run_single(name: str, data_dir: str, repeat: int) -> dict:
+    from stage_timings import timed_stages
+
+    run, unit = BENCHMARKS[name](data_dir)
+    setup_rss = peak_rss_mb()
+    times = []
+    stages = {}
+    for _ in range(repeat):
+        with timed_stages() as timings:
+            start = time.perf_counter()
+            items = run()
+            elapsed = time.perf_counter() - start
+        if not times or elapsed < min(times):
+            stages = timings.as_dict()
+        times.append(elapsed)
+    return {
+        "seconds": min(times),
+        "mean_seconds": sum(times) / len(times),
+        "repeat": repeat,
+        "items": items,
+        "unit": unit,
+        "throughput": items / min(times) if min(times) > 0 else None,
+        "setup_rss_mb": setup_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        "children_peak_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+        "stages": stages
+    }
+
+def generate_data(data_dir: str, args: argparse.Namespace) -> None:
+    json_path = coco_json_path(data_dir)
+    if not os.path.exists(json_path):
+        os.makedirs(os.path.dirname(json_path), exist_ok=True)
+        generate_coco_json(json_path, args.images, args.objects_per_image, args.vertices, args.seed, args.rle_ratio)
+        generate_image_files(coco_images_path(data_dir), [f'{i}.jpg' for i in range(min(args.image_files, args.images))], (640, 480), args.seed)
+    yaml_path = os.path.join(data_dir, 'yolo', 'data.yaml')
+    if not os.path.exists(yaml_path):
+        generate_yolo_dataset(os.path.join(data_dir, 'yolo'), args.yolo_images, args.objects_per_image, args.vertices, args.seed)
+
+def metadata() -> dict:
+    import numpy as np
+
+    try:
+        revision = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_PATH, check=True, capture_output=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "revision": revision,
+        "date": datetime.datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count()
+    }
+
+def compare(results: dict, baseline: dict, tolerance: float) -> None:
+    print(f"\n{'benchmark':>26}  {'time':>8}  {'peak RSS':>8}")
+    for name, result in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if previous is None:
+            continue
+        time_ratio = result['seconds'] / previous['seconds'] if previous['seconds'] > 0 else float('inf')
+        rss_ratio = max_peak_rss_mb(result) / max_peak_rss_mb(previous) if max_peak_rss_mb(previous) > 0 else float('inf')
+        slower = time_ratio > 1 + tolerance and result['seconds'] - previous['seconds'] > MIN_SECONDS_DIFFERENCE
+        flag = '  regression' if slower or rss_ratio > 1 + tolerance else ''
+        print(f"{name:>26}  {time_ratio:>7.2f}x  {rss_ratio:>7.2f}x{flag}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--images', type=int, default=10000)
+    parser.add_argument('--objects-per-image', type=int, default=10)
+    parser.add_argument('--vertices', type=int, default=32)
+    parser.add_argument('--rle-ratio', type=float, default=0.1, help="Share of annotations stored as RLE masks.")
+    parser.add_argument('--image-files', type=int, default=500, help="Images written to disk for the crop and decode benchmarks.")
+    parser.add_argument('--yolo-images', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--data-dir', help="Keeps the generated data there and reuses it on later runs.")
+    parser.add_argument('--output', help="JSON file the results are written to.")
+    parser.add_argument('--compare', help="Results of an earlier run to compare with.")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Relative slowdown or growth reported as a regression.")
+    parser.add_argument('--run', choices=list(BENCHMARKS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_single(args.run, args.data_dir, args.repeat)))
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_dir = args.data_dir or temp_dir
+        start = time.perf_counter()
+        generate_data(data_dir, args)
+        print(f"Data in {data_dir} ({time.perf_counter() - start:.1f} s)")
+
+        results = {}
+        for name in args.benchmarks:
+            output = subprocess.run(
+                [sys.executable, __file__, '--run', name, '--data-dir', data_dir, '--repeat', str(args.repeat)],
+                check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            results[name] = result
+            print(f"{name:>26}: {result['seconds']:.3f} s, {result['throughput'] or 0:.0f} {result['unit']}/s, "
+                  f"peak RSS {result['peak_rss_mb']:.0f} MB (after setup {result['setup_rss_mb']:.0f} MB, "
+                  f"workers {result['children_peak_rss_mb']:.0f} MB)")
+            for stage_name, timing in result['stages'].items():
+                print(f"{'':>28}{stage_name}: {timing['seconds']:.3f} s")
+
+    report = {
+        "metadata": metadata(),
+        "parameters": {name: value for name, value in vars(args).items() if name not in ('run', 'output', 'compare', 'data_dir')},
+        "results": results
+    }
+    if args.output:
+        with open(args.output, 'w') as writer:
+            json.dump(report, writer, indent=4)
+    if args.compare:
+        with open(args.compare, 'r') as reader:
+            compare(results, json.load(reader), args.tolerance)
+
+if __name__ == '__main__':
+    main()
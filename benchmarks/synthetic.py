@@ -0,0 +1,129 @@
+"""
+Synthetic datasets for the benchmarks: COCO files with polygon and RLE
+annotations, YOLOv8 directories and image files.
+"""
+import os
+import json
+import random
+
+import cv2
+import numpy as np
+import yaml
+
+NUM_CLASSES = 10
+
+def rectangle_rle(x: int, y: int, width: int, height: int, image_size: tuple[int, int]) -> dict:
+    """
+    Uncompressed COCO RLE of a rectangle, counted in column-major order.
+    """
+    image_width, image_height = image_size
+    counts = [x * image_height + y]
+    for _ in range(width - 1):
+        counts.extend([height, image_height - height])
+    counts.extend([height, image_height * (image_width - x - width + 1) - y - height])
+    return {"size": [image_height, image_width], "counts": counts}
+
+def generate_coco_json(
+        json_path: str,
+        images: int,
+        annotations_per_image: int,
+        vertices: int,
+        seed: int = 0,
+        rle_ratio: float = 0.0,
+        image_size: tuple[int, int] = (640, 480)
+        ) -> None:
+    """
+    Writes a COCO file with `images` images of `image_size` named
+    `<image_id>.jpg` and `annotations_per_image` annotations each: polygons of
+    `vertices` vertices, or with probability `rle_ratio` a crowd RLE mask.
+    """
+    rng = random.Random(seed)
+    width, height = image_size
+    with open(json_path, 'w') as writer:
+        writer.write('{"categories": [')
+        writer.write(','.join(json.dumps({"id": i, "name": f"class_{i}", "supercategory": ""}) for i in range(NUM_CLASSES)))
+        writer.write('], "images": [')
+        writer.write(','.join(
+            json.dumps({"id": i, "file_name": f"{i}.jpg", "width": width, "height": height})
+            for i in range(images)
+        ))
+        writer.write('], "annotations": [')
+        annotation_id = 0
+        for image_id in range(images):
+            for _ in range(annotations_per_image):
+                x, y = rng.uniform(0, width - 140), rng.uniform(0, height - 130)
+                if rle_ratio > 0 and rng.random() < rle_ratio:
+                    annotation = {
+                        "segmentation": rectangle_rle(int(x), int(y), 100, 100, image_size),
+                        "area": 10000.0,
+                        "bbox": [int(x), int(y), 100, 100],
+                        "iscrowd": 1
+                    }
+                else:
+                    polygon = []
+                    for _ in range(vertices):
+                        polygon.extend([round(x + rng.uniform(0, 100), 2), round(y + rng.uniform(0, 100), 2)])
+                    annotation = {"segmentation": [polygon], "area": 5000.0, "bbox": [x, y, 100, 100], "iscrowd": 0}
+                if annotation_id > 0:
+                    writer.write(',')
+                writer.write(json.dumps({
+                    "id": annotation_id,
+                    "image_id": image_id,
+                    "category_id": rng.randrange(NUM_CLASSES),
+                    **annotation
+                }))
+                annotation_id += 1
+        writer.write(']}')
+
+def encode_test_image(image_size: tuple[int, int], seed: int = 0, extension: str = '.jpg') -> bytes:
+    """
+    A smooth random image, which compresses like a photograph.
+    """
+    width, height = image_size
+    noise = np.random.default_rng(seed).integers(0, 256, size=(height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+    image = cv2.GaussianBlur(cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC), (0, 0), 3)
+    return cv2.imencode(extension, image)[1].tobytes()
+
+def generate_image_files(images_path: str, file_names: list[str], image_size: tuple[int, int], seed: int = 0) -> None:
+    """
+    Writes the same encoded image under every name, which is much faster than
+    encoding each one and decodes at the same cost.
+    """
+    os.makedirs(images_path, exist_ok=True)
+    encoded = encode_test_image(image_size, seed, os.path.splitext(file_names[0])[1] if file_names else '.jpg')
+    for file_name in file_names:
+        with open(os.path.join(images_path, file_name), 'wb') as writer:
+            writer.write(encoded)
+
+def generate_yolo_dataset(
+        path: str,
+        images: int,
+        annotations_per_image: int,
+        vertices: int,
+        seed: int = 0,
+        image_size: tuple[int, int] = (640, 480)
+        ) -> str:
+    """
+    Writes a YOLOv8 dataset (`images/`, `labels/` with polygon labels and
+    `data.yaml`) and returns the path of the yaml file.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = image_size
+    file_names = [f'{i}.jpg' for i in range(images)]
+    generate_image_files(os.path.join(path, 'images'), file_names, image_size, seed)
+    os.makedirs(os.path.join(path, 'labels'), exist_ok=True)
+    for file_name in file_names:
+        origins = rng.uniform(0, 1, size=(annotations_per_image, 1, 2)) * [(width - 100) / width, (height - 100) / height]
+        polygons = origins + rng.uniform(0, 1, size=(annotations_per_image, vertices, 2)) * [100 / width, 100 / height]
+        class_ids = rng.integers(0, NUM_CLASSES, size=annotations_per_image)
+        lines = [
+            f"{class_id} " + ' '.join(f'{value:.6f}' for value in polygon.ravel().tolist())
+            for class_id, polygon in zip(class_ids.tolist(), polygons)
+        ]
+        with open(os.path.join(path, 'labels', os.path.splitext(file_name)[0] + '.txt'), 'w') as writer:
+            writer.write('\n'.join(lines) + '\n')
+
+    yaml_path = os.path.join(path, 'data.yaml')
+    with open(yaml_path, 'w') as writer:
+        yaml.safe_dump({'path': path, 'names': {i: f'class_{i}' for i in range(NUM_CLASSES)}}, writer)
+    return yaml_path
@@ -1,3 +1,6 @@
 from coco import COCOAdapter
 from yolov8 import YOLOv8Adapter
-from dataset import Dataset
\ No newline at end of file
+from snapshot import SnapshotAdapter
+from dataset import Dataset
+from annotation_store import AnnotationStore
+from dataset_view import DatasetView
\ No newline at end of file
@@ -0,0 +1,461 @@
+from array import array
+from typing import Iterable, Optional
+
+import numpy as np
+
+KIND_CLASSIFICATION = 0
+KIND_DETECTION = 1
+KIND_SEGMENTATION = 2
+KIND_MASK = 3
+
+def ragged_indices(offsets: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """
+    Returns the indices into a ragged buffer of every element of the given rows,
+    where the elements of row `i` are `buffer[offsets[i]:offsets[i + 1]]`.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = offsets[rows]
+    counts = offsets[rows + 1] - starts
+    total = int(counts.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    run_starts = np.cumsum(counts) - counts
+    return np.arange(total, dtype=np.int64) - np.repeat(run_starts - starts, counts)
+
+def counts_to_offsets(counts: np.ndarray) -> np.ndarray:
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+def polygon_areas(vertices: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Shoelace area of every polygon of a ragged vertex buffer, in one pass.
+    """
+    counts = np.diff(offsets)
+    areas = np.zeros(len(counts), dtype=np.float64)
+    if len(vertices) == 0:
+        return areas
+    x = vertices[:, 0].astype(np.float64)
+    y = vertices[:, 1].astype(np.float64)
+    following = np.arange(1, len(vertices) + 1, dtype=np.int64)
+    non_empty = counts > 0
+    following[offsets[1:][non_empty] - 1] = offsets[:-1][non_empty]
+    cross = x * y[following] - x[following] * y
+    areas[non_empty] = np.abs(np.add.reduceat(cross, offsets[:-1][non_empty])) / 2
+    return areas
+
+def polygon_bboxes(vertices: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    `(x, y, width, height)` of every polygon of a ragged vertex buffer. Empty
+    polygons get an all-zero box.
+    """
+    counts = np.diff(offsets)
+    bboxes = np.zeros((len(counts), 4), dtype=np.float64)
+    non_empty = counts > 0
+    if not non_empty.any():
+        return bboxes
+    starts = offsets[:-1][non_empty]
+    minimums = np.minimum.reduceat(vertices, starts, axis=0)
+    maximums = np.maximum.reduceat(vertices, starts, axis=0)
+    bboxes[non_empty, :2] = minimums
+    bboxes[non_empty, 2:] = maximums - minimums
+    return bboxes
+
+class AnnotationStore:
+    """
+    Columnar storage for the annotations of a dataset.
+
+    Every annotation is one row. Scalar attributes live in NumPy columns
+    (`annotation_ids`, `image_ids`, `class_ids`, `bboxes` as x/y/width/height,
+    `areas` and `kinds`) and all polygon vertices share one flat float32 buffer,
+    where the vertices of row `i` are `vertices[vertex_offsets[i]:vertex_offsets[i + 1]]`.
+
+    Mask annotations keep their compressed COCO RLE: the counts strings of all
+    rows share the `rle_counts` byte buffer (indexed by `rle_offsets`) and the
+    mask `(height, width)` is stored in `mask_sizes`.
+    """
+    COLUMNS = ('annotation_ids', 'image_ids', 'class_ids', 'bboxes', 'areas', 'kinds', 'mask_sizes')
+    RAGGED_COLUMNS = (('vertex_offsets', 'vertices'), ('rle_offsets', 'rle_counts'))
+
+    def __init__(self,
+                annotation_ids: np.ndarray,
+                image_ids: np.ndarray,
+                class_ids: np.ndarray,
+                bboxes: np.ndarray,
+                areas: np.ndarray,
+                kinds: np.ndarray,
+                vertex_offsets: np.ndarray,
+                vertices: np.ndarray,
+                mask_sizes: Optional[np.ndarray] = None,
+                rle_offsets: Optional[np.ndarray] = None,
+                rle_counts: Optional[np.ndarray] = None
+                ):
+        self.annotation_ids = np.asarray(annotation_ids, dtype=np.int64)
+        self.image_ids = np.asarray(image_ids, dtype=np.int64)
+        self.class_ids = np.asarray(class_ids, dtype=np.int64)
+        self.bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        self.areas = np.asarray(areas, dtype=np.float64)
+        self.kinds = np.asarray(kinds, dtype=np.int8)
+        self.vertex_offsets = np.asarray(vertex_offsets, dtype=np.int64)
+        self.vertices = np.asarray(vertices, dtype=np.float32).reshape(-1, 2)
+
+        if mask_sizes is None:
+            mask_sizes = np.zeros((len(self.annotation_ids), 2), dtype=np.int32)
+        if rle_offsets is None:
+            rle_offsets = np.zeros(len(self.annotation_ids) + 1, dtype=np.int64)
+        if rle_counts is None:
+            rle_counts = np.empty(0, dtype=np.uint8)
+        self.mask_sizes = np.asarray(mask_sizes, dtype=np.int32).reshape(-1, 2)
+        self.rle_offsets = np.asarray(rle_offsets, dtype=np.int64)
+        self.rle_counts = np.asarray(rle_counts, dtype=np.uint8)
+
+        if len(self.vertex_offsets) != len(self.annotation_ids) + 1:
+            raise ValueError("vertex_offsets must have one entry more than the number of annotations")
+        if len(self.rle_offsets) != len(self.annotation_ids) + 1:
+            raise ValueError("rle_offsets must have one entry more than the number of annotations")
+
+        self.version = 0
+        self._invalidate()
+
+    @classmethod
+    def empty(cls) -> "AnnotationStore":
+        return AnnotationStoreBuilder().build()
+
+    def __len__(self):
+        return len(self.annotation_ids)
+
+    def columns(self) -> dict[str, np.ndarray]:
+        """
+        All arrays backing this store, by attribute name.
+        """
+        names = list(self.COLUMNS)
+        for offsets_name, values_name in self.RAGGED_COLUMNS:
+            names.extend((offsets_name, values_name))
+        return {name: getattr(self, name) for name in names}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(column.nbytes for column in self.columns().values())
+
+    def _invalidate(self) -> None:
+        """
+        Drops the lookup tables derived from the columns. Must be called after
+        any change to `annotation_ids` or `image_ids`.
+        """
+        self.version += 1
+        self._id_order: Optional[np.ndarray] = None
+        self._sorted_ids: Optional[np.ndarray] = None
+        self._image_order: Optional[np.ndarray] = None
+        self._image_keys: Optional[np.ndarray] = None
+        self._image_starts: Optional[np.ndarray] = None
+
+    def touch(self) -> None:
+        """
+        Marks the columns as modified in place (e.g. shifted coordinates) so that
+        anything cached on top of this store gets recomputed.
+        """
+        self.version += 1
+
+    def _build_id_index(self) -> None:
+        if self._id_order is None:
+            self._id_order = np.argsort(self.annotation_ids, kind='stable')
+            self._sorted_ids = self.annotation_ids[self._id_order]
+
+    def _build_image_index(self) -> None:
+        if self._image_order is None:
+            self._image_order = np.argsort(self.image_ids, kind='stable')
+            sorted_image_ids = self.image_ids[self._image_order]
+            self._image_keys, self._image_starts = np.unique(sorted_image_ids, return_index=True)
+            self._image_starts = np.append(self._image_starts, len(sorted_image_ids))
+
+    def lookup_tables(self) -> dict[str, np.ndarray]:
+        """
+        The id and image lookup tables, built if needed, so that they can be
+        persisted next to the columns.
+        """
+        self._build_id_index()
+        self._build_image_index()
+        return {
+            'id_order': self._id_order,
+            'sorted_ids': self._sorted_ids,
+            'image_order': self._image_order,
+            'image_keys': self._image_keys,
+            'image_starts': self._image_starts
+        }
+
+    def restore_lookup_tables(self, tables: dict[str, np.ndarray]) -> None:
+        """
+        Reuses lookup tables saved by `lookup_tables` instead of rebuilding them.
+        """
+        if not tables:
+            return
+        self._id_order = tables['id_order']
+        self._sorted_ids = tables['sorted_ids']
+        self._image_order = tables['image_order']
+        self._image_keys = tables['image_keys']
+        self._image_starts = tables['image_starts']
+
+    def find_rows(self, annotation_ids: Iterable[int]) -> np.ndarray:
+        """
+        Returns the row of each annotation id, or -1 for unknown ids.
+        """
+        self._build_id_index()
+        annotation_ids = np.asarray(annotation_ids, dtype=np.int64)
+        if len(self._sorted_ids) == 0:
+            return np.full(len(annotation_ids), -1, dtype=np.int64)
+        positions = np.searchsorted(self._sorted_ids, annotation_ids)
+        positions = np.minimum(positions, len(self._sorted_ids) - 1)
+        found = self._sorted_ids[positions] == annotation_ids
+        return np.where(found, self._id_order[positions], -1)
+
+    def row_of(self, annotation_id: int) -> int:
+        row = int(self.find_rows([annotation_id])[0])
+        if row < 0:
+            raise KeyError(annotation_id)
+        return row
+
+    def contains(self, annotation_id: int) -> bool:
+        return int(self.find_rows([annotation_id])[0]) >= 0
+
+    def rows_for_image(self, image_id: int) -> np.ndarray:
+        self._build_image_index()
+        position = np.searchsorted(self._image_keys, image_id)
+        if position >= len(self._image_keys) or self._image_keys[position] != image_id:
+            return np.empty(0, dtype=np.int64)
+        return self._image_order[self._image_starts[position]:self._image_starts[position + 1]]
+
+    def rows_for_images(self, image_ids: Iterable[int]) -> np.ndarray:
+        return np.flatnonzero(np.isin(self.image_ids, np.asarray(list(image_ids), dtype=np.int64)))
+
+    def annotated_image_ids(self) -> np.ndarray:
+        self._build_image_index()
+        return self._image_keys
+
+    def vertex_counts(self) -> np.ndarray:
+        return np.diff(self.vertex_offsets)
+
+    def get_vertices(self, row: int) -> np.ndarray:
+        return self.vertices[self.vertex_offsets[row]:self.vertex_offsets[row + 1]]
+
+    def vertex_indices(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Returns the indices into `vertices` of every vertex of the given rows.
+        """
+        return ragged_indices(self.vertex_offsets, rows)
+
+    def vertex_rows(self) -> np.ndarray:
+        """
+        Returns, for each vertex in the buffer, the row it belongs to.
+        """
+        return np.repeat(np.arange(len(self), dtype=np.int64), self.vertex_counts())
+
+    def get_rle(self, row: int) -> Optional[dict]:
+        """
+        Returns the compressed RLE `{'size': [height, width], 'counts': bytes}` of a
+        mask row, or None for other kinds.
+        """
+        if self.kinds[row] != KIND_MASK:
+            return None
+        height, width = self.mask_sizes[row]
+        counts = self.rle_counts[self.rle_offsets[row]:self.rle_offsets[row + 1]].tobytes()
+        return {'size': [int(height), int(width)], 'counts': counts}
+
+    def take(self, rows: np.ndarray) -> "AnnotationStore":
+        """
+        Returns a new store with only the given rows, in the given order.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = {name: getattr(self, name)[rows] for name in self.COLUMNS}
+        for offsets_name, values_name in self.RAGGED_COLUMNS:
+            offsets = getattr(self, offsets_name)
+            columns[offsets_name] = counts_to_offsets(offsets[rows + 1] - offsets[rows])
+            columns[values_name] = getattr(self, values_name)[ragged_indices(offsets, rows)]
+        return AnnotationStore(**columns)
+
+    def copy(self) -> "AnnotationStore":
+        return AnnotationStore(**{name: column.copy() for name, column in self.columns().items()})
+
+    def remove_rows(self, rows: np.ndarray) -> None:
+        """
+        Removes the given rows in a single pass over the columns.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return
+        keep = np.ones(len(self), dtype=bool)
+        keep[rows] = False
+        kept = self.take(np.flatnonzero(keep))
+        self._replace_columns(kept)
+
+    def extend(self, other: "AnnotationStore") -> None:
+        """
+        Appends all rows of `other` to this store.
+        """
+        if len(other) == 0:
+            return
+        columns = {name: np.concatenate([getattr(self, name), getattr(other, name)]) for name in self.COLUMNS}
+        for offsets_name, values_name in self.RAGGED_COLUMNS:
+            offsets = getattr(self, offsets_name)
+            columns[offsets_name] = np.concatenate([offsets[:-1], getattr(other, offsets_name) + offsets[-1]])
+            columns[values_name] = np.concatenate([getattr(self, values_name), getattr(other, values_name)])
+        self._replace_columns(AnnotationStore(**columns))
+
+    def _set_ragged(self, offsets_name: str, values_name: str, row: int, values: np.ndarray) -> None:
+        offsets = getattr(self, offsets_name)
+        buffer = getattr(self, values_name)
+        start, end = offsets[row], offsets[row + 1]
+        if end - start == len(values):
+            buffer[start:end] = values
+        else:
+            setattr(self, values_name, np.concatenate([buffer[:start], values, buffer[end:]]))
+            offsets[row + 1:] += len(values) - (end - start)
+
+    def set_vertices(self, row: int, vertices: np.ndarray) -> None:
+        """
+        Replaces the polygon of one row. When the number of vertices changes the
+        vertex buffer is rebuilt.
+        """
+        vertices = np.asarray(vertices, dtype=np.float32).reshape(-1, 2)
+        self._set_ragged('vertex_offsets', 'vertices', row, vertices)
+        self.touch()
+
+    def set_rle(self, row: int, rle: Optional[dict]) -> None:
+        """
+        Replaces the compressed RLE of one row, or clears it when `rle` is None.
+        """
+        counts = np.frombuffer(rle['counts'], dtype=np.uint8) if rle is not None else np.empty(0, dtype=np.uint8)
+        self._set_ragged('rle_offsets', 'rle_counts', row, counts)
+        self.mask_sizes[row] = rle['size'] if rle is not None else (0, 0)
+        self.touch()
+
+    def assign_rows(self, rows: np.ndarray, other: "AnnotationStore") -> None:
+        """
+        Overwrites the given rows with the rows of `other`, in order. Annotation
+        and image ids are kept.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        for name in ('class_ids', 'bboxes', 'areas', 'kinds'):
+            getattr(self, name)[rows] = getattr(other, name)
+        for other_row, row in enumerate(rows.tolist()):
+            self.set_vertices(row, other.get_vertices(other_row))
+            self.set_rle(row, other.get_rle(other_row))
+
+    def set_image_id(self, row: int, image_id: int) -> None:
+        self.image_ids[row] = image_id
+        self._invalidate()
+
+    def _replace_columns(self, other: "AnnotationStore") -> None:
+        for name, column in other.columns().items():
+            setattr(self, name, column)
+        self._invalidate()
+
+class AnnotationStoreBuilder:
+    """
+    Accumulates annotations row by row into compact typed buffers and turns them
+    into an `AnnotationStore`, without keeping one Python object per annotation.
+    """
+    def __init__(self):
+        self.annotation_ids = array('q')
+        self.image_ids = array('q')
+        self.class_ids = array('q')
+        self.bboxes = array('d')
+        self.areas = array('d')
+        self.kinds = array('b')
+        self.vertex_counts = array('q')
+        self.vertices = array('f')
+        self.mask_sizes = array('i')
+        self.rle_lengths = array('q')
+        self.rle_counts = bytearray()
+
+    def __len__(self):
+        return len(self.annotation_ids)
+
+    def add(self,
+            annotation_id: int,
+            image_id: int,
+            class_id: int,
+            x: float,
+            y: float,
+            width: float,
+            height: float,
+            area: float,
+            points: Optional[Iterable[float]] = None,
+            kind: int = KIND_SEGMENTATION,
+            rle: Optional[dict] = None
+            ) -> None:
+        """
+        Adds one annotation. `points` is a flat sequence `x0, y0, x1, y1, ...`
+        or an array of shape (N, 2). `rle` is a compressed COCO RLE and is only
+        used with `kind=KIND_MASK`.
+        """
+        if points is None:
+            flat = np.empty(0, dtype=np.float32)
+        else:
+            flat = np.asarray(points, dtype=np.float32).ravel()
+        if len(flat) % 2 != 0:
+            raise ValueError("points must have an even number of coordinates")
+        if kind == KIND_MASK and rle is None:
+            raise ValueError("Mask annotations need an rle")
+
+        self.annotation_ids.append(int(annotation_id))
+        self.image_ids.append(int(image_id))
+        self.class_ids.append(int(class_id))
+        self.bboxes.extend((x, y, width, height))
+        self.areas.append(area)
+        self.kinds.append(kind)
+        self.vertices.frombytes(flat.tobytes())
+        self.vertex_counts.append(len(flat) // 2)
+
+        if rle is None:
+            self.mask_sizes.extend((0, 0))
+            self.rle_lengths.append(0)
+        else:
+            self.mask_sizes.extend((int(rle['size'][0]), int(rle['size'][1])))
+            self.rle_lengths.append(len(rle['counts']))
+            self.rle_counts.extend(rle['counts'])
+
+    def add_batch(self,
+            annotation_ids: np.ndarray,
+            image_ids: np.ndarray,
+            class_ids: np.ndarray,
+            bboxes: np.ndarray,
+            areas: np.ndarray,
+            kinds: np.ndarray,
+            vertex_counts: np.ndarray,
+            vertices: np.ndarray
+            ) -> None:
+        """
+        Adds many polygon or box annotations at once from column arrays. The
+        vertices of all rows are concatenated in `vertices`.
+        """
+        rows = len(annotation_ids)
+        vertex_counts = np.asarray(vertex_counts, dtype=np.int64)
+        vertices = np.asarray(vertices, dtype=np.float32).reshape(-1, 2)
+        if int(vertex_counts.sum()) != len(vertices):
+            raise ValueError("vertex_counts does not match the number of vertices")
+
+        self.annotation_ids.frombytes(np.asarray(annotation_ids, dtype=np.int64).tobytes())
+        self.image_ids.frombytes(np.broadcast_to(np.asarray(image_ids, dtype=np.int64), (rows,)).tobytes())
+        self.class_ids.frombytes(np.asarray(class_ids, dtype=np.int64).tobytes())
+        self.bboxes.frombytes(np.asarray(bboxes, dtype=np.float64).reshape(rows, 4).tobytes())
+        self.areas.frombytes(np.asarray(areas, dtype=np.float64).tobytes())
+        self.kinds.frombytes(np.asarray(kinds, dtype=np.int8).tobytes())
+        self.vertex_counts.frombytes(vertex_counts.tobytes())
+        self.vertices.frombytes(vertices.tobytes())
+        self.mask_sizes.frombytes(np.zeros(rows * 2, dtype=np.int32).tobytes())
+        self.rle_lengths.frombytes(np.zeros(rows, dtype=np.int64).tobytes())
+
+    def build(self) -> AnnotationStore:
+        return AnnotationStore(
+            annotation_ids = np.frombuffer(self.annotation_ids, dtype=np.int64).copy(),
+            image_ids = np.frombuffer(self.image_ids, dtype=np.int64).copy(),
+            class_ids = np.frombuffer(self.class_ids, dtype=np.int64).copy(),
+            bboxes = np.frombuffer(self.bboxes, dtype=np.float64).copy(),
+            areas = np.frombuffer(self.areas, dtype=np.float64).copy(),
+            kinds = np.frombuffer(self.kinds, dtype=np.int8).copy(),
+            vertex_offsets = counts_to_offsets(np.frombuffer(self.vertex_counts, dtype=np.int64)),
+            vertices = np.frombuffer(self.vertices, dtype=np.float32).copy(),
+            mask_sizes = np.frombuffer(self.mask_sizes, dtype=np.int32).copy(),
+            rle_offsets = counts_to_offsets(np.frombuffer(self.rle_lengths, dtype=np.int64)),
+            rle_counts = np.frombuffer(bytes(self.rle_counts), dtype=np.uint8).copy()
+        )
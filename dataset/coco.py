@@ -1,87 +1,137 @@
 import json
 import datetime
+from typing import Iterator, Optional, Union
 
-import cv2
-from pycocotools import mask as mask_utils
+import numpy as np
 
-from dataset import Dataset, Point, SegmentationAnnotation
+from dataset import Dataset
+from dataset_view import DatasetView
+from annotation_store import AnnotationStore, AnnotationStoreBuilder, KIND_CLASSIFICATION, KIND_DETECTION, KIND_MASK, KIND_SEGMENTATION, counts_to_offsets, ragged_indices
+from rle import compress_rle, rle_area, rle_bbox
+from json_stream import JSONObjectStream, JSONObjectWriter, dumps
+from index_cache import cache_path_for, file_signature, load_dataset_index, save_dataset_index
+from stage_timings import stage
 
 class COCOAdapter:
     @staticmethod
-    def load(json_path: str, images_path: str) -> Dataset:
+    def load(json_path: str, images_path: str, streaming: bool = True, use_cache: bool = True) -> Dataset:
         """
-        TODO: Add documentation
+        Loads a COCO dataset. By default the JSON file is parsed incrementally and
+        the dataset index is built while parsing, so the raw text and the full
+        parsed tree are never held in memory. `streaming=False` parses the whole
+        file at once, which is slightly faster for small files.
+
+        With `use_cache`, the parsed index is stored in a sidecar file next to the
+        JSON and reused as long as the JSON size and modification time match.
+
+        Reports the `coco.cache_read`, `coco.parse`, `coco.build` and
+        `coco.cache_write` stages (see `stage_timings.timed_stages`).
         """
-        coco_dataset = None
-        with open(json_path, 'r') as reader:
-            coco_dataset = json.loads(reader.read())
+        cache_path = cache_path_for(json_path)
+        signature = np.array(file_signature(json_path), dtype=np.int64)
+        if use_cache:
+            with stage('coco.cache_read'):
+                cached = load_dataset_index(cache_path)
+            if cached is not None:
+                dataset, extra_arrays = cached
+                if np.array_equal(extra_arrays.get('source_signature'), signature) and dataset.data_path == images_path:
+                    return dataset
 
-        id2class = {}
-        for class_info in coco_dataset['categories']:
-            id2class.update({
-                class_info['id']:class_info['name']
-            })
+        dataset = COCOAdapter._parse(json_path, images_path, streaming)
+        if use_cache:
+            with stage('coco.cache_write'):
+                save_dataset_index(cache_path, dataset, source_signature=signature)
+        return dataset
 
+    @staticmethod
+    def _parse(json_path: str, images_path: str, streaming: bool) -> Dataset:
+        id2class = {}
         image_id2image_name = {}
         image_id2image_dimensions = {}
-        for image_info in coco_dataset['images']:
-            image_id2image_name.update({
-                image_info['id']: image_info['file_name']
-            })
-            image_id2image_dimensions.update({
-                image_info['id']: (image_info['width'], image_info['height'])
-            })
-
-        annotation_id2image_id = {}
-        annotation_id2annotation = {}
-        for annotation_info in coco_dataset['annotations']:
-            annotation_id2image_id.update({
-                annotation_info['id']: annotation_info['image_id']
-            })
+        builder = AnnotationStoreBuilder()
 
-            points = []
-            if type(annotation_info['segmentation']) == dict:
-                pyObj = mask_utils.frPyObjects(
-                    annotation_info["segmentation"],
-                    annotation_info["segmentation"]["size"][0],
-                    annotation_info["segmentation"]["size"][1],
-                )
-                maskedArr = mask_utils.decode(pyObj)
-                contours, _ = cv2.findContours(maskedArr, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-                for contour in contours:
-                    for point in contour:
-                        x, y = point[0]
-                        x = float(x)
-                        y = float(y)
-                        points.append(Point(x, y))
+        with stage('coco.parse'), open(json_path, 'r') as reader:
+            if streaming:
+                items = ((key, value) for key, value, is_array_item in JSONObjectStream(reader) if is_array_item)
             else:
-                for i in range(0, len(annotation_info['segmentation'][0]), 2):
-                    x = annotation_info['segmentation'][0][i]
-                    y = annotation_info['segmentation'][0][i+1]
-                    points.append(Point(x, y))
+                coco_dataset = json.loads(reader.read())
+                items = (
+                    (key, value)
+                    for key in ('categories', 'images', 'annotations')
+                    for value in coco_dataset.get(key, [])
+                )
 
-            assert len(points) > 3, "The segmentation must have at least three points!"
+            for key, value in items:
+                if key == 'annotations':
+                    COCOAdapter._add_annotation(builder, value)
+                elif key == 'images':
+                    image_id2image_name.update({
+                        value['id']: value['file_name']
+                    })
+                    image_id2image_dimensions.update({
+                        value['id']: (value['width'], value['height'])
+                    })
+                elif key == 'categories':
+                    id2class.update({
+                        value['id']: value['name']
+                    })
+
+        with stage('coco.build'):
+            return Dataset.from_annotation_store(
+                id2class = id2class,
+                data_path = images_path,
+                image_id2image_name = image_id2image_name,
+                image_id2image_dimensions = image_id2image_dimensions,
+                annotation_store = builder.build()
+            )
+
+    @staticmethod
+    def _add_annotation(builder: AnnotationStoreBuilder, annotation_info: dict) -> None:
+        if type(annotation_info['segmentation']) == dict:
+            rle = compress_rle(annotation_info['segmentation'])
+            bbox = annotation_info['bbox'] if 'bbox' in annotation_info else rle_bbox(rle)
+            builder.add(
+                annotation_id = annotation_info['id'],
+                image_id = annotation_info['image_id'],
+                class_id = annotation_info['category_id'],
+                x = bbox[0],
+                y = bbox[1],
+                width = bbox[2],
+                height = bbox[3],
+                area = annotation_info['area'] if 'area' in annotation_info else rle_area(rle),
+                kind = KIND_MASK,
+                rle = rle
+            )
+            return
 
-            annotation = SegmentationAnnotation(
+        if len(annotation_info['segmentation']) == 0 or len(annotation_info['segmentation'][0]) == 0:
+            builder.add(
+                annotation_id = annotation_info['id'],
+                image_id = annotation_info['image_id'],
                 class_id = annotation_info['category_id'],
                 x = annotation_info['bbox'][0],
                 y = annotation_info['bbox'][1],
                 width = annotation_info['bbox'][2],
                 height = annotation_info['bbox'][3],
                 area = annotation_info['area'],
-                points = points
+                kind = KIND_DETECTION
             )
-            annotation_id2annotation.update({
-                annotation_info['id']: annotation
-            })
+            return
+
+        points = np.asarray(annotation_info['segmentation'][0], dtype=np.float32).reshape(-1, 2)
+
+        assert len(points) > 3, "The segmentation must have at least three points!"
 
-        return Dataset(
-            id2class = id2class,
-            data_path = images_path,
-            image_id2image_name = image_id2image_name,
-            image_id2image_dimensions = image_id2image_dimensions,
-            annotation_id2image_id = annotation_id2image_id,
-            annotation_id2annotation = annotation_id2annotation
+        builder.add(
+            annotation_id = annotation_info['id'],
+            image_id = annotation_info['image_id'],
+            class_id = annotation_info['category_id'],
+            x = annotation_info['bbox'][0],
+            y = annotation_info['bbox'][1],
+            width = annotation_info['bbox'][2],
+            height = annotation_info['bbox'][3],
+            area = annotation_info['area'],
+            points = points
         )
 
     @staticmethod
@@ -113,41 +163,121 @@ class COCOAdapter:
         }
 
     @staticmethod
-    def save(dataset: Dataset, json_path: str) -> None:
-        """
-        TODO: Add documentation
-        """
-        coco_dataset = COCOAdapter._get_coco_template()
-        
-        for image_id, image_name in dataset.image_id2image_name.items():
-            coco_dataset['images'].append({
+    def _image_batches(image_id2image_name, image_id2image_dimensions, batch_size: int) -> Iterator[list[dict]]:
+        batch = []
+        for image_id, image_name in image_id2image_name.items():
+            width, height = image_id2image_dimensions[image_id]
+            batch.append({
                 "id": image_id,
                 "file_name": image_name,
-                "width": dataset.image_id2image_dimensions[image_id][0],
-                "height": dataset.image_id2image_dimensions[image_id][1],
+                "width": width,
+                "height": height,
                 "license": 0
             })
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        yield batch
 
-        for annotation_id, annotation in dataset.annotation_id2annotation.items():
-            ann = {
-                "id": annotation_id,
-                "image_id": dataset.annotation_id2image_id[annotation_id],
-                "category_id": annotation.class_id,
-                "segmentation": [],
-                "area": annotation.area,
-                "bbox": [annotation.x, annotation.y, annotation.width, annotation.height],
-                "iscrowd": 0
-            }
-            for point in annotation.points:
-                ann['segmentation'].extend([point.x, point.y])
-            coco_dataset['annotations'].append(ann)
+    @staticmethod
+    def _annotation_batches(store: AnnotationStore, rows: np.ndarray, batch_size: int) -> Iterator[list[dict]]:
+        """
+        Builds the COCO annotations straight from the store columns, one batch of
+        rows at a time. Polygons are written as one flat list of coordinates and
+        masks as a compressed RLE; classification rows have no COCO form and are
+        skipped.
+        """
+        rows = rows[store.kinds[rows] != KIND_CLASSIFICATION]
+        for start in range(0, len(rows), batch_size):
+            batch_rows = rows[start:start + batch_size]
+            vertex_offsets = (counts_to_offsets(store.vertex_counts()[batch_rows]) * 2).tolist()
+            coordinates = store.vertices[store.vertex_indices(batch_rows)].ravel().tolist()
+            rle_offsets = counts_to_offsets(np.diff(store.rle_offsets)[batch_rows]).tolist()
+            rle_counts = store.rle_counts[ragged_indices(store.rle_offsets, batch_rows)].tobytes().decode('ascii')
 
-        for class_id, class_name in dataset.id2class.items():
-            coco_dataset['categories'].append({
+            batch = []
+            for position, (annotation_id, image_id, class_id, kind, bbox, area, mask_size) in enumerate(zip(
+                    store.annotation_ids[batch_rows].tolist(),
+                    store.image_ids[batch_rows].tolist(),
+                    store.class_ids[batch_rows].tolist(),
+                    store.kinds[batch_rows].tolist(),
+                    store.bboxes[batch_rows].tolist(),
+                    store.areas[batch_rows].tolist(),
+                    store.mask_sizes[batch_rows].tolist())):
+                if kind == KIND_MASK:
+                    segmentation = {
+                        "size": mask_size,
+                        "counts": rle_counts[rle_offsets[position]:rle_offsets[position + 1]]
+                    }
+                elif kind == KIND_SEGMENTATION:
+                    segmentation = [coordinates[vertex_offsets[position]:vertex_offsets[position + 1]]]
+                else:
+                    segmentation = []
+                batch.append({
+                    "id": annotation_id,
+                    "image_id": image_id,
+                    "category_id": class_id,
+                    "segmentation": segmentation,
+                    "area": area,
+                    "bbox": bbox,
+                    "iscrowd": 1 if kind == KIND_MASK else 0
+                })
+            yield batch
+
+    @staticmethod
+    def save(dataset: Union[Dataset, DatasetView],
+                json_path: str,
+                indent: Optional[int] = 4,
+                fast_json: bool = True,
+                streaming: bool = True,
+                batch_size: int = 10000
+                ) -> None:
+        """
+        Saves a dataset, or a view of one (e.g. a split), as a COCO JSON file.
+
+        By default the file is written incrementally: images and annotations
+        are encoded in batches straight from the annotation store, so the full
+        COCO dict and the full JSON text are never held in memory.
+        `indent=None` writes compact JSON, which is smaller and much faster to
+        write. With `fast_json`, orjson is used when it is installed and the
+        indentation allows it (compact or 2 spaces). `streaming=False` builds
+        the whole document before writing it. Reports the `coco.save.images`
+        and `coco.save.annotations` stages when streaming.
+        """
+        if isinstance(dataset, DatasetView):
+            store = dataset.dataset.annotation_store
+            rows = dataset.annotation_rows
+            id2class = dataset.dataset.id2class
+        else:
+            store = dataset.annotation_store
+            rows = np.arange(len(store))
+            id2class = dataset.id2class
+
+        template = COCOAdapter._get_coco_template()
+        images = COCOAdapter._image_batches(dataset.image_id2image_name, dataset.image_id2image_dimensions, batch_size)
+        annotations = COCOAdapter._annotation_batches(store, rows, batch_size)
+        categories = [[
+            {
                 "id": class_id,
                 "name": class_name,
                 "supercategory": ""
-            })
+            }
+            for class_id, class_name in id2class.items()
+        ]]
 
         with open(json_path, 'w') as writer:
-            writer.write(json.dumps(coco_dataset, indent=4))
\ No newline at end of file
+            if not streaming:
+                template['images'] = [image for batch in images for image in batch]
+                template['annotations'] = [annotation for batch in annotations for annotation in batch]
+                template['categories'] = categories[0]
+                writer.write(dumps(template, indent, fast_json))
+                return
+
+            with JSONObjectWriter(writer, indent, fast_json) as json_writer:
+                json_writer.write_value('info', template['info'])
+                json_writer.write_value('licenses', template['licenses'])
+                with stage('coco.save.images'):
+                    json_writer.write_array('images', images)
+                with stage('coco.save.annotations'):
+                    json_writer.write_array('annotations', annotations)
+                json_writer.write_array('categories', categories)
@@ -0,0 +1,323 @@
+import os
+import json
+import shutil
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from annotation_store import AnnotationStore, KIND_CLASSIFICATION, KIND_DETECTION, KIND_MASK, KIND_SEGMENTATION, counts_to_offsets, polygon_areas
+from rle import crop_rle, rle_area
+
+PROGRESS_FILE_NAME = '.crop_progress'
+
+@dataclass
+class CropPlan:
+    """
+    One crop box `(left, top, right, bottom)` per image, in pixels. Boxes that
+    cover the whole image leave it unchanged.
+    """
+    image_ids: np.ndarray
+    boxes: np.ndarray
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def digest(self) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(np.ascontiguousarray(self.image_ids, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(self.boxes, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+def check_boxes(image_ids: np.ndarray, boxes: np.ndarray) -> None:
+    """
+    Raises a `ValueError` when a crop box is empty, which would give an image
+    without pixels.
+    """
+    empty = np.flatnonzero((boxes[:, 2] <= boxes[:, 0]) | (boxes[:, 3] <= boxes[:, 1]))
+    if len(empty) > 0:
+        raise ValueError(f"Empty crop box for {len(empty)} images, e.g. image {int(image_ids[empty[0]])}: {boxes[empty[0]].tolist()}")
+
+def image_dimensions(dataset, image_ids: np.ndarray) -> np.ndarray:
+    """
+    `(N, 2)` declared width and height of the given images.
+    """
+    return np.array([dataset.image_id2image_dimensions[image_id] for image_id in image_ids.tolist()], dtype=np.int64).reshape(-1, 2)
+
+def plan_fixed_crop(dataset, left: int, top: int, right: int, bottom: int) -> CropPlan:
+    """
+    The same box for every image, clipped to the size of each image. Raises a
+    `ValueError` when the box leaves nothing of some image.
+    """
+    image_ids = np.sort(np.fromiter(dataset.image_id2image_name.keys(), dtype=np.int64, count=len(dataset.image_id2image_name)))
+    dimensions = image_dimensions(dataset, image_ids)
+    boxes = np.empty((len(image_ids), 4), dtype=np.int64)
+    boxes[:, 0] = np.clip(left, 0, dimensions[:, 0])
+    boxes[:, 1] = np.clip(top, 0, dimensions[:, 1])
+    boxes[:, 2] = np.clip(right, boxes[:, 0], dimensions[:, 0])
+    boxes[:, 3] = np.clip(bottom, boxes[:, 1], dimensions[:, 1])
+    check_boxes(image_ids, boxes)
+    return CropPlan(image_ids, boxes)
+
+def plan_annotation_crop(dataset, margin: int) -> CropPlan:
+    """
+    For every image, the box around all of its annotation bboxes grown by
+    `margin` and clipped to the image, computed in one pass over the bbox
+    columns. Images without annotations keep their whole extent.
+    """
+    store = dataset.annotation_store
+    image_ids = np.sort(np.fromiter(dataset.image_id2image_name.keys(), dtype=np.int64, count=len(dataset.image_id2image_name)))
+    dimensions = image_dimensions(dataset, image_ids)
+
+    rows = np.flatnonzero(np.isin(store.image_ids, image_ids))
+    positions = np.searchsorted(image_ids, store.image_ids[rows])
+    x0, y0 = store.bboxes[rows, 0], store.bboxes[rows, 1]
+    x1, y1 = x0 + store.bboxes[rows, 2], y0 + store.bboxes[rows, 3]
+
+    extents = np.empty((len(image_ids), 4), dtype=np.float64)
+    extents[:, :2] = np.inf
+    extents[:, 2:] = -np.inf
+    np.minimum.at(extents[:, 0], positions, x0)
+    np.minimum.at(extents[:, 1], positions, y0)
+    np.maximum.at(extents[:, 2], positions, x1)
+    np.maximum.at(extents[:, 3], positions, y1)
+
+    annotated = np.isfinite(extents[:, 0])
+    boxes = np.zeros((len(image_ids), 4), dtype=np.int64)
+    boxes[:, 2:] = dimensions
+    boxes[annotated, 0] = np.clip(np.floor(extents[annotated, 0] - margin), 0, dimensions[annotated, 0])
+    boxes[annotated, 1] = np.clip(np.floor(extents[annotated, 1] - margin), 0, dimensions[annotated, 1])
+    boxes[annotated, 2] = np.clip(np.ceil(extents[annotated, 2] + margin), boxes[annotated, 0], dimensions[annotated, 0])
+    boxes[annotated, 3] = np.clip(np.ceil(extents[annotated, 3] + margin), boxes[annotated, 1], dimensions[annotated, 1])
+    check_boxes(image_ids, boxes)
+    return CropPlan(image_ids, boxes)
+
+def crop_annotations(store: AnnotationStore, plan: CropPlan) -> np.ndarray:
+    """
+    Shifts the annotations of the planned images into their crop box and clips
+    them to it, in place: bboxes and polygon vertices in one pass over the
+    columns, masks one by one. Areas are recomputed. Returns the rows left
+    outside the crop box, whose clipped bbox is empty, for the caller to
+    remove together with its other removals.
+    """
+    rows = np.flatnonzero(np.isin(store.image_ids, plan.image_ids) & (store.kinds != KIND_CLASSIFICATION))
+    boxes = plan.boxes[np.searchsorted(plan.image_ids, store.image_ids[rows])].astype(np.float64)
+    widths = boxes[:, 2] - boxes[:, 0]
+    heights = boxes[:, 3] - boxes[:, 1]
+
+    bboxes = store.bboxes[rows]
+    x0 = np.clip(bboxes[:, 0] - boxes[:, 0], 0, widths)
+    y0 = np.clip(bboxes[:, 1] - boxes[:, 1], 0, heights)
+    x1 = np.clip(bboxes[:, 0] + bboxes[:, 2] - boxes[:, 0], 0, widths)
+    y1 = np.clip(bboxes[:, 1] + bboxes[:, 3] - boxes[:, 1], 0, heights)
+    store.bboxes[rows] = np.stack([x0, y0, x1 - x0, y1 - y0], axis=1)
+    detection = rows[store.kinds[rows] == KIND_DETECTION]
+    store.areas[detection] = store.bboxes[detection, 2] * store.bboxes[detection, 3]
+
+    row_position = np.full(len(store), -1, dtype=np.int64)
+    row_position[rows] = np.arange(len(rows))
+    positions = row_position[store.vertex_rows()]
+    shifted = positions >= 0
+    positions = positions[shifted]
+    store.vertices[shifted, 0] = np.clip(store.vertices[shifted, 0] - boxes[positions, 0], 0, widths[positions])
+    store.vertices[shifted, 1] = np.clip(store.vertices[shifted, 1] - boxes[positions, 1], 0, heights[positions])
+    segmentation = rows[store.kinds[rows] == KIND_SEGMENTATION]
+    store.areas[segmentation] = np.abs(polygon_areas(store.vertices, store.vertex_offsets))[segmentation]
+
+    masks = rows[store.kinds[rows] == KIND_MASK]
+    if len(masks) > 0:
+        # The RLE buffer is rebuilt once instead of once per mask.
+        counts = [store.rle_counts[store.rle_offsets[row]:store.rle_offsets[row + 1]] for row in range(len(store))]
+        for row, (left, top, right, bottom) in zip(masks.tolist(), boxes[row_position[masks]].astype(np.int64).tolist()):
+            rle = crop_rle(store.get_rle(row), left, top, right, bottom)
+            counts[row] = np.frombuffer(rle['counts'], dtype=np.uint8)
+            store.mask_sizes[row] = rle['size']
+            store.areas[row] = rle_area(rle)
+        store.rle_offsets = counts_to_offsets(np.fromiter(map(len, counts), dtype=np.int64, count=len(counts)))
+        store.rle_counts = np.concatenate(counts) if counts else np.empty(0, dtype=np.uint8)
+    store.touch()
+    return rows[(x1 <= x0) | (y1 <= y0)]
+
+def _record_progress(progress_path: str, image_id: int, size: tuple[int, int]) -> None:
+    # Lines this short are appended atomically, so workers can share the file.
+    with open(progress_path, 'a') as writer:
+        writer.write(json.dumps([[image_id, list(size)]]) + '\n')
+
+def _crop_files(tasks: list[tuple[int, str, str, tuple[int, int, int, int]]], progress_path: str) -> list[Optional[tuple[int, int]]]:
+    """
+    Crops `source` into `destination` for every task and returns the size of
+    every result, or None when the image could not be cropped. Every image is
+    recorded in the progress file as soon as it is done.
+    """
+    sizes = []
+    for image_id, source, destination, box in tasks:
+        try:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with Image.open(source) as image:
+                image_format = image.format
+                left, top, right, bottom = box
+                box = (left, top, min(right, image.width), min(bottom, image.height))
+                if box == (0, 0, image.width, image.height):
+                    if os.path.abspath(source) != os.path.abspath(destination):
+                        shutil.copy2(source, destination)
+                    _record_progress(progress_path, image_id, image.size)
+                    sizes.append(image.size)
+                    continue
+                cropped = image.crop(box)
+                cropped.load()
+            # Written next to the destination, recorded, and only then moved in
+            # place: an interrupted crop never leaves a half-written image, and
+            # a resumed in-place crop finishes the move instead of cropping the
+            # image a second time (see `BatchCropper._load_progress`).
+            temporary_path = destination + '.tmp'
+            cropped.save(temporary_path, format=image_format, **({'quality': 95} if image_format == 'JPEG' else {}))
+            _record_progress(progress_path, image_id, cropped.size)
+            os.replace(temporary_path, destination)
+            sizes.append(cropped.size)
+        except Exception:
+            sizes.append(None)
+    return sizes
+
+class BatchCropper:
+    """
+    Crops the images of a dataset according to a `CropPlan` in a process pool,
+    writing to `output_path` (which may be the dataset directory itself to
+    crop in place). Every finished image is appended to a progress file in the
+    output directory, so an interrupted run can be started again with the same
+    plan and only crops the remaining images.
+    """
+    def __init__(self, dataset, output_path: str, workers: Optional[int] = None, chunk_size: int = 64):
+        self.dataset = dataset
+        self.output_path = output_path
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.progress_path = os.path.join(output_path, PROGRESS_FILE_NAME)
+        self.failed: list[int] = []
+
+    def _load_progress(self, plan: CropPlan) -> dict[int, tuple[int, int]]:
+        if not os.path.exists(self.progress_path):
+            return {}
+        done = {}
+        with open(self.progress_path, 'r') as reader:
+            lines = reader.read().splitlines()
+        try:
+            if len(lines) == 0 or json.loads(lines[0]) != {'plan': plan.digest()}:
+                return {}
+        except ValueError:
+            return {}
+        for line in lines[1:]:
+            try:
+                records = [(int(image_id), tuple(size)) for image_id, size in json.loads(line)]
+            except (ValueError, TypeError):
+                # A line cut short by the interruption is skipped.
+                continue
+            done.update(records)
+
+        # An image recorded but not yet moved in place was interrupted between
+        # the two steps; its cropped file is complete.
+        for image_id in done:
+            destination = os.path.join(self.output_path, self.dataset.image_id2image_name[image_id])
+            if os.path.exists(destination + '.tmp'):
+                os.replace(destination + '.tmp', destination)
+        return done
+
+    def crop_images(self, plan: CropPlan) -> dict[int, tuple[int, int]]:
+        """
+        Crops the image files and returns the size of every image that was
+        written. Images that could not be cropped are listed in `failed`. The
+        progress file is kept until `finish` is called.
+        """
+        dataset = self.dataset
+        os.makedirs(self.output_path, exist_ok=True)
+        sizes = self._load_progress(plan)
+        pending = [image_id for image_id in plan.image_ids.tolist() if image_id not in sizes]
+        boxes = dict(zip(plan.image_ids.tolist(), map(tuple, plan.boxes.tolist())))
+        chunks = [pending[start:start + self.chunk_size] for start in range(0, len(pending), self.chunk_size)]
+        self.failed = []
+
+        with open(self.progress_path, 'w') as writer:
+            # The file is rewritten from the records that were read back, which
+            # drops a last line cut short by the interruption. The workers
+            # append to it from then on.
+            writer.write(json.dumps({'plan': plan.digest()}) + '\n')
+            if sizes:
+                writer.write(json.dumps([[image_id, list(size)] for image_id, size in sizes.items()]) + '\n')
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            in_flight = deque()
+            next_chunk = 0
+            while next_chunk < len(chunks) or in_flight:
+                while next_chunk < len(chunks) and len(in_flight) < 2 * self.workers:
+                    chunk = chunks[next_chunk]
+                    tasks = [
+                        (
+                            image_id,
+                            os.path.join(dataset.data_path, dataset.image_id2image_name[image_id]),
+                            os.path.join(self.output_path, dataset.image_id2image_name[image_id]),
+                            boxes[image_id]
+                        )
+                        for image_id in chunk
+                    ]
+                    in_flight.append((chunk, executor.submit(_crop_files, tasks, self.progress_path)))
+                    next_chunk += 1
+
+                chunk, future = in_flight.popleft()
+                for image_id, size in zip(chunk, future.result()):
+                    if size is None:
+                        self.failed.append(image_id)
+                    else:
+                        sizes[image_id] = size
+        return sizes
+
+    def finish(self) -> None:
+        """
+        Removes the progress file once the crops are recorded elsewhere, after
+        which running the same plan again crops every image from scratch.
+        """
+        if os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+
+    def run(self, plan: CropPlan, dry_run: bool = False):
+        """
+        Crops the images and returns a new `Dataset` over `output_path` with
+        the cropped annotations and dimensions; annotations left outside the
+        crop box are removed. With `dry_run`, no file is read or written and
+        the dimensions are the planned ones. Images that could not be cropped
+        are listed in `failed`: they keep their annotations and dimensions
+        when cropping in place, and are left out of the returned dataset
+        otherwise, since their file is missing from `output_path`.
+        """
+        dataset = self.dataset
+        if dry_run:
+            sizes = {image_id: (right - left, bottom - top) for image_id, (left, top, right, bottom) in zip(plan.image_ids.tolist(), plan.boxes.tolist())}
+        else:
+            sizes = self.crop_images(plan)
+            if len(self.failed) == 0:
+                self.finish()
+        cropped = np.isin(plan.image_ids, np.fromiter(sizes.keys(), dtype=np.int64, count=len(sizes)))
+
+        annotation_store = dataset.annotation_store.copy()
+        emptied = crop_annotations(annotation_store, CropPlan(plan.image_ids[cropped], plan.boxes[cropped]))
+        image_id2image_name = dict(dataset.image_id2image_name)
+        image_id2image_dimensions = dict(dataset.image_id2image_dimensions)
+        image_id2image_dimensions.update(sizes)
+
+        missing = []
+        if os.path.abspath(self.output_path) != os.path.abspath(dataset.data_path):
+            missing = self.failed
+        for image_id in missing:
+            image_id2image_name.pop(image_id)
+            image_id2image_dimensions.pop(image_id)
+        missing_rows = np.flatnonzero(np.isin(annotation_store.image_ids, np.array(missing, dtype=np.int64)))
+        annotation_store.remove_rows(np.union1d(emptied, missing_rows))
+        return type(dataset).from_annotation_store(
+            id2class = dict(dataset.id2class),
+            data_path = self.output_path,
+            image_id2image_name = image_id2image_name,
+            image_id2image_dimensions = image_id2image_dimensions,
+            annotation_store = annotation_store
+        )
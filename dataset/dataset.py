@@ -4,21 +4,64 @@ import yaml
 import json
 import glob
 import math
-import shutil
 import random
 import datetime
 import numpy as np
 from PIL import Image
 from logging import Logger
 from dataclasses import dataclass
+from collections.abc import Callable, Hashable, Iterable, Iterator, Mapping, MutableMapping
+from typing import Union
 from pycocotools import mask as mask_utils
 
+from annotation_store import (
+    AnnotationStore,
+    AnnotationStoreBuilder,
+    KIND_CLASSIFICATION,
+    KIND_DETECTION,
+    KIND_SEGMENTATION,
+    KIND_MASK
+)
+from rle import decode_rle, rle_to_polygons, rle_area, rle_bbox
+from dataset_statistics import DatasetStatistics
+from image_cache import ImageCache, ImagePrefetcher
+from histograms import HistogramEngine
+from spatial_index import SpatialIndex
+from image_hashes import DuplicateImageFinder, DuplicateReport, ImageHashStore, hash_store_path_for
+from validation import ALL_CHECKS, DatasetValidator, ValidationIssue, list_existing_files
+from dataset_view import DatasetView
+from splits import split_image_ids
+from image_pipeline import ImageBatch, iter_image_batches
+from crop import BatchCropper, CropPlan, crop_annotations, plan_annotation_crop, plan_fixed_crop
+from masks import MaskEngine
+from edit_journal import EditJournal
+
+class ReadOnlyCopy:
+    """
+    Base of the objects built from an `AnnotationStore` row. They are copies,
+    so once `freeze` is called assigning to them raises a `TypeError` instead
+    of losing the change.
+    """
+    _frozen = False
+
+    def freeze(self) -> None:
+        object.__setattr__(self, '_frozen', True)
+
+    def __setattr__(self, name, value):
+        if self._frozen:
+            raise TypeError(
+                f"{type(self).__name__} read from a dataset is a copy; edit `dataclasses.replace(annotation, ...)` "
+                "and assign it to `annotation_id2annotation[annotation_id]`, or use `Dataset.add_annotation` "
+                "and `Dataset.edit_annotation`"
+            )
+        super().__setattr__(name, value)
+
 @dataclass
-class Point:
+class Point(ReadOnlyCopy):
     x: float
     y: float
 
-class Annotation:
+class Annotation(ReadOnlyCopy):
     pass
 
 @dataclass
@@ -34,7 +77,12 @@ class DetectionAnnotation(ClassificationAnnotation):
     area: float
 
     def get_mask(self, image_dimensions: tuple[int, int]) -> np.array:
-        mask = np.zeros(image_dimensions, dtype=np.uint8)
+        """
+        Full-image mask of the annotation; `image_dimensions` is `(width, height)`.
+        For many annotations of an image, use `Dataset.masks` instead.
+        """
+        width, height = image_dimensions
+        mask = np.zeros((height, width), dtype=np.uint8)
         mask[int(self.y):int(self.y + self.height), int(self.x):int(self.x + self.width)] = 1
         return mask
 
@@ -46,14 +94,37 @@ class SegmentationAnnotation(DetectionAnnotation):
     points: list[Point]
 
     def get_mask(self, image_dimensions: tuple[int, int]) -> np.array:
-        mask = np.zeros(image_dimensions, dtype=np.uint8)
-        points = [[(point.x, point.y)] for point in self.points]
-        cv2.fillPoly(mask, points, 1)
+        width, height = image_dimensions
+        mask = np.zeros((height, width), dtype=np.uint8)
+        points = np.round([[point.x, point.y] for point in self.points]).astype(np.int32).reshape(-1, 2)
+        if len(points) >= 3:
+            cv2.fillPoly(mask, [points], 1)
         return mask
     
     def compute_area_from_points(self) -> None:
         self.area = cv2.contourArea(np.array([[point.x, point.y] for point in self.points]))
 
+@dataclass
+class MaskAnnotation(DetectionAnnotation):
+    """
+    Annotation kept as a compressed COCO RLE (`{'size': [height, width], 'counts': bytes}`).
+    The mask is only decoded or polygonized on request, and decoded masks are
+    shared through an LRU cache.
+    """
+    rle: dict
+
+    def get_mask(self, image_dimensions: tuple[int, int] = None) -> np.array:
+        return decode_rle(self.rle)
+
+    def get_polygons(self) -> list[list[Point]]:
+        return [[Point(float(x), float(y)) for x, y in polygon] for polygon in rle_to_polygons(self.rle)]
+
+    def compute_area_from_rle(self) -> None:
+        self.area = rle_area(self.rle)
+
+    def compute_bbox_from_rle(self) -> None:
+        self.x, self.y, self.width, self.height = rle_bbox(self.rle)
+
 @dataclass
 class ImageInfo:
     id: int
@@ -62,6 +133,154 @@ class ImageInfo:
     height: int
     annotations: list[Annotation]
 
+def annotation_from_row(store: AnnotationStore, row: int) -> Annotation:
+    """
+    Materializes the annotation stored at `row` as a dataclass. The returned
+    object is a read-only copy: changes are made on a new annotation written
+    back through `Dataset.annotation_id2annotation[annotation_id] = annotation`.
+    """
+    annotation = _annotation_from_row(store, row)
+    if isinstance(annotation, SegmentationAnnotation):
+        for point in annotation.points:
+            point.freeze()
+    annotation.freeze()
+    return annotation
+
+def _annotation_from_row(store: AnnotationStore, row: int) -> Annotation:
+    kind = store.kinds[row]
+    class_id = int(store.class_ids[row])
+    if kind == KIND_CLASSIFICATION:
+        return ClassificationAnnotation(class_id = class_id)
+
+    x, y, width, height = (float(value) for value in store.bboxes[row])
+    area = float(store.areas[row])
+    if kind == KIND_DETECTION:
+        return DetectionAnnotation(class_id = class_id, x = x, y = y, width = width, height = height, area = area)
+    if kind == KIND_MASK:
+        return MaskAnnotation(
+            class_id = class_id, x = x, y = y, width = width, height = height, area = area, rle = store.get_rle(row)
+        )
+
+    return SegmentationAnnotation(
+        class_id = class_id,
+        x = x,
+        y = y,
+        width = width,
+        height = height,
+        area = area,
+        points = [Point(float(px), float(py)) for px, py in store.get_vertices(row)]
+    )
+
+def add_annotation_to_builder(builder: AnnotationStoreBuilder, annotation_id: int, image_id: int, annotation: Annotation) -> None:
+    if isinstance(annotation, MaskAnnotation):
+        builder.add(annotation_id, image_id, annotation.class_id, annotation.x, annotation.y,
+                    annotation.width, annotation.height, annotation.area, None, KIND_MASK, annotation.rle)
+    elif isinstance(annotation, SegmentationAnnotation):
+        points = np.array([(point.x, point.y) for point in annotation.points], dtype=np.float32).reshape(-1, 2)
+        builder.add(annotation_id, image_id, annotation.class_id, annotation.x, annotation.y,
+                    annotation.width, annotation.height, annotation.area, points, KIND_SEGMENTATION)
+    elif isinstance(annotation, DetectionAnnotation):
+        builder.add(annotation_id, image_id, annotation.class_id, annotation.x, annotation.y,
+                    annotation.width, annotation.height, annotation.area, None, KIND_DETECTION)
+    else:
+        builder.add(annotation_id, image_id, annotation.class_id, 0, 0, 0, 0, 0, None, KIND_CLASSIFICATION)
+
+class AnnotationMapping(MutableMapping):
+    """
+    `annotation_id -> Annotation` view over an `AnnotationStore`. Annotations
+    are built on access as read-only copies; assigning to an existing id
+    writes the annotation back into the store, and assigning to a new id adds
+    it to the image set for it in `image_ids` beforehand.
+    """
+    def __init__(self, store: AnnotationStore, image_ids: "AnnotationImageMapping"):
+        self.store = store
+        self.image_ids = image_ids
+
+    def __getitem__(self, annotation_id: int) -> Annotation:
+        return annotation_from_row(self.store, self.store.row_of(annotation_id))
+
+    def __setitem__(self, annotation_id: int, annotation: Annotation) -> None:
+        builder = AnnotationStoreBuilder()
+        if self.store.contains(annotation_id):
+            row = self.store.row_of(annotation_id)
+            add_annotation_to_builder(builder, annotation_id, self.store.image_ids[row], annotation)
+            self.store.assign_rows([row], builder.build())
+            return
+
+        if annotation_id not in self.image_ids.new_annotations:
+            raise KeyError(f"Annotation {annotation_id} has no image; set `annotation_id2image_id[{annotation_id}]` first or use `Dataset.add_annotation`")
+        add_annotation_to_builder(builder, annotation_id, self.image_ids.new_annotations.pop(annotation_id), annotation)
+        self.store.extend(builder.build())
+
+    def __delitem__(self, annotation_id: int) -> None:
+        self.store.remove_rows([self.store.row_of(annotation_id)])
+
+    def __contains__(self, annotation_id) -> bool:
+        return self.store.contains(annotation_id)
+
+    def __iter__(self):
+        return (int(annotation_id) for annotation_id in self.store.annotation_ids)
+
+    def __len__(self):
+        return len(self.store)
+
+class AnnotationImageMapping(MutableMapping):
+    """
+    `annotation_id -> image_id` view over an `AnnotationStore`. Setting the
+    image of an id without annotation keeps it in `new_annotations` until the
+    annotation itself is assigned in `AnnotationMapping`.
+    """
+    def __init__(self, store: AnnotationStore):
+        self.store = store
+        self.new_annotations: dict[int, int] = {}
+
+    def __getitem__(self, annotation_id: int) -> int:
+        if annotation_id in self.new_annotations:
+            return self.new_annotations[annotation_id]
+        return int(self.store.image_ids[self.store.row_of(annotation_id)])
+
+    def __setitem__(self, annotation_id: int, image_id: int) -> None:
+        if self.store.contains(annotation_id):
+            self.store.set_image_id(self.store.row_of(annotation_id), image_id)
+        else:
+            self.new_annotations[int(annotation_id)] = int(image_id)
+
+    def __delitem__(self, annotation_id: int) -> None:
+        if self.new_annotations.pop(annotation_id, None) is None:
+            self.store.remove_rows([self.store.row_of(annotation_id)])
+
+    def __contains__(self, annotation_id) -> bool:
+        return self.store.contains(annotation_id)
+
+    def __iter__(self):
+        return (int(annotation_id) for annotation_id in self.store.annotation_ids)
+
+    def __len__(self):
+        return len(self.store)
+
+class ImageAnnotationsMapping(Mapping):
+    """
+    Read-only `image_id -> [annotation_id, ...]` view. Every image of the
+    dataset is a key, including images without annotations.
+    """
+    def __init__(self, store: AnnotationStore, image_id2image_name: dict[int, str]):
+        self.store = store
+        self.image_id2image_name = image_id2image_name
+
+    def __getitem__(self, image_id: int) -> list[int]:
+        if image_id not in self.image_id2image_name:
+            raise KeyError(image_id)
+        return self.store.annotation_ids[self.store.rows_for_image(image_id)].tolist()
+
+    def __contains__(self, image_id) -> bool:
+        return image_id in self.image_id2image_name
+
+    def __iter__(self):
+        return iter(self.image_id2image_name)
+
+    def __len__(self):
+        return len(self.image_id2image_name)
+
 class Dataset:
     """
     TODO: Add documentation
@@ -85,13 +304,52 @@ class Dataset:
         self.image_id2image_info: dict[int, ImageInfo] = {}
 
         self.image_id2image_name: dict[int, str] = image_id2image_name
-        self.image_path2image_id: dict[str, int] = {v: k for k, v in image_id2image_name.items()}
+        self._image_path2image_id: dict[str, int] = None
         self.image_id2image_dimensions: dict[int, tuple[int, int]] = image_id2image_dimensions
-        self.annotation_id2image_id: dict[int, int] = annotation_id2image_id
-        self.image_id2annotation_ids: dict[int, list[int]] = {image_id: [] for image_id in image_id2image_name.keys()}
-        for annotation_id, image_id in annotation_id2image_id.items():
-            self.image_id2annotation_ids[image_id].append(annotation_id)
-        self.annotation_id2annotation: dict[int, list[Annotation]] = annotation_id2annotation
+        self.statistics = DatasetStatistics(self)
+        self.image_cache = ImageCache()
+        self.histograms = HistogramEngine(self)
+        self.masks = MaskEngine(self)
+        self.journal = EditJournal(self)
+        # Boxes applied to images as they are read by `get_image` and
+        # `iter_images`, used by journal previews.
+        self.read_crop_boxes: dict[int, tuple[int, int, int, int]] = {}
+        self._spatial_index: SpatialIndex = None
+        self._image_hash_store: ImageHashStore = None
+        self._image_prefetcher: ImagePrefetcher = None
+
+        builder = AnnotationStoreBuilder()
+        for annotation_id, annotation in annotation_id2annotation.items():
+            add_annotation_to_builder(builder, annotation_id, annotation_id2image_id[annotation_id], annotation)
+        self._attach_annotation_store(builder.build())
+
+    @classmethod
+    def from_annotation_store(cls,
+                id2class: dict[int, str],
+                data_path: str,
+                image_id2image_name: dict[int, str],
+                image_id2image_dimensions: dict[int, tuple[int, int]],
+                annotation_store: AnnotationStore
+                ) -> "Dataset":
+        """
+        Builds a dataset directly on top of an `AnnotationStore`, without going
+        through one dataclass per annotation.
+        """
+        dataset = cls(id2class, data_path, image_id2image_name, image_id2image_dimensions, {}, {})
+        dataset._attach_annotation_store(annotation_store)
+        return dataset
+
+    @property
+    def image_path2image_id(self) -> dict[str, int]:
+        if self._image_path2image_id is None:
+            self._image_path2image_id = {v: k for k, v in self.image_id2image_name.items()}
+        return self._image_path2image_id
+
+    def _attach_annotation_store(self, annotation_store: AnnotationStore) -> None:
+        self.annotation_store = annotation_store
+        self.annotation_id2image_id: MutableMapping[int, int] = AnnotationImageMapping(annotation_store)
+        self.annotation_id2annotation: MutableMapping[int, Annotation] = AnnotationMapping(annotation_store, self.annotation_id2image_id)
+        self.image_id2annotation_ids: Mapping[int, list[int]] = ImageAnnotationsMapping(annotation_store, self.image_id2image_name)
 
     def __len__(self):
         """
@@ -103,7 +361,7 @@ class Dataset:
         """
         TODO: Add documentation
         """
-        return np.array(Image.open(os.path.join(self.data_path, self.image_id2image_name[image_id])))
+        return self.get_image(image_id)
     
     def __iter__(self):
         """
@@ -112,232 +370,306 @@ class Dataset:
         return iter(self.image_id2image_name.keys())
     
     def get_image(self, image_id: int):
-        return np.array(
-            Image.open(
-                os.path.join(self.data_path, self.image_id2image_name[image_id])
-            )
-        )
+        """
+        Returns the decoded image, through the dataset image cache. The
+        returned array is shared with the cache and read-only.
+        """
+        return self.image_cache.get(image_id, lambda: self._read_image(image_id))
+
+    def _read_image(self, image_id: int) -> np.ndarray:
+        image = Image.open(os.path.join(self.data_path, self.image_id2image_name[image_id]))
+        if image_id in self.read_crop_boxes:
+            image = image.crop(self.read_crop_boxes[image_id])
+        return np.array(image)
+
+    def iter_images(self,
+                image_ids: Iterable[int] = None,
+                batch_size: int = 32,
+                workers: int = None,
+                max_side: int = None,
+                mode: str = 'RGB'
+                ) -> Iterator[ImageBatch]:
+        """
+        Decodes images in parallel worker processes and yields them as stacked
+        `ImageBatch`es in shared memory. With `max_side`, images are decoded at
+        reduced resolution (JPEG draft mode) and fit in `max_side` x `max_side`.
+        Images with a box in `read_crop_boxes` are cropped to it.
+        """
+        if image_ids is None:
+            image_ids = self.image_id2image_name.keys()
+        image_ids = list(image_ids)
+        image_paths = [os.path.join(self.data_path, self.image_id2image_name[image_id]) for image_id in image_ids]
+        boxes = [self.read_crop_boxes.get(image_id) for image_id in image_ids] if self.read_crop_boxes else None
+        return iter_image_batches(image_paths, image_ids, batch_size, workers, max_side, mode, boxes)
+
+    @property
+    def image_hash_store(self) -> ImageHashStore:
+        """
+        Hashes of the images, persisted in a sidecar file next to the data
+        directory (see `image_hashes.hash_store_path_for`).
+        """
+        if self._image_hash_store is None:
+            self._image_hash_store = ImageHashStore(hash_store_path_for(self.data_path))
+        return self._image_hash_store
+
+    @image_hash_store.setter
+    def image_hash_store(self, store: ImageHashStore) -> None:
+        self._image_hash_store = store
+
+    @property
+    def image_prefetcher(self) -> ImagePrefetcher:
+        if self._image_prefetcher is None:
+            self._image_prefetcher = ImagePrefetcher(self.image_cache, self._read_image)
+        return self._image_prefetcher
+
+    def prefetch_images(self, image_ids: Iterable[int]) -> None:
+        """
+        Decodes the given images into the image cache in background threads.
+        """
+        self.image_prefetcher.prefetch(image_ids)
+
+    @property
+    def spatial_index(self) -> SpatialIndex:
+        """
+        Grid index over the annotation bboxes, rebuilt when the annotations change.
+        """
+        if self._spatial_index is None or not self._spatial_index.is_current(self.annotation_store):
+            self._spatial_index = SpatialIndex(self.annotation_store)
+        return self._spatial_index
+
+    def annotations_at(self, image_id: int, x: float, y: float) -> list[int]:
+        """
+        Ids of the annotations under a point of an image, smallest first.
+        """
+        return self.annotation_store.annotation_ids[self.spatial_index.pick(image_id, x, y)].tolist()
+
+    def annotations_in_rect(self, image_id: int, left: float, top: float, right: float, bottom: float) -> list[int]:
+        return self.annotation_store.annotation_ids[self.spatial_index.query_rect(image_id, left, top, right, bottom)].tolist()
 
     def get_annotation(self, annotation_id: int):
         return self.annotation_id2annotation[annotation_id]
 
+    def add_annotation(self, image_id: int, annotation: Annotation, annotation_id: int = None) -> int:
+        """
+        Adds an annotation to an image and returns its id. A new id is
+        generated when `annotation_id` is not given.
+        """
+        if annotation_id is None:
+            annotation_id = int(self.annotation_store.annotation_ids.max()) + 1 if len(self.annotation_store) > 0 else 0
+        elif annotation_id in self.annotation_id2annotation:
+            raise ValueError(f"Annotation {annotation_id} already exists")
+
+        builder = AnnotationStoreBuilder()
+        add_annotation_to_builder(builder, annotation_id, image_id, annotation)
+        self.annotation_store.extend(builder.build())
+        return annotation_id
+
+    def edit_annotation(self, annotation_id: int, annotation: Annotation) -> None:
+        """
+        Records new content for an annotation in the edit journal. Unlike
+        assigning to `annotation_id2annotation`, nothing changes until
+        `journal.commit()`.
+        """
+        builder = AnnotationStoreBuilder()
+        add_annotation_to_builder(builder, annotation_id, self.annotation_id2image_id[annotation_id], annotation)
+        self.journal.replace_annotations(builder.build())
+
+    def open_journal(self, path: str) -> EditJournal:
+        """
+        Keeps the edit journal in a file from now on, bringing back the edits
+        recorded there and not committed yet.
+        """
+        if len(self.journal) > 0:
+            raise RuntimeError("The current journal has edits that are not committed")
+        self.journal = EditJournal(self, path)
+        return self.journal
+
     def check_missing_images(self) -> list[int]:
+        existing = list_existing_files(self.data_path, self.image_id2image_name.values())
         missing_images_ids = []
         for image_id, image_name in self.image_id2image_name.items():
-            if not os.path.exists(os.path.join(self.data_path, image_name)):
+            if image_name not in existing:
                 missing_images_ids.append(image_id)
 
         return missing_images_ids
+
+    def validate(self,
+                checks: Iterable[str] = ALL_CHECKS,
+                workers: int = None,
+                progress_path: str = None
+                ) -> Iterator[ValidationIssue]:
+        """
+        Runs the dataset checks in one pass (see `validation.ALL_CHECKS`) and
+        yields the issues as they are found. Checks that open the images run
+        in worker processes. With `progress_path`, an interrupted run resumes
+        where it stopped.
+        """
+        return DatasetValidator(self, checks, workers, progress_path=progress_path).run()
     
-    def check_annotations_without_image(self) -> list[int]:
-        annotations_without_image = []
-        for annotation_id, image_id in self.annotation_id2image_id.items():
-            if image_id not in self.image_id2image_name:
-                annotations_without_image.append(annotation_id)
+    def check_duplicate_images(self, max_distance: int = 4, splits: Mapping[str, Iterable[int]] = None, workers: int = None) -> DuplicateReport:
+        """
+        Finds exact duplicate files and near-duplicate images (perceptual
+        hashes within `max_distance` bits). With `splits`, e.g.
+        `{'train': train_ids, 'val': val_ids}`, also reports the duplicates
+        that leak across splits. Hashes are kept in `image_hash_store` and
+        saved next to the data, so re-runs only hash new or changed images.
+        """
+        return DuplicateImageFinder(self, self.image_hash_store, workers).find(max_distance, splits)
 
-        return annotations_without_image
+    def check_annotations_without_image(self) -> list[int]:
+        image_ids = np.fromiter(self.image_id2image_name.keys(), dtype=np.int64, count=len(self.image_id2image_name))
+        without_image = ~np.isin(self.annotation_store.image_ids, image_ids)
+        return self.annotation_store.annotation_ids[without_image].tolist()
 
     def check_not_used_images(self):
-        not_used_images_ids = []
-        for image_id, annotations_ids in self.image_id2annotation_ids.items():
-            if len(annotations_ids) == 0:
-                not_used_images_ids.append(image_id)
-
-        return not_used_images_ids
+        annotated_image_ids = set(self.annotation_store.annotated_image_ids().tolist())
+        return [image_id for image_id in self.image_id2image_name.keys() if image_id not in annotated_image_ids]
     
+    def check_duplicate_annotations(self, iou_threshold: float = 0.9, same_class: bool = True, use_segmentation: bool = False) -> list[tuple[int, int]]:
+        """
+        Pairs of annotation ids of the same image whose IoU is at least
+        `iou_threshold`. Only pairs with intersecting bboxes are compared.
+        """
+        store = self.annotation_store
+        rows_a, rows_b, ious = self.spatial_index.overlaps(use_segmentation=use_segmentation)
+        duplicated = ious >= iou_threshold
+        if same_class:
+            duplicated &= store.class_ids[rows_a] == store.class_ids[rows_b]
+        return list(zip(store.annotation_ids[rows_a[duplicated]].tolist(), store.annotation_ids[rows_b[duplicated]].tolist()))
+
     def remove_image(self, image_id: int):
+        """
+        Removes an image, its file and its annotations immediately. Use
+        `journal.remove_images` to stage removals until `journal.commit()`.
+        """
         image_name = self.image_id2image_name[image_id]
         os.remove(os.path.join(self.data_path, image_name))
 
         self.image_id2image_name.pop(image_id)
         self.image_id2image_dimensions.pop(image_id)
+        if self._image_path2image_id is not None:
+            self._image_path2image_id.pop(image_name, None)
 
-        for annotation_id in self.image_id2annotation_ids[image_id]:
-            self.annotation_id2annotation.pop(annotation_id)
-            self.annotation_id2image_id.pop(annotation_id)
-
-        self.image_id2annotation_ids.pop(image_id)
+        self.annotation_store.remove_rows(self.annotation_store.rows_for_image(image_id))
+        self.statistics.invalidate()
+        self.image_cache.invalidate(image_id)
+        self.histograms.discard_image(image_id, image_name)
 
     def count_classe_instances(self):
         """
         TODO: Add documentation
         """
-        class_instances = {class_id: 0 for class_id in self.id2class.keys()}
-        for annotation in self.annotation_id2annotation.values():
-            class_instances[annotation.class_id] += 1
-        return class_instances
+        return dict(self.statistics.class_counts())
 
-    def split_dataset(self, train_ratio: float, val_ratio: float, test_ratio: float):
+    def view(self) -> DatasetView:
         """
-        TODO: Add documentation
+        A `DatasetView` of every image, the starting point of the filter API.
+        """
+        image_ids = np.sort(np.fromiter(self.image_id2image_name.keys(), dtype=np.int64, count=len(self.image_id2image_name)))
+        return DatasetView(self, image_ids)
+
+    def split_dataset(self,
+                train_ratio: float,
+                val_ratio: float,
+                test_ratio: float,
+                seed: int = 0,
+                stratify: bool = False,
+                groups: Union[Mapping[int, Hashable], Callable[[str], Hashable]] = None
+                ) -> tuple[DatasetView, DatasetView, DatasetView]:
         """
-        if train_ratio + val_ratio + test_ratio != 1:
+        Splits the images into train, validation and test views. The split is
+        reproducible for a given `seed`. With `stratify`, every split gets
+        about the same class distribution (iterative multi-label
+        stratification over the classes present in each image). With
+        `groups`, an `image_id -> key` mapping or a function of the image name,
+        images with the same key stay in the same split.
+
+        The views share the parent annotations; call `materialize()` on a view
+        to get an independent `Dataset`.
+        """
+        if not math.isclose(train_ratio + val_ratio + test_ratio, 1):
             raise ValueError("The sum of the ratios must be 1")
 
-        image_ids = self.image_id2image_name.keys()
-        random.shuffle(image_ids)
-
-        train_image_ids = image_ids[: int(len(image_ids) * train_ratio)]
-        val_image_ids = image_ids[int(len(image_ids) * train_ratio) : int(len(image_ids) * val_ratio)]
-        test_image_ids = image_ids[int(len(image_ids) * (train_ratio + val_ratio)) :]
-
-        train_image_id2image_name = {}
-        train_image_id2image_dimensions = {}
-        train_annotation_id2image_id = {}
-        train_annotation_id2annotation = {}
-        for image_id in train_image_ids:
-            train_image_id2image_name.update({
-                image_id: self.image_id2image_name[image_id]
-            })
-            train_image_id2image_dimensions.update({
-                image_id: self.image_id2image_dimensions[image_id]
-            })
-            for annotation_id in self.image_id2annotation_ids[image_id]:
-                train_annotation_id2image_id.update({
-                    annotation_id: image_id
-                })
-                train_annotation_id2annotation.update({
-                    annotation_id: self.annotation_id2annotation[annotation_id]
-                })
-
-        val_image_id2image_name = {}
-        val_image_id2image_dimensions = {}
-        val_annotation_id2image_id = {}
-        val_annotation_id2annotation = {}
-        for image_id in val_image_ids:
-            val_image_id2image_name.update({
-                image_id: self.image_id2image_name[image_id]
-            })
-            val_image_id2image_dimensions.update({
-                image_id: self.image_id2image_dimensions[image_id]
-            })
-            for annotation_id in self.image_id2annotation_ids[image_id]:
-                val_annotation_id2image_id.update({
-                    annotation_id: image_id
-                })
-                val_annotation_id2annotation.update({
-                    annotation_id: self.annotation_id2annotation[annotation_id]
-                })
-
-        test_image_id2image_name = {}
-        test_image_id2image_dimensions = {}
-        test_annotation_id2image_id = {}
-        test_annotation_id2annotation = {}
-        for image_id in test_image_ids:
-            test_image_id2image_name.update({
-                image_id: self.image_id2image_name[image_id]
-            })
-            test_image_id2image_dimensions.update({
-                image_id: self.image_id2image_dimensions[image_id]
-            })
-            for annotation_id in self.image_id2annotation_ids[image_id]:
-                test_annotation_id2image_id.update({
-                    annotation_id: image_id
-                })
-                test_annotation_id2annotation.update({
-                    annotation_id: self.annotation_id2annotation[annotation_id]
-                })
-
-        train_ds = Dataset(
-            id2class = self.id2class,
-            data_path = self.data_path,
-            image_id2image_name = train_image_id2image_name,
-            image_id2image_dimensions = train_image_id2image_name,
-            annotation_id2image_id = train_annotation_id2image_id,
-            annotation_id2annotation = train_annotation_id2annotation
-        )
-        val_ds = Dataset(
-            id2class = self.id2class,
-            data_path = self.data_path,
-            image_id2image_name = val_image_id2image_name,
-            image_id2image_dimensions = val_image_id2image_name,
-            annotation_id2image_id = val_annotation_id2image_id,
-            annotation_id2annotation = val_annotation_id2annotation
-        )
-        test_ds = Dataset(
-            id2class = self.id2class,
-            data_path = self.data_path,
-            image_id2image_name = test_image_id2image_name,
-            image_id2image_dimensions = test_image_id2image_dimensions,
-            annotation_id2image_id = test_annotation_id2image_id,
-            annotation_id2annotation = test_annotation_id2annotation
+        image_ids = np.fromiter(self.image_id2image_name.keys(), dtype=np.int64, count=len(self.image_id2image_name))
+        train_image_ids, val_image_ids, test_image_ids = split_image_ids(
+            image_ids,
+            [train_ratio, val_ratio, test_ratio],
+            seed = seed,
+            store = self.annotation_store if stratify else None,
+            image_id2image_name = self.image_id2image_name,
+            groups = groups
         )
 
+        train_ds = DatasetView(self, train_image_ids)
+        val_ds = DatasetView(self, val_image_ids)
+        test_ds = DatasetView(self, test_image_ids)
+
         return train_ds, val_ds, test_ds
 
-    def copy_dataset(self, destination_path: str):
+    def copy_dataset(self, destination_path: str, mode: str = 'copy', workers: int = None, progress: Callable[[int, int], None] = None) -> "Dataset":
         """
-        TODO: Add documentation
+        Copies the dataset to `destination_path` and returns the copy. Image
+        files are copied, reflinked, hardlinked or symlinked as set by `mode`
+        in a thread pool, and files already there are skipped, so an
+        interrupted copy can be resumed. The annotations are written next to
+        the images and memory-mapped copy-on-write by the returned dataset,
+        which shares nothing mutable with this one. `DatasetMaterializer`
+        also reports the images that could not be copied.
         """
-        if not os.path.exists(destination_path):
-            os.makedirs(destination_path)
+        # Imported here since the snapshot module depends on this one.
+        from materialize import DatasetMaterializer
 
-        shutil.copy(self.data_path, destination_path)
-
-        return Dataset(
-            self.id2class,
-            destination_path,
-            self.image_id2image_name,
-            self.image_id2image_dimensions,
-            self.annotation_id2image_id,
-            self.annotation_id2annotation
-        )
+        copy, _ = DatasetMaterializer(self, destination_path, mode, workers, progress=progress).run()
+        return copy
 
     def crop_single_image(self, image_id: str, left: int, top: int, right: int, bottom: int):
         """
-        TODO: Add documentation
+        Crops one image in place and updates its annotations and dimensions.
+        Annotations left outside the crop box are removed.
         """
-        image = Image.open(os.path.join(self.data_path, self.image_id2image_name[image_id]))
+        image_path = os.path.join(self.data_path, self.image_id2image_name[image_id])
+        image = Image.open(image_path)
+        image_format = image.format
         image = image.crop((left, top, right, bottom))
-        image.save(os.path.join(self.data_path, self.image_id2image_name[image_id]))
-
-        self.image_id2image_dimensions[image_id] = (bottom - top, right - left)
-
-        for annotation_id in self.image_id2annotation_ids[image_id]:
-            annotation = self.annotation_id2annotation[annotation_id]
-
-            annotation.x -= left
-            annotation.y -= top
-
-            if isinstance(annotation, SegmentationAnnotation):
-                for point in annotation.points:
-                    point.x -= left
-                    point.y -= top
-
-    def crop_multiple_images(self, left: int, top: int, right: int, bottom: int):
+        # Replacing the file rather than writing into it keeps hardlinked
+        # copies of the dataset unchanged.
+        image.save(image_path + '.tmp', format=image_format)
+        os.replace(image_path + '.tmp', image_path)
+
+        self.image_id2image_dimensions[image_id] = (right - left, bottom - top)
+
+        emptied = crop_annotations(self.annotation_store, CropPlan(np.array([image_id], dtype=np.int64), np.array([[left, top, right, bottom]], dtype=np.int64)))
+        self.annotation_store.remove_rows(emptied)
+        self.statistics.invalidate()
+        self.image_cache.invalidate(image_id)
+        self.histograms.update_image(image_id, np.asarray(image.convert('RGB')))
+
+    def _apply_crop_plan(self, plan: CropPlan, output_path: str, workers: int = None, dry_run: bool = False) -> "Dataset":
+        if os.path.abspath(output_path) == os.path.abspath(self.data_path):
+            raise ValueError("The cropped images must be written to a new directory; crop in place with `journal.crop_images` and `journal.commit`")
+        cropper = BatchCropper(self, output_path, workers)
+        cropped = cropper.run(plan, dry_run)
+        if cropper.failed:
+            raise OSError(f"{len(cropper.failed)} images could not be cropped, e.g. {self.image_id2image_name[cropper.failed[0]]}; call again to resume, or use `BatchCropper.run` for the dataset without them")
+        return cropped
+
+    def crop_multiple_images(self, left: int, top: int, right: int, bottom: int, output_path: str, workers: int = None, dry_run: bool = False) -> "Dataset":
         """
-        TODO: Add documentation
+        Crops every image to the same box, clipped to each image, in a process
+        pool. The cropped images are written to `output_path`, which must not
+        be the dataset directory, and a new dataset over them is returned. An
+        interrupted run can be resumed by calling it again with the same
+        arguments. With `dry_run`, returns the resulting dataset without
+        touching any file. Raises a `ValueError` when the box leaves nothing
+        of some image, and an `OSError` when some images could not be
+        cropped; the other ones are kept in `output_path` and calling again
+        only retries the failed ones.
         """
-        for image_id in self.image_id2image_name.keys():
-            self.crop_single_image(image_id, left, top, right, bottom)
+        return self._apply_crop_plan(plan_fixed_crop(self, left, top, right, bottom), output_path, workers, dry_run)
 
-    def crop_images_by_annotations(self, margin: int):
+    def crop_images_by_annotations(self, margin: int, output_path: str, workers: int = None, dry_run: bool = False) -> "Dataset":
         """
-        TODO: Add documentation
+        Crops every annotated image to the box around its annotations grown by
+        `margin`. See `crop_multiple_images` for the other arguments.
         """
-        for image_id in self.image_id2image_name.keys():
-            x_values = []
-            y_values = []
-            for annotation_id in self.image_id2annotation_ids[image_id]:
-                annotation = self.annotation_id2annotation[annotation_id]
-                x_values.append(annotation.x)
-                x_values.append(annotation.x + annotation.width)
-                y_values.append(annotation.y)
-                y_values.append(annotation.y + annotation.height)
-
-            if len(x_values) == 0 or len(y_values) == 0:
-                continue
-            
-            x_min = min(x_values) - margin
-            x_min = max(x_min, 0)
-
-            x_max = max(x_values) + margin
-            x_max = min(x_max, self.image_id2image_dimensions[image_id][0])
-
-            y_min = min(y_values) - margin
-            y_min = max(y_min, 0)
-
-            y_max = max(y_values) + margin
-            y_max = min(y_max, self.image_id2image_dimensions[image_id][1])
-
-            self.crop_single_image(image_id, x_min, y_min, x_max, y_max)    
\ No newline at end of file
+        return self._apply_crop_plan(plan_annotation_crop(self, margin), output_path, workers, dry_run)
\ No newline at end of file
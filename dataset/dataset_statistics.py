@@ -0,0 +1,157 @@
+from typing import Callable
+
+import numpy as np
+
+from annotation_store import AnnotationStore
+
+class DatasetStatistics:
+    """
+    Dataset-wide statistics computed with batched NumPy passes over the
+    annotation columns. Results are cached until the dataset changes: the cache
+    is keyed on the annotation store version and the number of images, and
+    `Dataset` also clears it explicitly on `remove_image` and crops.
+    """
+    COOCCURRENCE_CHUNK_SIZE = 65536
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self._cache: dict[str, object] = {}
+        self._cache_key = None
+
+    @property
+    def store(self) -> AnnotationStore:
+        return self.dataset.annotation_store
+
+    def invalidate(self) -> None:
+        self._cache.clear()
+        self._cache_key = None
+
+    def _cached(self, name: str, compute: Callable[[], object]):
+        key = (id(self.store), self.store.version, len(self.dataset.image_id2image_name))
+        if key != self._cache_key:
+            self._cache.clear()
+            self._cache_key = key
+        if name not in self._cache:
+            self._cache[name] = compute()
+        return self._cache[name]
+
+    def _image_ids(self) -> np.ndarray:
+        image_id2image_name = self.dataset.image_id2image_name
+        return np.fromiter(image_id2image_name.keys(), dtype=np.int64, count=len(image_id2image_name))
+
+    def class_ids(self) -> np.ndarray:
+        """
+        Sorted ids of every class, including ids used by annotations but missing from `id2class`.
+        """
+        def compute():
+            known = np.fromiter(self.dataset.id2class.keys(), dtype=np.int64, count=len(self.dataset.id2class))
+            return np.union1d(known, self.store.class_ids)
+        return self._cached('class_ids', compute)
+
+    def class_counts(self) -> dict[int, int]:
+        """
+        Number of annotations of each class.
+        """
+        def compute():
+            class_ids = self.class_ids()
+            counts = np.bincount(np.searchsorted(class_ids, self.store.class_ids), minlength=len(class_ids))
+            return dict(zip(class_ids.tolist(), counts.tolist()))
+        return self._cached('class_counts', compute)
+
+    def image_annotation_counts(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns `(image_ids, counts)` with the number of annotations of every image,
+        including images without annotations.
+        """
+        def compute():
+            image_ids = np.sort(self._image_ids())
+            counts = np.zeros(len(image_ids), dtype=np.int64)
+            if len(image_ids) > 0:
+                annotation_image_ids = self.store.image_ids[np.isin(self.store.image_ids, image_ids)]
+                counts = np.bincount(np.searchsorted(image_ids, annotation_image_ids), minlength=len(image_ids))
+            return image_ids, counts
+        return self._cached('image_annotation_counts', compute)
+
+    def bbox_columns(self) -> dict[str, np.ndarray]:
+        """
+        Per-annotation bbox width, height, aspect ratio (width / height) and area.
+        """
+        def compute():
+            widths = self.store.bboxes[:, 2]
+            heights = self.store.bboxes[:, 3]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                aspects = np.where(heights > 0, widths / heights, np.nan)
+            return {
+                'width': widths,
+                'height': heights,
+                'aspect': aspects,
+                'area': self.store.areas
+            }
+        return self._cached('bbox_columns', compute)
+
+    def bbox_histograms(self, bins: int = 50) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+        """
+        Histograms of bbox width, height, aspect ratio and area, as `(counts, bin_edges)`.
+        """
+        def compute():
+            histograms = {}
+            for name, values in self.bbox_columns().items():
+                values = values[np.isfinite(values)]
+                histograms[name] = np.histogram(values, bins=bins)
+            return histograms
+        return self._cached(f'bbox_histograms_{bins}', compute)
+
+    def class_cooccurrence(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns `(class_ids, matrix)` where `matrix[i, j]` is the number of images that
+        contain both classes `class_ids[i]` and `class_ids[j]`. The diagonal holds the
+        number of images containing each class.
+        """
+        def compute():
+            image_ids = np.sort(self._image_ids())
+            class_ids = self.class_ids()
+            in_dataset = np.isin(self.store.image_ids, image_ids)
+            image_index = np.searchsorted(image_ids, self.store.image_ids[in_dataset])
+            class_index = np.searchsorted(class_ids, self.store.class_ids[in_dataset])
+            pairs = np.unique(image_index * len(class_ids) + class_index)
+            pair_images = pairs // len(class_ids)
+            pair_classes = pairs % len(class_ids)
+
+            matrix = np.zeros((len(class_ids), len(class_ids)), dtype=np.int64)
+            for start in range(0, len(image_ids), self.COOCCURRENCE_CHUNK_SIZE):
+                end = start + self.COOCCURRENCE_CHUNK_SIZE
+                first, last = np.searchsorted(pair_images, [start, end])
+                presence = np.zeros((min(end, len(image_ids)) - start, len(class_ids)), dtype=np.float32)
+                presence[pair_images[first:last] - start, pair_classes[first:last]] = 1
+                matrix += np.rint(presence.T @ presence).astype(np.int64)
+            return class_ids, matrix
+        return self._cached('class_cooccurrence', compute)
+
+    def overlaps(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        `(rows_a, rows_b, bbox_ious)` of every pair of annotations of the same
+        image whose bboxes intersect.
+        """
+        return self._cached('overlaps', lambda: self.dataset.spatial_index.overlaps())
+
+    def overlap_histogram(self, bins: int = 20) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Histogram of the bbox IoU of overlapping annotation pairs, as `(counts, bin_edges)`.
+        """
+        return self._cached(f'overlap_histogram_{bins}', lambda: np.histogram(self.overlaps()[2], bins=bins, range=(0, 1)))
+
+    def class_overlap_counts(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns `(class_ids, matrix)` where `matrix[i, j]` is the number of
+        overlapping annotation pairs between classes `class_ids[i]` and `class_ids[j]`.
+        """
+        def compute():
+            class_ids = self.class_ids()
+            rows_a, rows_b, _ = self.overlaps()
+            index_a = np.searchsorted(class_ids, self.store.class_ids[rows_a])
+            index_b = np.searchsorted(class_ids, self.store.class_ids[rows_b])
+            matrix = np.zeros((len(class_ids), len(class_ids)), dtype=np.int64)
+            np.add.at(matrix, (np.minimum(index_a, index_b), np.maximum(index_a, index_b)), 1)
+            matrix = matrix + np.triu(matrix, 1).T
+            return class_ids, matrix
+        return self._cached('class_overlap_counts', compute)
@@ -0,0 +1,207 @@
+import re
+import fnmatch
+from collections.abc import Callable, Mapping
+from typing import Iterable, Iterator, Optional, Union
+
+import numpy as np
+
+class SubsetMapping(Mapping):
+    """
+    Read-only `image_id -> value` mapping restricted to a sorted array of image ids.
+    """
+    def __init__(self, mapping: Mapping, image_ids: np.ndarray):
+        self.mapping = mapping
+        self.image_ids = image_ids
+
+    def __getitem__(self, image_id):
+        position = np.searchsorted(self.image_ids, image_id)
+        if position >= len(self.image_ids) or self.image_ids[position] != image_id:
+            raise KeyError(image_id)
+        return self.mapping[image_id]
+
+    def __iter__(self):
+        return iter(self.image_ids.tolist())
+
+    def __len__(self):
+        return len(self.image_ids)
+
+class DatasetView:
+    """
+    Read-only view over a subset of a `Dataset`: a sorted array of image ids
+    and, optionally, a sorted array of the rows of the parent annotation store
+    that are selected. Nothing is copied; filters build new views with
+    vectorized masks over the parent columns and can be chained, e.g.
+    `dataset.view().filter_by_classes(['car']).filter_by_annotation_count(3)`.
+    Use `materialize` to get an independent `Dataset`.
+    """
+    def __init__(self, dataset, image_ids: np.ndarray, annotation_rows: Optional[np.ndarray] = None):
+        self.dataset = dataset
+        self.image_ids = image_ids
+        self._selected_rows = annotation_rows
+        self._selected_rows_key = (id(dataset.annotation_store), dataset.annotation_store.version)
+        self._annotation_rows = None
+        self._annotation_rows_key = None
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.image_ids.tolist())
+
+    def __contains__(self, image_id) -> bool:
+        position = np.searchsorted(self.image_ids, image_id)
+        return position < len(self.image_ids) and self.image_ids[position] == image_id
+
+    def __getitem__(self, image_id: int):
+        if image_id not in self:
+            raise KeyError(image_id)
+        return self.dataset.get_image(image_id)
+
+    def __repr__(self):
+        return f"DatasetView({len(self)} images of {self.dataset.data_path!r})"
+
+    @property
+    def data_path(self) -> str:
+        return self.dataset.data_path
+
+    @property
+    def image_id2image_name(self) -> Mapping[int, str]:
+        return SubsetMapping(self.dataset.image_id2image_name, self.image_ids)
+
+    @property
+    def image_id2image_dimensions(self) -> Mapping[int, tuple[int, int]]:
+        return SubsetMapping(self.dataset.image_id2image_dimensions, self.image_ids)
+
+    @property
+    def annotation_rows(self) -> np.ndarray:
+        """
+        Sorted rows of the parent annotation store selected by the view.
+        """
+        store = self.dataset.annotation_store
+        key = (id(store), store.version)
+        if self._selected_rows is not None:
+            # Rows selected by a filter are positions in the store they were computed on.
+            if self._selected_rows_key != key:
+                raise RuntimeError("The annotations of the dataset changed since this view was filtered")
+            return self._selected_rows
+        if self._annotation_rows_key != key:
+            self._annotation_rows = np.flatnonzero(np.isin(store.image_ids, self.image_ids))
+            self._annotation_rows_key = key
+        return self._annotation_rows
+
+    @property
+    def annotation_ids(self) -> np.ndarray:
+        return self.dataset.annotation_store.annotation_ids[self.annotation_rows]
+
+    def image_annotation_counts(self) -> np.ndarray:
+        """
+        Number of selected annotations of every image of the view, in `image_ids` order.
+        """
+        image_ids = self.dataset.annotation_store.image_ids[self.annotation_rows]
+        return np.bincount(np.searchsorted(self.image_ids, image_ids), minlength=len(self.image_ids))[:len(self.image_ids)]
+
+    def _class_ids(self, classes: Iterable[Union[int, str]]) -> np.ndarray:
+        class2id = self.dataset.class2id
+        return np.array([class2id[value] if isinstance(value, str) else value for value in classes], dtype=np.int64)
+
+    def _with_annotations(self, mask: np.ndarray, drop_empty_images: bool) -> "DatasetView":
+        rows = self.annotation_rows[mask]
+        image_ids = self.image_ids
+        if drop_empty_images:
+            image_ids = image_ids[np.isin(image_ids, self.dataset.annotation_store.image_ids[rows])]
+        return DatasetView(self.dataset, image_ids, rows)
+
+    def filter_by_image_ids(self, image_ids: Iterable[int]) -> "DatasetView":
+        keep = np.isin(self.image_ids, np.fromiter(image_ids, dtype=np.int64))
+        image_ids = self.image_ids[keep]
+        rows = self.annotation_rows
+        return DatasetView(self.dataset, image_ids, rows[np.isin(self.dataset.annotation_store.image_ids[rows], image_ids)])
+
+    def filter_by_classes(self, classes: Iterable[Union[int, str]], keep_other_annotations: bool = False) -> "DatasetView":
+        """
+        Images with at least one annotation of the given classes (ids or names).
+        Annotations of other classes are dropped unless `keep_other_annotations`.
+        """
+        store = self.dataset.annotation_store
+        in_classes = np.isin(store.class_ids[self.annotation_rows], self._class_ids(classes))
+        if not keep_other_annotations:
+            return self._with_annotations(in_classes, drop_empty_images=True)
+        return self.filter_by_image_ids(store.image_ids[self.annotation_rows[in_classes]])
+
+    def filter_by_bbox_size(self,
+                min_width: float = None,
+                max_width: float = None,
+                min_height: float = None,
+                max_height: float = None,
+                drop_empty_images: bool = True
+                ) -> "DatasetView":
+        """
+        Keeps the annotations whose bbox size is within the given bounds.
+        """
+        bboxes = self.dataset.annotation_store.bboxes[self.annotation_rows]
+        mask = np.ones(len(bboxes), dtype=bool)
+        for column, low, high in ((2, min_width, max_width), (3, min_height, max_height)):
+            if low is not None:
+                mask &= bboxes[:, column] >= low
+            if high is not None:
+                mask &= bboxes[:, column] <= high
+        return self._with_annotations(mask, drop_empty_images)
+
+    def filter_by_area(self, min_area: float = None, max_area: float = None, drop_empty_images: bool = True) -> "DatasetView":
+        """
+        Keeps the annotations whose area is within the given bounds.
+        """
+        areas = self.dataset.annotation_store.areas[self.annotation_rows]
+        mask = np.ones(len(areas), dtype=bool)
+        if min_area is not None:
+            mask &= areas >= min_area
+        if max_area is not None:
+            mask &= areas <= max_area
+        return self._with_annotations(mask, drop_empty_images)
+
+    def filter_by_annotation_count(self, min_count: int = None, max_count: int = None) -> "DatasetView":
+        """
+        Keeps the images whose number of selected annotations is within the given bounds.
+        """
+        counts = self.image_annotation_counts()
+        keep = np.ones(len(self.image_ids), dtype=bool)
+        if min_count is not None:
+            keep &= counts >= min_count
+        if max_count is not None:
+            keep &= counts <= max_count
+        return self.filter_by_image_ids(self.image_ids[keep])
+
+    def filter_by_file_name(self, pattern: str) -> "DatasetView":
+        """
+        Keeps the images whose file name (relative to the data path) matches a glob pattern.
+        """
+        match = re.compile(fnmatch.translate(pattern)).match
+        image_id2image_name = self.dataset.image_id2image_name
+        keep = np.fromiter((match(image_id2image_name[image_id]) is not None for image_id in self.image_ids.tolist()), dtype=bool, count=len(self.image_ids))
+        return self.filter_by_image_ids(self.image_ids[keep])
+
+    def count_classe_instances(self) -> dict[int, int]:
+        class_ids, counts = np.unique(self.dataset.annotation_store.class_ids[self.annotation_rows], return_counts=True)
+        return dict(zip(class_ids.tolist(), counts.tolist()))
+
+    def materialize(self, data_path: str = None, mode: str = None, workers: int = None, progress: Callable[[int, int], None] = None):
+        """
+        Builds an independent `Dataset` with the images and annotations of the view.
+        With `mode`, the images of the view are also placed in `data_path` and
+        the annotations are written next to them, as by `Dataset.copy_dataset`.
+        """
+        if mode is not None:
+            # Imported here since the materialize module depends on this one.
+            from materialize import DatasetMaterializer
+
+            dataset, _ = DatasetMaterializer(self, data_path, mode, workers, progress=progress).run()
+            return dataset
+
+        image_ids = self.image_ids.tolist()
+        return type(self.dataset).from_annotation_store(
+            id2class = dict(self.dataset.id2class),
+            data_path = data_path or self.dataset.data_path,
+            image_id2image_name = {image_id: self.dataset.image_id2image_name[image_id] for image_id in image_ids},
+            image_id2image_dimensions = {image_id: self.dataset.image_id2image_dimensions[image_id] for image_id in image_ids},
+            annotation_store = self.dataset.annotation_store.take(self.annotation_rows)
+        )
@@ -0,0 +1,337 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Iterable, Optional, Union
+
+import numpy as np
+
+from annotation_store import AnnotationStore
+from crop import BatchCropper, CropPlan, crop_annotations
+from dataset_view import DatasetView
+
+@dataclass(frozen=True)
+class RemoveImages:
+    image_ids: tuple[int, ...]
+
+@dataclass(frozen=True)
+class CropImages:
+    image_ids: tuple[int, ...]
+    boxes: tuple[tuple[int, int, int, int], ...]
+
+@dataclass(frozen=True)
+class RemoveAnnotations:
+    annotation_ids: tuple[int, ...]
+
+@dataclass(frozen=True)
+class RelabelAnnotations:
+    annotation_ids: tuple[int, ...]
+    class_id: int
+
+@dataclass(frozen=True, eq=False)
+class ReplaceAnnotations:
+    # One row per replaced annotation, matched by annotation id.
+    annotations: AnnotationStore
+
+Operation = Union[RemoveImages, CropImages, RemoveAnnotations, RelabelAnnotations, ReplaceAnnotations]
+
+OPERATIONS = {
+    'remove_images': RemoveImages,
+    'crop_images': CropImages,
+    'remove_annotations': RemoveAnnotations,
+    'relabel_annotations': RelabelAnnotations,
+    'replace_annotations': ReplaceAnnotations
+}
+OPERATION_NAMES = {operation_type: name for name, operation_type in OPERATIONS.items()}
+
+def _as_tuples(value):
+    return tuple(_as_tuples(item) for item in value) if isinstance(value, list) else value
+
+def operation_record(operation: Operation) -> dict:
+    if isinstance(operation, ReplaceAnnotations):
+        return {'op': 'replace_annotations', 'columns': {name: column.tolist() for name, column in operation.annotations.columns().items()}}
+    return {'op': OPERATION_NAMES[type(operation)], **asdict(operation)}
+
+def operation_from_record(record: dict) -> Operation:
+    if record['op'] == 'replace_annotations':
+        return ReplaceAnnotations(AnnotationStore(**record['columns']))
+    return OPERATIONS[record['op']](**{name: _as_tuples(value) for name, value in record.items() if name != 'op'})
+
+@dataclass
+class PendingEdits:
+    """
+    Net effect of a list of operations on the images: the removed images and
+    annotations, and for every cropped image its crop box in the coordinates
+    of the original file and its resulting `(width, height)`.
+    """
+    removed_image_ids: set[int] = field(default_factory=set)
+    removed_annotation_ids: set[int] = field(default_factory=set)
+    crop_boxes: dict[int, tuple[int, int, int, int]] = field(default_factory=dict)
+    dimensions: dict[int, tuple[int, int]] = field(default_factory=dict)
+
+def replay_operations(dataset, operations: Iterable[Operation], store: Optional[AnnotationStore] = None) -> PendingEdits:
+    """
+    Folds `operations` over the images of `dataset`. With `store`, the
+    annotation edits are also applied to it in place, except the removals,
+    which are left to the caller so that rows are removed in one pass. The
+    annotations a crop leaves outside the image are added to the removals.
+    """
+    edits = PendingEdits()
+    for operation in operations:
+        if isinstance(operation, RemoveImages):
+            edits.removed_image_ids.update(operation.image_ids)
+            for image_id in operation.image_ids:
+                edits.crop_boxes.pop(image_id, None)
+                edits.dimensions.pop(image_id, None)
+        elif isinstance(operation, RemoveAnnotations):
+            edits.removed_annotation_ids.update(operation.annotation_ids)
+        elif isinstance(operation, CropImages):
+            image_ids, boxes = [], []
+            for image_id, (left, top, right, bottom) in sorted(zip(operation.image_ids, operation.boxes)):
+                width, height = edits.dimensions.get(image_id, dataset.image_id2image_dimensions[image_id])
+                left, top = min(max(left, 0), width), min(max(top, 0), height)
+                right, bottom = min(max(right, left), width), min(max(bottom, top), height)
+                offset_x, offset_y = edits.crop_boxes.get(image_id, (0, 0, width, height))[:2]
+                edits.crop_boxes[image_id] = (offset_x + left, offset_y + top, offset_x + right, offset_y + bottom)
+                edits.dimensions[image_id] = (right - left, bottom - top)
+                image_ids.append(image_id)
+                boxes.append((left, top, right, bottom))
+            if store is not None:
+                emptied = crop_annotations(store, CropPlan(np.array(image_ids, dtype=np.int64), np.array(boxes, dtype=np.int64).reshape(-1, 4)))
+                edits.removed_annotation_ids.update(store.annotation_ids[emptied].tolist())
+        elif store is not None and isinstance(operation, RelabelAnnotations):
+            rows = store.find_rows(operation.annotation_ids)
+            store.class_ids[rows[rows >= 0]] = operation.class_id
+            store.touch()
+        elif store is not None and isinstance(operation, ReplaceAnnotations):
+            rows = store.find_rows(operation.annotations.annotation_ids)
+            found = np.flatnonzero(rows >= 0)
+            store.assign_rows(rows[found], operation.annotations.take(found))
+    return edits
+
+def removed_rows(store: AnnotationStore, edits: PendingEdits) -> np.ndarray:
+    removed = np.isin(store.image_ids, np.fromiter(edits.removed_image_ids, dtype=np.int64, count=len(edits.removed_image_ids)))
+    removed |= np.isin(store.annotation_ids, np.fromiter(edits.removed_annotation_ids, dtype=np.int64, count=len(edits.removed_annotation_ids)))
+    return np.flatnonzero(removed)
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class EditJournal:
+    """
+    Append-only log of the edits of a dataset. Removals, crops and annotation
+    edits are only recorded, which is instant whatever the dataset size;
+    `view` and `preview` show their effect without touching the dataset, and
+    `commit` applies them all at once: the images are cropped in a process
+    pool, the removed files are deleted in a thread pool and the annotation
+    rows are removed in one pass. Until then, `undo` drops the last edit.
+
+    With `path`, every operation is appended to a JSON lines file, followed by
+    an undo or commit marker when they happen. Opening the journal again on
+    the same dataset brings back the edits that were not committed, and
+    `replay` applies the same edits to another dataset.
+    """
+    def __init__(self, dataset, path: Optional[str] = None):
+        self.dataset = dataset
+        self.path = path
+        self.operations: list[Operation] = []
+        self._edits: Optional[PendingEdits] = None
+        if path is not None and os.path.exists(path):
+            self.operations = self._read_pending(path)
+            # New records must not be appended to a line cut short.
+            with open(path, 'rb+') as file:
+                if file.seek(0, os.SEEK_END) > 0:
+                    file.seek(-1, os.SEEK_END)
+                    if file.read(1) != b'\n':
+                        file.write(b'\n')
+
+    @staticmethod
+    def _read_pending(path: str) -> list[Operation]:
+        operations = []
+        with open(path, 'r') as reader:
+            for line in reader:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interruption is skipped.
+                    continue
+                if record['op'] == 'commit':
+                    operations = []
+                elif record['op'] == 'undo':
+                    operations.pop()
+                else:
+                    operations.append(operation_from_record(record))
+        return operations
+
+    def _append(self, record: dict) -> None:
+        if self.path is not None:
+            with open(self.path, 'a') as writer:
+                writer.write(json.dumps(record) + '\n')
+
+    def __len__(self):
+        return len(self.operations)
+
+    @property
+    def edits(self) -> PendingEdits:
+        if self._edits is None:
+            self._edits = replay_operations(self.dataset, self.operations)
+        return self._edits
+
+    def record(self, operation: Operation) -> None:
+        self._append(operation_record(operation))
+        self.operations.append(operation)
+        self._edits = None
+
+    def _check_images(self, image_ids: Iterable[int]) -> tuple[int, ...]:
+        image_ids = tuple(int(image_id) for image_id in image_ids)
+        for image_id in image_ids:
+            if image_id not in self.dataset.image_id2image_name or image_id in self.edits.removed_image_ids:
+                raise KeyError(image_id)
+        return image_ids
+
+    def _check_annotations(self, annotation_ids: Iterable[int]) -> tuple[int, ...]:
+        annotation_ids = tuple(int(annotation_id) for annotation_id in annotation_ids)
+        rows = self.dataset.annotation_store.find_rows(annotation_ids)
+        if np.any(rows < 0):
+            raise KeyError(annotation_ids[int(np.argmax(rows < 0))])
+        return annotation_ids
+
+    def remove_images(self, image_ids: Iterable[int]) -> None:
+        self.record(RemoveImages(self._check_images(image_ids)))
+
+    def crop_images(self, image_ids: Iterable[int], boxes: Iterable[tuple[int, int, int, int]]) -> None:
+        """
+        Records a crop of every image to its `(left, top, right, bottom)` box,
+        in the coordinates left by the previous edits and clipped to the image.
+        Raises a `ValueError` when a box leaves nothing of its image.
+        """
+        image_ids = self._check_images(image_ids)
+        boxes = tuple(tuple(int(value) for value in box) for box in boxes)
+        if len(boxes) != len(image_ids):
+            raise ValueError("One box is needed per image")
+        for image_id, (left, top, right, bottom) in zip(image_ids, boxes):
+            width, height = self.edits.dimensions.get(image_id, self.dataset.image_id2image_dimensions[image_id])
+            if min(right, width) <= max(left, 0) or min(bottom, height) <= max(top, 0):
+                raise ValueError(f"Empty crop box for image {image_id}: {[left, top, right, bottom]}")
+        self.record(CropImages(image_ids, boxes))
+
+    def remove_annotations(self, annotation_ids: Iterable[int]) -> None:
+        self.record(RemoveAnnotations(self._check_annotations(annotation_ids)))
+
+    def relabel_annotations(self, annotation_ids: Iterable[int], class_id: int) -> None:
+        self.record(RelabelAnnotations(self._check_annotations(annotation_ids), int(class_id)))
+
+    def replace_annotations(self, annotations: AnnotationStore) -> None:
+        """
+        Records new content for existing annotations, given as store rows with
+        their annotation ids (see `Dataset.edit_annotation`).
+        """
+        self._check_annotations(annotations.annotation_ids)
+        self.record(ReplaceAnnotations(annotations))
+
+    def undo(self) -> Operation:
+        """
+        Drops the last edit that was not committed and returns it.
+        """
+        if not self.operations:
+            raise IndexError("Nothing to undo")
+        operation = self.operations.pop()
+        self._append({'op': 'undo'})
+        self._edits = None
+        return operation
+
+    def view(self) -> DatasetView:
+        """
+        View of the dataset without the removed images and annotations. Crops
+        and annotation edits are not shown; use `preview` for them.
+        """
+        store = self.dataset.annotation_store
+        edits = self.edits
+        image_ids = np.sort(np.fromiter(
+            (image_id for image_id in self.dataset.image_id2image_name.keys() if image_id not in edits.removed_image_ids),
+            dtype=np.int64
+        ))
+        keep = np.ones(len(store), dtype=bool)
+        keep[removed_rows(store, edits)] = False
+        keep &= np.isin(store.image_ids, image_ids)
+        return DatasetView(self.dataset, image_ids, np.flatnonzero(keep))
+
+    def preview(self):
+        """
+        New dataset with every edit applied to a copy of the annotations. Its
+        images are read from the original files and cropped on read by
+        `get_image` and `iter_images`. Histograms, image hashes and thumbnails
+        are computed from the files and still describe the uncropped images.
+        """
+        dataset = self.dataset
+        store = dataset.annotation_store.copy()
+        edits = replay_operations(dataset, self.operations, store)
+        store.remove_rows(removed_rows(store, edits))
+        image_ids = [image_id for image_id in dataset.image_id2image_name.keys() if image_id not in edits.removed_image_ids]
+        preview = type(dataset).from_annotation_store(
+            id2class = dict(dataset.id2class),
+            data_path = dataset.data_path,
+            image_id2image_name = {image_id: dataset.image_id2image_name[image_id] for image_id in image_ids},
+            image_id2image_dimensions = {image_id: edits.dimensions.get(image_id, dataset.image_id2image_dimensions[image_id]) for image_id in image_ids},
+            annotation_store = store
+        )
+        preview.read_crop_boxes = dict(edits.crop_boxes)
+        return preview
+
+    def commit(self, workers: Optional[int] = None) -> None:
+        """
+        Applies the recorded edits to the dataset and its files. When some
+        images cannot be cropped, an `OSError` is raised before anything else
+        is changed and the journal is kept; committing again resumes the crops
+        that were left, as it does after an interruption.
+        """
+        dataset = self.dataset
+        edits = self.edits
+        cropper = None
+        if edits.crop_boxes:
+            image_ids = np.array(sorted(edits.crop_boxes), dtype=np.int64)
+            cropper = BatchCropper(dataset, dataset.data_path, workers)
+            cropper.crop_images(CropPlan(image_ids, np.array([edits.crop_boxes[image_id] for image_id in image_ids.tolist()], dtype=np.int64)))
+            if cropper.failed:
+                raise OSError(f"{len(cropper.failed)} images could not be cropped, e.g. {dataset.image_id2image_name[cropper.failed[0]]}")
+
+        removed_names = [dataset.image_id2image_name[image_id] for image_id in edits.removed_image_ids]
+        with ThreadPoolExecutor(max_workers=workers or min(32, 4 * (os.cpu_count() or 1))) as executor:
+            list(executor.map(lambda image_name: _remove_file(os.path.join(dataset.data_path, image_name)), removed_names))
+
+        store = dataset.annotation_store
+        store.remove_rows(removed_rows(store, replay_operations(dataset, self.operations, store)))
+        for image_id, image_name in zip(edits.removed_image_ids, removed_names):
+            dataset.image_id2image_name.pop(image_id)
+            dataset.image_id2image_dimensions.pop(image_id)
+            dataset.image_cache.invalidate(image_id)
+            dataset.histograms.discard_image(image_id, image_name)
+        if dataset._image_path2image_id is not None:
+            for image_name in removed_names:
+                dataset._image_path2image_id.pop(image_name, None)
+        dataset.image_id2image_dimensions.update(edits.dimensions)
+        for image_id in edits.crop_boxes:
+            dataset.image_cache.invalidate(image_id)
+            dataset.histograms.discard_image(image_id, dataset.image_id2image_name[image_id])
+        dataset.statistics.invalidate()
+
+        self._append({'op': 'commit'})
+        if cropper is not None:
+            # The progress file outlives the crops until the commit marker is
+            # written, so a commit interrupted in between skips them.
+            cropper.finish()
+        self.operations = []
+        self._edits = None
+
+    def replay(self, dataset) -> "EditJournal":
+        """
+        A journal of `dataset` with the same pending edits, e.g. to apply to a
+        full dataset the edits tried on a copy of it.
+        """
+        journal = EditJournal(dataset)
+        for operation in self.operations:
+            journal.record(operation)
+        return journal
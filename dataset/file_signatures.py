@@ -0,0 +1,11 @@
+import os
+
+def file_signature(path: str) -> tuple[int, int]:
+    """
+    `(size, mtime_ns)` of a file, or `(-1, -1)` when it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return -1, -1
+    return stat.st_size, stat.st_mtime_ns
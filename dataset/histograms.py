@@ -0,0 +1,332 @@
+import os
+import math
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, Mapping, Optional
+
+import cv2
+import numpy as np
+
+from file_signatures import file_signature
+from image_pipeline import decode_image
+
+HISTOGRAM_BINS = 256
+CHANNELS = ('red', 'green', 'blue')
+# cv2.calcHist counts in float32, which is exact only up to 2 ** 24.
+MAX_PIXELS_PER_PASS = 1 << 24
+
+def image_histogram(image: np.ndarray) -> np.ndarray:
+    """
+    Per-channel histogram of an RGB uint8 image, as a `(3, 256)` int64 array.
+    """
+    image = np.ascontiguousarray(image)
+    if image.ndim == 2:
+        image = np.repeat(image[:, :, None], len(CHANNELS), axis=2)
+    histogram = np.zeros((len(CHANNELS), HISTOGRAM_BINS), dtype=np.int64)
+    rows_per_pass = max(MAX_PIXELS_PER_PASS // max(image.shape[1], 1), 1)
+    for start in range(0, image.shape[0], rows_per_pass):
+        chunk = image[start:start + rows_per_pass]
+        for channel in range(len(CHANNELS)):
+            counts = cv2.calcHist([chunk], [channel], None, [HISTOGRAM_BINS], [0, HISTOGRAM_BINS])
+            histogram[channel] += np.rint(counts.ravel()).astype(np.int64)
+    return histogram
+
+def _compute_histograms(image_paths: list[str], max_side: Optional[int]) -> tuple[np.ndarray, np.ndarray]:
+    histograms = np.zeros((len(image_paths), len(CHANNELS), HISTOGRAM_BINS), dtype=np.int64)
+    decoded = np.zeros(len(image_paths), dtype=bool)
+    for index, image_path in enumerate(image_paths):
+        try:
+            histograms[index] = image_histogram(decode_image(image_path, max_side))
+        except (OSError, ValueError):
+            continue
+        decoded[index] = True
+    return histograms, decoded
+
+class HistogramCache:
+    """
+    Per-image histograms keyed by image name and validated against the
+    `file_signature` of the image file, so that they are recomputed only
+    when an image changes. Can be persisted with `save` and shared between the
+    engines of several datasets (e.g. the splits of a dataset).
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._entries: dict[str, tuple[tuple[int, int], np.ndarray]] = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            try:
+                with np.load(path) as data:
+                    for name, signature, histogram in zip(data['names'].tolist(), data['signatures'].tolist(), data['histograms']):
+                        self._entries[name] = (tuple(signature), histogram.astype(np.int64))
+            except (OSError, ValueError, KeyError):
+                self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, image_name: str, signature: tuple[int, int]) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(image_name)
+        if entry is None or entry[0] != signature:
+            return None
+        return entry[1]
+
+    def put(self, image_name: str, signature: tuple[int, int], histogram: np.ndarray) -> None:
+        with self._lock:
+            self._entries[image_name] = (signature, histogram)
+
+    def discard(self, image_name: str) -> None:
+        with self._lock:
+            self._entries.pop(image_name, None)
+
+    def save(self, path: Optional[str] = None) -> bool:
+        """
+        Writes the cache to `path` (by default the path it was opened from).
+        Returns False when it cannot be written.
+        """
+        path = path or self.path
+        if path is None:
+            return False
+        with self._lock:
+            names = list(self._entries.keys())
+            signatures = np.array([signature for signature, _ in self._entries.values()], dtype=np.int64).reshape(-1, 2)
+            histograms = np.array([histogram for _, histogram in self._entries.values()], dtype=np.int64)
+        histograms = histograms.reshape(-1, len(CHANNELS), HISTOGRAM_BINS)
+        temporary_path = path + '.tmp'
+        try:
+            with open(temporary_path, 'wb') as writer:
+                np.savez(writer, names=np.array(names, dtype=str), signatures=signatures, histograms=histograms)
+            os.replace(temporary_path, path)
+        except OSError:
+            return False
+        return True
+
+@dataclass
+class HistogramEstimate:
+    """
+    Approximate dataset histogram computed from a sample of images.
+    `histogram[c, v]` is the estimated fraction of pixels of channel `c` with
+    value `v`. With probability `confidence`, every bin is within `max_error`
+    of the value computed over all images.
+    """
+    histogram: np.ndarray
+    sample_size: int
+    max_error: float
+    confidence: float
+
+def sample_size_for_error(max_error: float, confidence: float = 0.95) -> int:
+    """
+    Number of sampled images that guarantees `HistogramEstimate.max_error`
+    (Hoeffding's inequality with a union bound over every bin).
+    """
+    bins = len(CHANNELS) * HISTOGRAM_BINS
+    return math.ceil(math.log(2 * bins / (1 - confidence)) / (2 * max_error ** 2))
+
+def error_for_sample_size(sample_size: int, population: int, confidence: float = 0.95) -> float:
+    if sample_size >= population:
+        return 0.0
+    bins = len(CHANNELS) * HISTOGRAM_BINS
+    return math.sqrt(math.log(2 * bins / (1 - confidence)) / (2 * sample_size))
+
+class HistogramEngine:
+    """
+    Per-channel pixel histograms of a dataset. Per-image histograms are
+    computed in worker processes, kept in a `HistogramCache` and summed into a
+    dataset total. The total is kept up to date incrementally: `Dataset`
+    calls `discard_image` when an image is removed and `update_image` when it
+    is cropped, so neither rescans the dataset. Images that are missing or
+    cannot be decoded are kept in `failed` with the signature of their file,
+    and only tried again once it changes.
+    """
+    CHUNK_SIZE = 64
+
+    def __init__(self, dataset, cache: Optional[HistogramCache] = None, workers: Optional[int] = None):
+        self.dataset = dataset
+        self.cache = cache if cache is not None else HistogramCache()
+        self.workers = workers
+        self._image_histograms: dict[int, np.ndarray] = {}
+        self.failed: dict[int, tuple[int, int]] = {}
+        self._total = np.zeros((len(CHANNELS), HISTOGRAM_BINS), dtype=np.int64)
+
+    def _image_path(self, image_id: int) -> str:
+        return os.path.join(self.dataset.data_path, self.dataset.image_id2image_name[image_id])
+
+    def _include(self, image_id: int, histogram: np.ndarray) -> None:
+        self.failed.pop(image_id, None)
+        previous = self._image_histograms.get(image_id)
+        if previous is not None:
+            self._total -= previous
+        self._image_histograms[image_id] = histogram
+        self._total += histogram
+
+    def compute(self, image_ids: Iterable[int] = None) -> None:
+        """
+        Computes the histograms of the given images (all images by default)
+        that are neither included in the total, cached nor failed with the
+        same file signature.
+        """
+        if image_ids is None:
+            image_ids = self.dataset.image_id2image_name.keys()
+
+        missing_ids = []
+        missing_signatures = []
+        for image_id in image_ids:
+            if image_id in self._image_histograms:
+                continue
+            image_name = self.dataset.image_id2image_name[image_id]
+            signature = file_signature(self._image_path(image_id))
+            if self.failed.get(image_id) == signature:
+                continue
+            if signature == (-1, -1):
+                self.failed[image_id] = signature
+                continue
+            histogram = self.cache.get(image_name, signature)
+            if histogram is not None:
+                self._include(image_id, histogram)
+            else:
+                missing_ids.append(image_id)
+                missing_signatures.append(signature)
+
+        if len(missing_ids) == 0:
+            return
+
+        chunks = [
+            (missing_ids[start:start + self.CHUNK_SIZE], missing_signatures[start:start + self.CHUNK_SIZE])
+            for start in range(0, len(missing_ids), self.CHUNK_SIZE)
+        ]
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            results = executor.map(
+                _compute_histograms,
+                [[self._image_path(image_id) for image_id in ids] for ids, _ in chunks],
+                [None] * len(chunks)
+            )
+            for (ids, signatures), (histograms, decoded) in zip(chunks, results):
+                for image_id, signature, histogram, ok in zip(ids, signatures, histograms, decoded):
+                    if not ok:
+                        self.failed[image_id] = signature
+                        continue
+                    self.cache.put(self.dataset.image_id2image_name[image_id], signature, histogram)
+                    self._include(image_id, histogram)
+
+    def _sync(self) -> None:
+        # Drops images that left the dataset without going through `discard_image`.
+        image_id2image_name = self.dataset.image_id2image_name
+        for image_id in [image_id for image_id in self._image_histograms if image_id not in image_id2image_name]:
+            self._total -= self._image_histograms.pop(image_id)
+        for image_id in [image_id for image_id in self.failed if image_id not in image_id2image_name]:
+            del self.failed[image_id]
+
+    def get_image_histogram(self, image_id: int) -> Optional[np.ndarray]:
+        """
+        Histogram of one image, or None when the image cannot be decoded.
+        """
+        if image_id not in self._image_histograms:
+            self.compute([image_id])
+        return self._image_histograms.get(image_id)
+
+    def dataset_histogram(self) -> np.ndarray:
+        """
+        `(3, 256)` pixel counts of every image of the dataset that can be
+        decoded. Failed images are only checked for a new file signature.
+        """
+        self._sync()
+        if len(self._image_histograms) < len(self.dataset.image_id2image_name):
+            self.compute()
+        return self._total.copy()
+
+    def histogram(self, image_ids: Iterable[int]) -> np.ndarray:
+        """
+        Sum of the histograms of a subset of images, e.g. one split.
+        """
+        image_ids = list(image_ids)
+        self.compute(image_ids)
+        histograms = [self._image_histograms[image_id] for image_id in image_ids if image_id in self._image_histograms]
+        if len(histograms) == 0:
+            return np.zeros((len(CHANNELS), HISTOGRAM_BINS), dtype=np.int64)
+        return np.sum(histograms, axis=0)
+
+    def split_histograms(self, splits: Mapping[str, Iterable[int]]) -> dict[str, np.ndarray]:
+        """
+        Histogram of each split, e.g. `{'train': train_ids, 'val': val_ids}`.
+        Images shared by the splits are decoded once.
+        """
+        splits = {name: list(image_ids) for name, image_ids in splits.items()}
+        self.compute(image_id for image_ids in splits.values() for image_id in image_ids)
+        return {name: self.histogram(image_ids) for name, image_ids in splits.items()}
+
+    def approximate_histogram(self,
+                max_error: float = 0.01,
+                confidence: float = 0.95,
+                sample_size: int = None,
+                max_side: int = None,
+                seed: int = 0
+                ) -> HistogramEstimate:
+        """
+        Estimates the normalized dataset histogram from a uniform sample of
+        images, without decoding the whole dataset. The sample size is derived
+        from `max_error` unless `sample_size` is given. Every image has the same
+        weight, so the estimate matches the normalized `dataset_histogram` when
+        images have the same size. With `max_side`, images are decoded at
+        reduced resolution, which is faster but not covered by the bound.
+        """
+        image_ids = np.fromiter(self.dataset.image_id2image_name.keys(), dtype=np.int64, count=len(self.dataset.image_id2image_name))
+        if sample_size is None:
+            sample_size = sample_size_for_error(max_error, confidence)
+        sample_size = min(sample_size, len(image_ids))
+        sample = np.random.default_rng(seed).choice(image_ids, size=sample_size, replace=False).tolist()
+
+        cached = [image_id for image_id in sample if image_id in self._image_histograms]
+        uncached = [image_id for image_id in sample if image_id not in self._image_histograms]
+        histograms = [self._image_histograms[image_id] for image_id in cached]
+        if len(uncached) > 0:
+            chunks = [uncached[start:start + self.CHUNK_SIZE] for start in range(0, len(uncached), self.CHUNK_SIZE)]
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                results = executor.map(
+                    _compute_histograms,
+                    [[self._image_path(image_id) for image_id in ids] for ids in chunks],
+                    [max_side] * len(chunks)
+                )
+                for chunk_histograms, decoded in results:
+                    histograms.extend(chunk_histograms[decoded])
+
+        histograms = np.array(histograms, dtype=np.float64).reshape(-1, len(CHANNELS), HISTOGRAM_BINS)
+        pixels = histograms.sum(axis=2, keepdims=True)
+        pixels[pixels == 0] = 1
+        estimate = (histograms / pixels).mean(axis=0) if len(histograms) > 0 else np.zeros((len(CHANNELS), HISTOGRAM_BINS))
+        return HistogramEstimate(
+            histogram = estimate,
+            sample_size = len(histograms),
+            max_error = error_for_sample_size(len(histograms), len(image_ids), confidence) if len(histograms) > 0 else 1.0,
+            confidence = confidence
+        )
+
+    def discard_image(self, image_id: int, image_name: str = None) -> None:
+        """
+        Removes an image from the totals, and from the cache when `image_name` is given.
+        """
+        histogram = self._image_histograms.pop(image_id, None)
+        if histogram is not None:
+            self._total -= histogram
+        self.failed.pop(image_id, None)
+        if image_name is not None:
+            self.cache.discard(image_name)
+
+    def update_image(self, image_id: int, image: np.ndarray = None) -> None:
+        """
+        Replaces the histogram of an image that changed on disk. When the new
+        pixels are already in memory (`image`), they are used instead of
+        decoding the file again. Images that were never computed are left to
+        be computed on demand.
+        """
+        if image_id not in self._image_histograms:
+            return
+        if image is None:
+            self.discard_image(image_id)
+            self.compute([image_id])
+            return
+        histogram = image_histogram(image)
+        self._include(image_id, histogram)
+        signature = file_signature(self._image_path(image_id))
+        if signature != (-1, -1):
+            self.cache.put(self.dataset.image_id2image_name[image_id], signature, histogram)
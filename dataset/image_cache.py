@@ -0,0 +1,173 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Hashable, Iterable
+
+import numpy as np
+
+class ImageCache:
+    """
+    Thread-safe LRU cache of decoded images, bounded by the total size in bytes
+    of the cached arrays. Cached arrays are shared between callers and are
+    therefore read-only.
+    """
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._images: OrderedDict[Hashable, np.ndarray] = OrderedDict()
+        self._pending: dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._images
+
+    def __len__(self):
+        return len(self._images)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'images': len(self._images),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes
+            }
+
+    def get(self, key: Hashable, load: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        Returns the cached image for `key`, calling `load` on a miss. If the
+        image is already being loaded by another thread (e.g. the prefetcher),
+        waits for that load instead of decoding it twice.
+        """
+        with self._lock:
+            if key in self._images:
+                self.hits += 1
+                self._images.move_to_end(key)
+                return self._images[key]
+            self.misses += 1
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = Future()
+                self._pending[key] = pending
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            return pending.result()
+        return self._load(key, load, pending)
+
+    def load_in_background(self, key: Hashable, load: Callable[[], np.ndarray]) -> bool:
+        """
+        Loads an image into the cache without counting a hit or a miss. Returns
+        False when the image is already cached or being loaded.
+        """
+        with self._lock:
+            if key in self._images or key in self._pending:
+                return False
+            pending = Future()
+            self._pending[key] = pending
+        try:
+            self._load(key, load, pending)
+        except Exception:
+            pass
+        return True
+
+    def _load(self, key: Hashable, load: Callable[[], np.ndarray], pending: Future) -> np.ndarray:
+        try:
+            image = load()
+            image.setflags(write=False)
+        except BaseException as error:
+            with self._lock:
+                if self._pending.get(key) is pending:
+                    del self._pending[key]
+            pending.set_exception(error)
+            raise
+
+        with self._lock:
+            # A load that was invalidated while running is no longer pending
+            # and its result, read before the change, is not cached.
+            current = self._pending.get(key) is pending
+            if current:
+                del self._pending[key]
+            if current and image.nbytes <= self.max_bytes:
+                self._images[key] = image
+                self.current_bytes += image.nbytes
+                while self.current_bytes > self.max_bytes:
+                    _, evicted = self._images.popitem(last=False)
+                    self.current_bytes -= evicted.nbytes
+                    self.evictions += 1
+        pending.set_result(image)
+        return image
+
+    def invalidate(self, key: Hashable) -> None:
+        """
+        Drops the cached image for `key`. A load of it that is in progress is
+        not cached when it finishes, and later calls load the image again.
+        """
+        with self._lock:
+            image = self._images.pop(key, None)
+            if image is not None:
+                self.current_bytes -= image.nbytes
+            self._pending.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._images.clear()
+            self._pending.clear()
+            self.current_bytes = 0
+
+class ImagePrefetcher:
+    """
+    Decodes images ahead of use into an `ImageCache` with a pool of background
+    threads. `prefetch` queues ids; queued ids that are no longer wanted can be
+    dropped with `cancel`, e.g. when a gallery scrolls past them.
+    """
+    def __init__(self, cache: ImageCache, load: Callable[[Hashable], np.ndarray], workers: int = 4):
+        self.cache = cache
+        self.load = load
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-prefetch')
+        self._futures: dict[Hashable, Future] = {}
+        self._lock = threading.RLock()
+
+    def prefetch(self, keys: Iterable[Hashable]) -> None:
+        with self._lock:
+            for key in keys:
+                if key in self._futures or key in self.cache:
+                    continue
+                future = self.executor.submit(self.cache.load_in_background, key, lambda key=key: self.load(key))
+                self._futures[key] = future
+                future.add_done_callback(lambda _, key=key: self._done(key))
+
+    def prefetch_window(self, keys: list[Hashable], position: int, ahead: int, behind: int = 0) -> None:
+        """
+        Prefetches the items around `position` of an ordered list of keys (e.g.
+        the images of a gallery), nearest first, and cancels anything queued
+        outside of that window.
+        """
+        start = max(position - behind, 0)
+        window = keys[position:position + ahead] + keys[start:position][::-1]
+        with self._lock:
+            self.cancel(set(self._futures) - set(window))
+            self.prefetch(window)
+
+    def cancel(self, keys: Iterable[Hashable] = None) -> None:
+        with self._lock:
+            for key in list(self._futures) if keys is None else keys:
+                future = self._futures.get(key)
+                if future is not None and future.cancel():
+                    self._futures.pop(key, None)
+
+    def _done(self, key: Hashable) -> None:
+        with self._lock:
+            self._futures.pop(key, None)
+
+    def shutdown(self) -> None:
+        self.cancel()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,315 @@
+import os
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Iterable, Mapping, Optional
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from file_signatures import file_signature
+
+HASH_BITS = 64
+CONTENT_DIGEST_SIZE = 16
+READ_CHUNK_SIZE = 1 << 20
+HASH_STORE_SUFFIX = '.image_hashes.npz'
+# Candidate pairs are checked in batches of at most this many pairs.
+PAIR_BATCH_SIZE = 1 << 22
+
+_POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values).astype(np.int64)
+    return _POPCOUNT_TABLE[values.view(np.uint8).reshape(-1, 8)].sum(axis=1, dtype=np.int64)
+
+def content_digest(path: str) -> bytes:
+    """
+    blake2b digest of a file, read in chunks so that large files are never
+    fully loaded in memory.
+    """
+    digest = hashlib.blake2b(digest_size=CONTENT_DIGEST_SIZE)
+    with open(path, 'rb') as reader:
+        while chunk := reader.read(READ_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.digest()
+
+def perceptual_hash(path: str) -> int:
+    """
+    64-bit DCT perceptual hash. The image is decoded at low resolution (JPEG
+    draft mode), reduced to 32x32 grey levels, and each bit tells whether one
+    of the 8x8 lowest frequencies is above their median.
+    """
+    with Image.open(path) as image:
+        image.draft('L', (64, 64))
+        pixels = np.asarray(image.convert('L').resize((32, 32), Image.BILINEAR), dtype=np.float32)
+    frequencies = cv2.dct(pixels)[:8, :8].ravel()
+    bits = frequencies > np.median(frequencies[1:])
+    return int(np.packbits(bits.astype(np.uint8)).view('>u8')[0])
+
+def _hash_images(image_paths: list[str], content: list[bool]) -> tuple[np.ndarray, list[Optional[bytes]], np.ndarray]:
+    hashes = np.zeros(len(image_paths), dtype=np.uint64)
+    digests = [None] * len(image_paths)
+    hashed = np.zeros(len(image_paths), dtype=bool)
+    for index, (image_path, need_content) in enumerate(zip(image_paths, content)):
+        try:
+            if need_content:
+                digests[index] = content_digest(image_path)
+            hashes[index] = perceptual_hash(image_path)
+        except (OSError, ValueError):
+            continue
+        hashed[index] = True
+    return hashes, digests, hashed
+
+def hash_store_path_for(data_path: str) -> str:
+    """
+    Sidecar file of the hashes of the images of `data_path`, next to the
+    directory rather than inside it.
+    """
+    return os.path.abspath(data_path) + HASH_STORE_SUFFIX
+
+class ImageHashStore:
+    """
+    Perceptual hashes and content digests of images, keyed by image name and
+    validated against the `file_signature` of the file, so that re-runs only
+    hash new or changed images. Persisted with `save`.
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._entries: dict[str, tuple[tuple[int, int], int, Optional[bytes]]] = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            try:
+                with np.load(path) as data:
+                    digests = [digest.tobytes() if has_digest else None for digest, has_digest in zip(data['digests'], data['has_digests'])]
+                    for name, signature, image_hash, digest in zip(data['names'].tolist(), data['signatures'].tolist(), data['hashes'].tolist(), digests):
+                        self._entries[name] = (tuple(signature), image_hash, digest)
+            except (OSError, ValueError, KeyError):
+                self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, image_name: str, signature: tuple[int, int]) -> Optional[tuple[int, Optional[bytes]]]:
+        """
+        `(perceptual_hash, content_digest)` of an image, or None when it is
+        unknown or changed. The digest is None when it was never computed.
+        """
+        with self._lock:
+            entry = self._entries.get(image_name)
+        if entry is None or entry[0] != signature:
+            return None
+        return entry[1], entry[2]
+
+    def put(self, image_name: str, signature: tuple[int, int], image_hash: int, digest: Optional[bytes]) -> None:
+        with self._lock:
+            self._entries[image_name] = (signature, image_hash, digest)
+
+    def save(self, path: Optional[str] = None) -> bool:
+        path = path or self.path
+        if path is None:
+            return False
+        with self._lock:
+            names = list(self._entries.keys())
+            entries = list(self._entries.values())
+        temporary_path = path + '.tmp'
+        try:
+            with open(temporary_path, 'wb') as writer:
+                np.savez(
+                    writer,
+                    names = np.array(names, dtype=str),
+                    signatures = np.array([entry[0] for entry in entries], dtype=np.int64).reshape(-1, 2),
+                    hashes = np.array([entry[1] for entry in entries], dtype=np.uint64),
+                    digests = np.array([list(entry[2] or bytes(CONTENT_DIGEST_SIZE)) for entry in entries], dtype=np.uint8).reshape(-1, CONTENT_DIGEST_SIZE),
+                    has_digests = np.array([entry[2] is not None for entry in entries], dtype=bool)
+                )
+            os.replace(temporary_path, path)
+        except OSError:
+            return False
+        return True
+
+@dataclass
+class DuplicateReport:
+    """
+    `exact` holds groups of image ids with identical file contents.
+    `near` holds `(image_id_a, image_id_b, distance)` rows for the pairs whose
+    perceptual hashes differ in at most `max_distance` bits, exact duplicates
+    included. `cross_split` holds `(image_id_a, split_a, image_id_b, split_b)`
+    for duplicates that belong to different splits.
+    """
+    exact: list[list[int]]
+    near: np.ndarray
+    max_distance: int
+    cross_split: list[tuple[int, str, int, str]] = field(default_factory=list)
+
+def near_duplicate_pairs(hashes: np.ndarray, max_distance: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns `(index_a, index_b, distances)` for every pair of 64-bit hashes at
+    Hamming distance `max_distance` or less, with `index_a < index_b`.
+
+    Multi-index hashing: the hashes are split into `max_distance + 1`
+    substrings, and by the pigeonhole principle close pairs share at least one
+    of them exactly. Candidates are the pairs of hashes with an equal
+    substring, found by sorting; a pair is kept only for the first substring
+    it shares, so no pair is reported twice.
+    """
+    hashes = np.ascontiguousarray(hashes, dtype=np.uint64)
+    chunks = max_distance + 1
+    if chunks > HASH_BITS:
+        raise ValueError(f"max_distance must be less than {HASH_BITS}")
+    bounds = np.linspace(0, HASH_BITS, chunks + 1).astype(np.uint64)
+    masks = [np.uint64(((1 << int(bounds[chunk + 1] - bounds[chunk])) - 1) << int(bounds[chunk])) for chunk in range(chunks)]
+
+    result_a, result_b, result_distances = [], [], []
+
+    def collect(order: np.ndarray, sorted_hashes: np.ndarray, first: np.ndarray, second: np.ndarray, chunk: int) -> None:
+        differences = sorted_hashes[first] ^ sorted_hashes[second]
+        distances = popcount(differences)
+        keep = np.flatnonzero(distances <= max_distance)
+        differences = differences[keep]
+        for mask in masks[:chunk]:
+            keep = keep[(differences & mask) != 0]
+            differences = differences[(differences & mask) != 0]
+        index_a, index_b = order[first[keep]], order[second[keep]]
+        result_a.append(np.minimum(index_a, index_b))
+        result_b.append(np.maximum(index_a, index_b))
+        result_distances.append(distances[keep])
+
+    for chunk, mask in enumerate(masks):
+        values = hashes & mask
+        order = np.argsort(values, kind='stable')
+        sorted_values = values[order]
+        sorted_hashes = hashes[order]
+        starts = np.flatnonzero(np.r_[True, sorted_values[1:] != sorted_values[:-1]]) if len(values) > 0 else np.empty(0, dtype=np.int64)
+        sizes = np.diff(np.r_[starts, len(values)])
+        starts, sizes = starts[sizes > 1], sizes[sizes > 1]
+        pair_counts = sizes * (sizes - 1) // 2
+
+        # Groups are processed in batches of about `PAIR_BATCH_SIZE` pairs so
+        # that memory stays bounded; larger groups are compared row by row.
+        large = pair_counts > PAIR_BATCH_SIZE
+        for start, size in zip(starts[large].tolist(), sizes[large].tolist()):
+            for position in range(start, start + size - 1):
+                second = np.arange(position + 1, start + size)
+                collect(order, sorted_hashes, np.full(len(second), position), second, chunk)
+        starts, sizes, pair_counts = starts[~large], sizes[~large], pair_counts[~large]
+        batches = (np.cumsum(pair_counts) - pair_counts) // PAIR_BATCH_SIZE
+        boundaries = np.flatnonzero(np.r_[True, batches[1:] != batches[:-1]]) if len(batches) > 0 else np.empty(0, dtype=np.int64)
+        for batch_start, batch_end in zip(boundaries, np.r_[boundaries[1:], len(starts)]):
+            group_starts, group_sizes = starts[batch_start:batch_end], sizes[batch_start:batch_end]
+            positions = np.repeat(group_starts, group_sizes) + np.arange(int(group_sizes.sum())) - np.repeat(np.cumsum(group_sizes) - group_sizes, group_sizes)
+            partners = np.repeat(group_starts + group_sizes, group_sizes) - positions - 1
+            first = np.repeat(positions, partners)
+            second = first + 1 + np.arange(len(first)) - np.repeat(np.cumsum(partners) - partners, partners)
+            collect(order, sorted_hashes, first, second, chunk)
+
+    if len(result_a) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(result_a), np.concatenate(result_b), np.concatenate(result_distances)
+
+def cross_split_duplicates(pairs: Iterable[tuple[int, int]], splits: Mapping[str, Iterable[int]]) -> list[tuple[int, str, int, str]]:
+    """
+    Keeps the pairs of duplicate image ids whose images belong to different splits.
+    """
+    image_id2split = {}
+    for split, image_ids in splits.items():
+        for image_id in image_ids:
+            image_id2split[image_id] = split
+    leaks = []
+    for image_id_a, image_id_b in pairs:
+        split_a = image_id2split.get(image_id_a)
+        split_b = image_id2split.get(image_id_b)
+        if split_a is not None and split_b is not None and split_a != split_b:
+            leaks.append((image_id_a, split_a, image_id_b, split_b))
+    return leaks
+
+class DuplicateImageFinder:
+    """
+    Finds exact and near-duplicate images of a dataset. Perceptual hashes (and
+    content digests, for the files whose size matches another file) are
+    computed in worker processes and kept in an `ImageHashStore`, which is
+    saved after new images are hashed when it has a path.
+    """
+    CHUNK_SIZE = 256
+
+    def __init__(self, dataset, store: Optional[ImageHashStore] = None, workers: Optional[int] = None):
+        self.dataset = dataset
+        self.store = store if store is not None else ImageHashStore()
+        self.workers = workers
+
+    def _hash(self, image_ids: list[int]) -> tuple[np.ndarray, np.ndarray, list[Optional[bytes]]]:
+        image_id2image_name = self.dataset.image_id2image_name
+        names = [image_id2image_name[image_id] for image_id in image_ids]
+        signatures = [file_signature(os.path.join(self.dataset.data_path, name)) for name in names]
+
+        # Only files whose size matches another file can be exact duplicates.
+        sizes = np.array([signature[0] for signature in signatures], dtype=np.int64)
+        unique_sizes, size_counts = np.unique(sizes, return_counts=True)
+        need_content = np.isin(sizes, unique_sizes[size_counts > 1]) & (sizes >= 0)
+
+        hashes = np.zeros(len(image_ids), dtype=np.uint64)
+        hashed = np.zeros(len(image_ids), dtype=bool)
+        digests: list[Optional[bytes]] = [None] * len(image_ids)
+        missing = []
+        for index, (name, signature) in enumerate(zip(names, signatures)):
+            if signature == (-1, -1):
+                continue
+            cached = self.store.get(name, signature)
+            if cached is not None and (cached[1] is not None or not need_content[index]):
+                hashes[index], digests[index] = cached
+                hashed[index] = True
+            else:
+                missing.append(index)
+
+        chunks = [missing[start:start + self.CHUNK_SIZE] for start in range(0, len(missing), self.CHUNK_SIZE)]
+        if len(chunks) > 0:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                results = executor.map(
+                    _hash_images,
+                    [[os.path.join(self.dataset.data_path, names[index]) for index in chunk] for chunk in chunks],
+                    [[bool(need_content[index]) for index in chunk] for chunk in chunks]
+                )
+                for chunk, (chunk_hashes, chunk_digests, chunk_hashed) in zip(chunks, results):
+                    for index, image_hash, digest, ok in zip(chunk, chunk_hashes.tolist(), chunk_digests, chunk_hashed):
+                        if not ok:
+                            continue
+                        hashes[index], digests[index], hashed[index] = image_hash, digest, True
+                        self.store.put(names[index], signatures[index], image_hash, digest)
+            self.store.save()
+        return hashes, hashed, digests
+
+    def find(self,
+                max_distance: int = 4,
+                splits: Mapping[str, Iterable[int]] = None,
+                image_ids: Iterable[int] = None
+                ) -> DuplicateReport:
+        """
+        Hashes the images (only new or changed ones are decoded) and reports
+        exact duplicates, near-duplicates within `max_distance` bits and, when
+        `splits` (`{'train': image_ids, ...}`) is given, the duplicates that
+        cross splits.
+        """
+        if image_ids is None:
+            image_ids = self.dataset.image_id2image_name.keys()
+        image_ids = np.fromiter(image_ids, dtype=np.int64)
+        hashes, hashed, digests = self._hash(image_ids.tolist())
+
+        groups: dict[bytes, list[int]] = {}
+        for image_id, digest in zip(image_ids.tolist(), digests):
+            if digest is not None:
+                groups.setdefault(digest, []).append(image_id)
+        exact = [group for group in groups.values() if len(group) > 1]
+
+        valid = np.flatnonzero(hashed)
+        index_a, index_b, distances = near_duplicate_pairs(hashes[valid], max_distance)
+        near = np.stack([image_ids[valid][index_a], image_ids[valid][index_b], distances], axis=1) if len(index_a) > 0 else np.empty((0, 3), dtype=np.int64)
+
+        report = DuplicateReport(exact=exact, near=near, max_distance=max_distance)
+        if splits is not None:
+            pairs = {(group[0], other) for group in exact for other in group[1:]}
+            pairs.update(zip(near[:, 0].tolist(), near[:, 1].tolist()))
+            report.cross_split = cross_split_duplicates(sorted(pairs), splits)
+        return report
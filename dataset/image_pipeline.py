@@ -0,0 +1,147 @@
+import os
+import ctypes
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing import resource_tracker, shared_memory
+from typing import Iterator, Optional
+
+import numpy as np
+from PIL import Image
+
+class _SharedMemoryArray:
+    """
+    Owner of a shared memory block exposed as an array. Arrays made from it,
+    and every view of them, reference it as their `base`, so the block stays
+    mapped until the last of them is gone and is closed by this finalizer.
+    (NumPy does not keep the buffer of `memory.buf` exported, so an array made
+    on it directly is unmapped under its feet by `SharedMemory.close`.)
+    """
+    def __init__(self, memory: shared_memory.SharedMemory, shape: tuple):
+        self.memory = memory
+        # Holding an export of the buffer also makes a premature close fail
+        # with a BufferError instead of unmapping it.
+        self._data = ctypes.c_char.from_buffer(memory.buf)
+        self.__array_interface__ = {
+            'version': 3,
+            'shape': shape,
+            'typestr': '|u1',
+            'data': (ctypes.addressof(self._data), False)
+        }
+
+    def __del__(self):
+        self._data = None
+        self.memory.close()
+
+@dataclass
+class ImageBatch:
+    """
+    A batch of decoded images stacked in one `(batch, height, width, channels)`
+    uint8 array, padded with zeros up to the largest image of the batch.
+    `sizes[i]` holds the `(height, width)` of image `i` before padding.
+
+    `images` lives in a shared memory block that is released when the batch
+    and every view of `images` are gone.
+    """
+    image_ids: list[int]
+    images: np.ndarray
+    sizes: np.ndarray
+    memory: Optional[shared_memory.SharedMemory] = field(default=None, repr=False)
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def image(self, index: int) -> np.ndarray:
+        height, width = self.sizes[index]
+        return self.images[index, :height, :width]
+
+def decode_image(image_path: str, max_side: Optional[int] = None, mode: str = 'RGB', box: Optional[tuple[int, int, int, int]] = None) -> np.ndarray:
+    """
+    Decodes an image, optionally cropped to `box` `(left, top, right, bottom)`
+    and downscaled so that its largest side is at most `max_side`. For JPEGs
+    the downscale happens while decoding (draft mode), which is much cheaper
+    than decoding at full resolution and resizing; cropped images are decoded
+    at full resolution since draft mode would scale the box.
+    """
+    with Image.open(image_path) as image:
+        if box is not None:
+            image = image.crop(box).convert(mode)
+            if max_side is not None:
+                image.thumbnail((max_side, max_side))
+        elif max_side is not None:
+            image.draft(mode, (max_side, max_side))
+            image = image.convert(mode)
+            image.thumbnail((max_side, max_side))
+        else:
+            image = image.convert(mode)
+        return np.asarray(image)
+
+def _decode_batch_to_shared_memory(image_paths: list[str], max_side: Optional[int], mode: str, boxes: list[Optional[tuple]]) -> tuple[str, tuple, np.ndarray]:
+    images = [decode_image(image_path, max_side, mode, box) for image_path, box in zip(image_paths, boxes)]
+    sizes = np.array([image.shape[:2] for image in images], dtype=np.int64).reshape(-1, 2)
+    channels = images[0].shape[2] if images and images[0].ndim == 3 else 1
+    shape = (len(images), int(sizes[:, 0].max(initial=0)), int(sizes[:, 1].max(initial=0)), channels)
+
+    memory = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)), 1))
+    batch = np.ndarray(shape, dtype=np.uint8, buffer=memory.buf)
+    batch[:] = 0
+    for index, image in enumerate(images):
+        batch[index, :image.shape[0], :image.shape[1]] = image.reshape(image.shape[0], image.shape[1], channels)
+    del batch
+    name = memory.name
+    memory.close()
+    # The parent process takes ownership of the block and unlinks it.
+    resource_tracker.unregister(memory._name, 'shared_memory')
+    return name, shape, sizes
+
+def iter_image_batches(
+        image_paths: list[str],
+        image_ids: list[int],
+        batch_size: int = 32,
+        workers: Optional[int] = None,
+        max_side: Optional[int] = None,
+        mode: str = 'RGB',
+        boxes: Optional[list[Optional[tuple[int, int, int, int]]]] = None
+        ) -> Iterator[ImageBatch]:
+    """
+    Decodes images in worker processes and yields them in order as `ImageBatch`es.
+    Workers write pixels straight into shared memory, so batches are not copied
+    back through pickling. At most two batches per worker are decoded ahead
+    of the consumer. `boxes` optionally holds a crop box, or None, per image.
+    """
+    if boxes is None:
+        boxes = [None] * len(image_paths)
+    batches = [
+        (image_paths[start:start + batch_size], image_ids[start:start + batch_size], boxes[start:start + batch_size])
+        for start in range(0, len(image_paths), batch_size)
+    ]
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        next_batch = 0
+        try:
+            while next_batch < len(batches) or in_flight:
+                while next_batch < len(batches) and len(in_flight) < 2 * workers:
+                    paths, ids, batch_boxes = batches[next_batch]
+                    in_flight.append((ids, executor.submit(_decode_batch_to_shared_memory, paths, max_side, mode, batch_boxes)))
+                    next_batch += 1
+
+                ids, future = in_flight.popleft()
+                name, shape, sizes = future.result()
+                memory = shared_memory.SharedMemory(name=name)
+                # The mapping stays valid after unlinking; only the name is removed.
+                memory.unlink()
+                yield ImageBatch(
+                    image_ids = ids,
+                    images = np.asarray(_SharedMemoryArray(memory, shape)),
+                    sizes = sizes,
+                    memory = memory
+                )
+        finally:
+            # Release the blocks of batches decoded ahead when the consumer stops early.
+            for _, future in in_flight:
+                if future.cancel() or future.exception() is not None:
+                    continue
+                memory = shared_memory.SharedMemory(name=future.result()[0])
+                memory.close()
+                memory.unlink()
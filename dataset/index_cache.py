@@ -0,0 +1,34 @@
+from typing import Optional
+
+import numpy as np
+
+from dataset import Dataset
+from file_signatures import file_signature
+from snapshot import read_snapshot, write_snapshot
+
+CACHE_SUFFIX = '.index.snapshot'
+
+def cache_path_for(source_path: str) -> str:
+    return source_path + CACHE_SUFFIX
+
+def save_dataset_index(cache_path: str, dataset: Dataset, **extra_arrays: np.ndarray) -> bool:
+    """
+    Writes a dataset and any `extra_arrays` (e.g. source signatures) as a
+    snapshot. Returns False when it cannot be written, e.g. on a read-only
+    dataset directory.
+    """
+    try:
+        write_snapshot(cache_path, dataset, extra_arrays)
+    except OSError:
+        return False
+    return True
+
+def load_dataset_index(cache_path: str) -> Optional[tuple[Dataset, dict[str, np.ndarray]]]:
+    """
+    Memory-maps a file written by `save_dataset_index`. Returns the dataset and
+    the extra arrays, or None when the file is missing or unreadable.
+    """
+    try:
+        return read_snapshot(cache_path)
+    except (OSError, ValueError, KeyError):
+        return None
@@ -0,0 +1,82 @@
+import os
+import yaml
+from typing import Optional, Union
+
+import numpy as np
+
+from dataset import Dataset
+from dataset_view import DatasetView
+from annotation_store import counts_to_offsets
+from mask_rasterization import MAX_INSTANCES_PER_IMAGE, _rasterize_masks, class_values, mask_path_for, rasterize_chunks, run_in_chunks, vectorize_dataset
+from semantic_masks import CLASSES_FILE_NAME, load_class_names, selected_rows
+
+class InstanceMasksAdapter:
+    """
+    One RGB PNG per image in `masks_path`, named after the image. The red
+    channel holds the class value of every pixel and the green and blue
+    channels the number of its instance (`green * 256 + blue`, 0 is the
+    background). The class of every value is kept in `classes.yaml`.
+    """
+    @staticmethod
+    def load(images_path: str, masks_path: str, workers: Optional[int] = None, chunk_size: int = 64) -> Dataset:
+        """
+        Turns every instance into a polygon annotation (the outer contour of
+        its largest part). Masks are read and vectorized in chunks of images
+        by `workers` processes.
+        """
+        image_id2image_name, image_id2image_dimensions, annotation_store = vectorize_dataset(images_path, masks_path, True, workers, chunk_size)
+        id2class = load_class_names(masks_path)
+        for value in np.unique(annotation_store.class_ids).tolist():
+            id2class.setdefault(value, str(value))
+
+        return Dataset.from_annotation_store(
+            id2class = id2class,
+            data_path = images_path,
+            image_id2image_name = image_id2image_name,
+            image_id2image_dimensions = image_id2image_dimensions,
+            annotation_store = annotation_store
+        )
+
+    @staticmethod
+    def save(dataset: Union[Dataset, DatasetView], masks_path: str, workers: Optional[int] = None, chunk_size: int = 64, compression: int = 3) -> None:
+        """
+        Rasterizes the polygons and masks of every image with `cv2.fillPoly` in
+        `workers` processes, `chunk_size` images at a time, and writes them as
+        PNG files. Boxes and classification annotations are not drawn.
+        """
+        source, rows, image_ids = selected_rows(dataset)
+        store = source.annotation_store
+        values = class_values(source.id2class.keys())
+        if max(values.values(), default=0) > 255:
+            raise ValueError("Instance masks hold at most 255 classes")
+        rows = rows[np.isin(store.class_ids[rows], np.fromiter(values.keys(), dtype=np.int64, count=len(values)))]
+
+        # Instances are numbered from 1 within each image, in row order.
+        rows = rows[np.argsort(store.image_ids[rows], kind='stable')]
+        image_offsets = counts_to_offsets(np.bincount(np.searchsorted(image_ids, store.image_ids[rows]), minlength=len(image_ids)))
+        if len(image_ids) > 0 and np.diff(image_offsets).max() > MAX_INSTANCES_PER_IMAGE:
+            raise ValueError(f"Instance masks hold at most {MAX_INSTANCES_PER_IMAGE} instances per image")
+        instances = np.arange(len(rows)) - np.repeat(image_offsets[:-1], np.diff(image_offsets)) + 1
+        pixel_values = np.stack([
+            instances & 255,
+            instances >> 8,
+            np.array([values[class_id] for class_id in store.class_ids[rows].tolist()], dtype=np.int64)
+        ], axis=1)
+
+        os.makedirs(masks_path, exist_ok=True)
+        with open(os.path.join(masks_path, CLASSES_FILE_NAME), 'w') as writer:
+            yaml.safe_dump({value: source.id2class[class_id] for class_id, value in values.items()}, writer)
+
+        payloads = rasterize_chunks(
+            store,
+            rows,
+            pixel_values,
+            image_ids,
+            [mask_path_for(masks_path, source.image_id2image_name[image_id]) for image_id in image_ids.tolist()],
+            np.array([source.image_id2image_dimensions[image_id] for image_id in image_ids.tolist()], dtype=np.int64).reshape(-1, 2),
+            np.uint8,
+            chunk_size,
+            compression
+        )
+        for _ in run_in_chunks(_rasterize_masks, payloads, workers):
+            pass
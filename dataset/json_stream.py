@@ -0,0 +1,175 @@
+import json
+from typing import IO, Iterable, Iterator, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+WHITESPACE = ' \t\n\r'
+
+class JSONObjectStream:
+    """
+    Incrementally parses a JSON document whose root is an object, reading the
+    file in chunks. Top-level arrays are yielded element by element, so only one
+    element has to be held in memory at a time.
+
+    Iterating yields `(key, value, is_array_item)` tuples: for top-level arrays
+    one tuple per element with `is_array_item=True`, for any other top-level
+    value a single tuple with the whole value.
+    """
+    def __init__(self, reader: IO[str], chunk_size: int = 1 << 20):
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def _read_more(self, size: int) -> bool:
+        if self.eof:
+            return False
+        if self.position > 0:
+            self.buffer = self.buffer[self.position:]
+            self.position = 0
+        chunk = self.reader.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer += chunk
+        return True
+
+    def _peek(self) -> str:
+        """
+        Skips whitespace and returns the next character without consuming it.
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._read_more(self.chunk_size):
+                raise ValueError("Unexpected end of JSON document")
+
+    def _expect(self, characters: str) -> str:
+        character = self._peek()
+        if character not in characters:
+            raise ValueError(f"Expected one of {characters!r} at offset {self.position}, found {character!r}")
+        self.position += 1
+        return character
+
+    def _decode_value(self):
+        self._peek()
+        read_size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if not self._read_more(read_size):
+                    raise
+                read_size *= 2
+                continue
+            # A value that ends exactly at the end of the buffer may be a truncated number.
+            if end == len(self.buffer) and self._read_more(read_size):
+                continue
+            self.position = end
+            return value
+
+    def __iter__(self) -> Iterator[tuple[str, object, bool]]:
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._decode_value()
+            self._expect(':')
+            if self._peek() == '[':
+                self.position += 1
+                if self._peek() == ']':
+                    self.position += 1
+                else:
+                    while True:
+                        yield key, self._decode_value(), True
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                yield key, self._decode_value(), False
+            if self._expect(',}') == '}':
+                return
+
+def dumps(value, indent: Optional[int] = None, fast: bool = True) -> str:
+    """
+    Encodes a value like `json.dumps`, compact when `indent` is None. With
+    `fast`, orjson is used when it is installed and supports the indentation
+    (compact or 2 spaces).
+    """
+    if fast and orjson is not None and indent in (None, 2):
+        return orjson.dumps(value, option=orjson.OPT_INDENT_2 if indent == 2 else 0).decode('utf-8')
+    if indent is None:
+        return json.dumps(value, separators=(',', ':'))
+    return json.dumps(value, indent=indent)
+
+class JSONObjectWriter:
+    """
+    Writes a JSON document whose root is an object one member at a time. Arrays
+    are written from an iterable of batches, so only one batch of elements has
+    to be held in memory. With `indent`, the output is the same as
+    `json.dumps(document, indent=indent)`.
+    """
+    def __init__(self, writer: IO[str], indent: Optional[int] = None, fast: bool = True):
+        self.writer = writer
+        self.indent = indent
+        self.fast = fast
+        self.members = 0
+
+    def _nested(self, text: str, level: int) -> str:
+        if self.indent is None:
+            return text
+        return text.replace('\n', '\n' + ' ' * (self.indent * level))
+
+    def _begin_member(self, key: str) -> None:
+        if self.members == 0:
+            self.writer.write('{')
+        else:
+            self.writer.write(',')
+        if self.indent is not None:
+            self.writer.write('\n' + ' ' * self.indent + json.dumps(key) + ': ')
+        else:
+            self.writer.write(json.dumps(key) + ':')
+        self.members += 1
+
+    def write_value(self, key: str, value) -> None:
+        self._begin_member(key)
+        self.writer.write(self._nested(dumps(value, self.indent, self.fast), 1))
+
+    def write_array(self, key: str, batches: Iterable[list]) -> None:
+        self._begin_member(key)
+        self.writer.write('[')
+        empty = True
+        for batch in batches:
+            if len(batch) == 0:
+                continue
+            # The batch is encoded as one array and its brackets are dropped,
+            # which leaves the elements already separated and indented.
+            text = dumps(batch, self.indent, self.fast)
+            if self.indent is not None:
+                text = self._nested(text[1:-2], 1)
+            else:
+                text = text[1:-1]
+            self.writer.write(text if empty else ',' + text)
+            empty = False
+        if not empty and self.indent is not None:
+            self.writer.write('\n' + ' ' * self.indent)
+        self.writer.write(']')
+
+    def close(self) -> None:
+        if self.members == 0:
+            self.writer.write('{')
+        self.writer.write('\n}' if self.indent is not None and self.members > 0 else '}')
+
+    def __enter__(self) -> "JSONObjectWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+
@@ -0,0 +1,302 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional
+
+import cv2
+import numpy as np
+from PIL import Image
+from pycocotools import mask as mask_utils
+
+from annotation_store import AnnotationStore, AnnotationStoreBuilder, KIND_MASK, KIND_SEGMENTATION, counts_to_offsets
+from rle import decode_rle
+
+IMAGE_EXTENSIONS = {extension.lower() for extension in Image.registered_extensions()}
+MASK_EXTENSION = '.png'
+MAX_INSTANCES_PER_IMAGE = (1 << 16) - 1
+
+def mask_path_for(masks_path: str, image_name: str) -> str:
+    return os.path.join(masks_path, os.path.splitext(image_name)[0] + MASK_EXTENSION)
+
+def class_values(class_ids: Iterable[int]) -> dict[int, int]:
+    """
+    Pixel value of every class. Classes keep their id when all ids are positive
+    (0 is the background), otherwise they are numbered from 1 in id order.
+    """
+    class_ids = sorted(class_ids)
+    if len(class_ids) > 0 and class_ids[0] > 0:
+        return {class_id: class_id for class_id in class_ids}
+    return {class_id: position + 1 for position, class_id in enumerate(class_ids)}
+
+def run_in_chunks(function: Callable, payloads: Iterable[tuple], workers: Optional[int] = None) -> Iterator:
+    """
+    Runs `function(*payload)` in a process pool and yields the results in
+    order, with at most two payloads per worker in flight, so that only a few
+    chunks are held in memory at a time.
+    """
+    workers = workers or os.cpu_count() or 1
+    payloads = iter(payloads)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for payload in payloads:
+            in_flight.append(executor.submit(function, *payload))
+            if len(in_flight) >= 2 * workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+def rasterize_chunks(
+        store: AnnotationStore,
+        rows: np.ndarray,
+        pixel_values: np.ndarray,
+        image_ids: np.ndarray,
+        mask_paths: list[str],
+        dimensions: np.ndarray,
+        dtype: type,
+        chunk_size: int,
+        compression: int
+        ) -> Iterator[tuple]:
+    """
+    Payloads of `_rasterize_masks` for chunks of `chunk_size` images. Only
+    polygon and mask rows are drawn; within an image, rows are drawn from the
+    largest to the smallest so that small objects stay visible. `pixel_values`
+    has one row of channel values per row of `rows`.
+    """
+    drawn = np.isin(store.kinds[rows], (KIND_SEGMENTATION, KIND_MASK))
+    rows, pixel_values = rows[drawn], pixel_values[drawn]
+    order = np.lexsort((-store.areas[rows], store.image_ids[rows]))
+    rows, pixel_values = rows[order], pixel_values[order]
+    row_offsets = counts_to_offsets(np.bincount(np.searchsorted(image_ids, store.image_ids[rows]), minlength=len(image_ids)))
+
+    vertex_counts = store.vertex_counts()
+    for start in range(0, len(image_ids), chunk_size):
+        end = min(start + chunk_size, len(image_ids))
+        chunk_rows = rows[row_offsets[start]:row_offsets[end]]
+        rles = [store.get_rle(row) for row in chunk_rows[store.kinds[chunk_rows] == KIND_MASK].tolist()]
+        yield (
+            mask_paths[start:end],
+            dimensions[start:end],
+            np.diff(row_offsets[start:end + 1]),
+            store.kinds[chunk_rows],
+            pixel_values[row_offsets[start]:row_offsets[end]],
+            vertex_counts[chunk_rows],
+            store.vertices[store.vertex_indices(chunk_rows)],
+            rles,
+            dtype,
+            compression
+        )
+
+def _rasterize_masks(
+        mask_paths: list[str],
+        dimensions: np.ndarray,
+        row_counts: np.ndarray,
+        kinds: np.ndarray,
+        pixel_values: np.ndarray,
+        vertex_counts: np.ndarray,
+        vertices: np.ndarray,
+        rles: list[dict],
+        dtype: type,
+        compression: int
+        ) -> int:
+    """
+    Draws and writes the masks of a chunk of images. Returns the number of
+    masks written.
+    """
+    row_offsets = counts_to_offsets(row_counts)
+    vertex_offsets = counts_to_offsets(vertex_counts)
+    points = np.round(vertices).astype(np.int32)
+    next_rle = 0
+    for image, (mask_path, (width, height)) in enumerate(zip(mask_paths, dimensions.tolist())):
+        channels = pixel_values.shape[1]
+        mask = np.zeros((height, width, channels) if channels > 1 else (height, width), dtype=dtype)
+        for row in range(row_offsets[image], row_offsets[image + 1]):
+            value = pixel_values[row].tolist() if channels > 1 else int(pixel_values[row, 0])
+            if kinds[row] == KIND_MASK:
+                decoded = decode_rle(rles[next_rle])
+                next_rle += 1
+                if decoded.shape == mask.shape[:2]:
+                    mask[decoded.astype(bool)] = value
+            elif vertex_counts[row] >= 3:
+                cv2.fillPoly(mask, [points[vertex_offsets[row]:vertex_offsets[row + 1]]], value)
+        os.makedirs(os.path.dirname(mask_path), exist_ok=True)
+        cv2.imwrite(mask_path, mask, [cv2.IMWRITE_PNG_COMPRESSION, compression])
+    return len(mask_paths)
+
+def region_polygon(region: np.ndarray) -> Optional[np.ndarray]:
+    """
+    Outer contour of a boolean region cropped to its bbox, in the coordinates
+    of the crop, when filling it gives back exactly the region; None for
+    regions in several parts, regions with holes, whose contour would fill the
+    holes, and some regions a pixel thin, whose contour also encloses pixels
+    of their neighbours. Regions too thin to have a polygon of three vertices
+    get their bbox if it fits them.
+    """
+    contours, _ = cv2.findContours(region.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if len(contours) != 1:
+        return None
+    polygon = contours[0].reshape(-1, 2)
+    height, width = region.shape
+    if len(polygon) < 3:
+        polygon = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]])
+    filled = cv2.fillPoly(np.zeros((height, width), dtype=np.uint8), [polygon.astype(np.int32)], 1)
+    return polygon.astype(np.float32) if np.array_equal(filled.astype(bool), region) else None
+
+def _region_columns(labels: np.ndarray, bboxes: np.ndarray, region_labels: np.ndarray) -> tuple[list, list, list, list]:
+    """
+    `(kinds, vertex_counts, vertices, rles)` of the labelled regions: a
+    polygon when `region_polygon` finds one, and an RLE mask otherwise, so
+    that masks saved from a loaded dataset are identical to the loaded ones.
+    """
+    kinds, vertex_counts, vertices, rles = [], [], [], []
+    for label, (x, y, width, height) in zip(region_labels.tolist(), bboxes.astype(np.int64).tolist()):
+        polygon = region_polygon(labels[y:y + height, x:x + width] == label)
+        if polygon is not None:
+            kinds.append(KIND_SEGMENTATION)
+            vertex_counts.append(len(polygon))
+            vertices.append(polygon + np.array([x, y], dtype=np.float32))
+            rles.append(None)
+        else:
+            kinds.append(KIND_MASK)
+            vertex_counts.append(0)
+            rles.append(mask_utils.encode(np.asfortranarray((labels == label).astype(np.uint8))))
+    return kinds, vertex_counts, vertices, rles
+
+def _semantic_regions(mask: np.ndarray) -> tuple[list, ...]:
+    """
+    Columns of the connected regions of every class of a semantic mask, found
+    with 8-connectivity like the contours. Polygons get the area inside their
+    contour, masks their pixel count.
+    """
+    class_ids, bboxes, areas, kinds, vertex_counts, vertices, rles = [], [], [], [], [], [], []
+    for value in np.flatnonzero(np.bincount(mask.ravel()))[1:].tolist():
+        count, labels, stats, _ = cv2.connectedComponentsWithStats((mask == value).astype(np.uint8), connectivity=8)
+        value_bboxes = stats[1:, :4]
+        value_kinds, value_vertex_counts, value_vertices, value_rles = _region_columns(labels, value_bboxes, np.arange(1, count))
+        polygons = iter(value_vertices)
+        for kind, pixel_count in zip(value_kinds, stats[1:, 4].tolist()):
+            areas.append(max(cv2.contourArea(next(polygons)), 1) if kind == KIND_SEGMENTATION else float(pixel_count))
+        class_ids.extend([value] * (count - 1))
+        bboxes.extend(value_bboxes.tolist())
+        kinds.extend(value_kinds)
+        vertex_counts.extend(value_vertex_counts)
+        vertices.extend(value_vertices)
+        rles.extend(value_rles)
+    if not class_ids:
+        return [], [], [], [], [], [], []
+    return (
+        [np.array(class_ids, dtype=np.int64)],
+        [np.array(bboxes, dtype=np.float64)],
+        [np.array(areas, dtype=np.float64)],
+        [np.array(vertex_counts, dtype=np.int64)],
+        vertices,
+        [np.array(kinds, dtype=np.int8)],
+        rles
+    )
+
+def _instance_regions(mask: np.ndarray) -> tuple[list, ...]:
+    """
+    Columns of the instances of an instance mask, with their pixel count as
+    area whether they become a polygon or an RLE mask.
+    """
+    # Instances are stored in the green and blue channels, classes in the red one (BGR order).
+    instances = mask[:, :, 1].astype(np.int64) << 8 | mask[:, :, 0]
+    ys, xs = np.nonzero(instances)
+    if len(ys) == 0:
+        return [], [], [], [], [], [], []
+    labels = instances[ys, xs]
+    order = np.argsort(labels, kind='stable')
+    ys, xs, labels = ys[order], xs[order], labels[order]
+    starts = np.flatnonzero(np.diff(labels, prepend=-1))
+    x0, y0 = np.minimum.reduceat(xs, starts), np.minimum.reduceat(ys, starts)
+    x1, y1 = np.maximum.reduceat(xs, starts), np.maximum.reduceat(ys, starts)
+    bboxes = np.stack([x0, y0, x1 - x0 + 1, y1 - y0 + 1], axis=1)
+    areas = np.diff(np.append(starts, len(labels)))
+    kinds, vertex_counts, vertices, rles = _region_columns(instances, bboxes, labels[starts])
+    class_ids = mask[ys[starts], xs[starts], 2].astype(np.int64)
+    return (
+        [class_ids],
+        [bboxes],
+        [areas],
+        [np.array(vertex_counts, dtype=np.int64)],
+        vertices,
+        [np.array(kinds, dtype=np.int8)],
+        rles
+    )
+
+def _vectorize_masks(mask_paths: list[str], instance: bool) -> list[Optional[tuple]]:
+    """
+    Reads a chunk of masks and returns, for every mask, its `(width, height)`
+    and the columns of its regions, with one RLE or None per region, or None
+    when it cannot be read.
+    """
+    results = []
+    for mask_path in mask_paths:
+        mask = cv2.imread(mask_path, cv2.IMREAD_UNCHANGED)
+        if mask is None:
+            results.append(None)
+            continue
+        if instance:
+            if mask.ndim != 3:
+                results.append(None)
+                continue
+            columns = _instance_regions(mask)
+        else:
+            columns = _semantic_regions(mask if mask.ndim == 2 else mask[:, :, 0])
+        empty = (np.empty(0, dtype=np.int64), np.empty((0, 4)), np.empty(0), np.empty(0, dtype=np.int64), np.empty((0, 2), dtype=np.float32), np.empty(0, dtype=np.int8))
+        *columns, rles = columns
+        columns = tuple(np.concatenate(column) if column else default for column, default in zip(columns, empty))
+        results.append(((mask.shape[1], mask.shape[0]),) + columns + (rles,))
+    return results
+
+def list_images(images_path: str) -> list[str]:
+    return sorted(
+        entry.name for entry in os.scandir(images_path)
+        if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS
+    )
+
+def vectorize_dataset(
+        images_path: str,
+        masks_path: str,
+        instance: bool,
+        workers: Optional[int] = None,
+        chunk_size: int = 64
+        ) -> tuple[dict[int, str], dict[int, tuple[int, int]], AnnotationStore]:
+    """
+    Reads the mask of every image of `images_path` in a process pool and turns
+    each region into a polygon annotation, or a mask annotation for semantic
+    regions with holes. Images without a mask have no annotations and are
+    probed for their size.
+    """
+    image_names = list_images(images_path)
+    image_id2image_name = dict(enumerate(image_names))
+    image_id2image_dimensions = {}
+    builder = AnnotationStoreBuilder()
+
+    payloads = (
+        ([mask_path_for(masks_path, image_name) for image_name in image_names[start:start + chunk_size]], instance)
+        for start in range(0, len(image_names), chunk_size)
+    )
+    image_id = 0
+    for results in run_in_chunks(_vectorize_masks, payloads, workers):
+        for result in results:
+            if result is None:
+                with Image.open(os.path.join(images_path, image_names[image_id])) as image:
+                    image_id2image_dimensions[image_id] = image.size
+            else:
+                size, class_ids, bboxes, areas, vertex_counts, vertices, kinds, rles = result
+                image_id2image_dimensions[image_id] = size
+                polygons = kinds == KIND_SEGMENTATION
+                builder.add_batch(
+                    annotation_ids = np.arange(len(builder), len(builder) + int(polygons.sum()), dtype=np.int64),
+                    image_ids = image_id,
+                    class_ids = class_ids[polygons],
+                    bboxes = bboxes[polygons],
+                    areas = areas[polygons],
+                    kinds = kinds[polygons],
+                    vertex_counts = vertex_counts[polygons],
+                    vertices = vertices
+                )
+                for row in np.flatnonzero(~polygons).tolist():
+                    builder.add(len(builder), image_id, class_ids[row], *bboxes[row].tolist(), areas[row], kind=KIND_MASK, rle=rles[row])
+            image_id += 1
+    return image_id2image_name, image_id2image_dimensions, builder.build()
@@ -0,0 +1,226 @@
+from dataclasses import dataclass
+from typing import Iterable, Optional, Union
+
+import cv2
+import numpy as np
+
+from annotation_store import AnnotationStore, KIND_CLASSIFICATION, KIND_DETECTION, KIND_MASK, KIND_SEGMENTATION, counts_to_offsets
+from dataset_view import DatasetView
+from image_cache import ImageCache
+from rle import decode_rle_region
+
+DEFAULT_MASK_CACHE_BYTES = 256 * 1024 * 1024
+
+@dataclass
+class CroppedMasks:
+    """
+    Masks of the annotations of one image, each cropped to the integer extent
+    `(x, y, width, height)` of its bbox. Mask `k` is the `(height, width)`
+    uint8 array `data[offsets[k]:offsets[k + 1]]`, so all masks share a single
+    buffer of the size of their extents.
+    """
+    annotation_ids: np.ndarray
+    boxes: np.ndarray
+    data: np.ndarray
+    offsets: np.ndarray
+
+    def __len__(self):
+        return len(self.annotation_ids)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        _, _, width, height = self.boxes[index].tolist()
+        return self.data[self.offsets[index]:self.offsets[index + 1]].reshape(height, width)
+
+    @property
+    def nbytes(self) -> int:
+        return self.annotation_ids.nbytes + self.boxes.nbytes + self.data.nbytes + self.offsets.nbytes
+
+    def setflags(self, write: bool) -> None:
+        for array in (self.annotation_ids, self.boxes, self.data, self.offsets):
+            array.setflags(write=write)
+
+    def full_mask(self, index: int, image_dimensions: tuple[int, int]) -> np.ndarray:
+        """
+        Mask `index` pasted into a zero mask of the whole image.
+        """
+        width, height = image_dimensions
+        mask = np.zeros((height, width), dtype=np.uint8)
+        x, y, box_width, box_height = self.boxes[index].tolist()
+        mask[y:y + box_height, x:x + box_width] = self[index]
+        return mask
+
+def mask_columns(store: AnnotationStore, rows: np.ndarray) -> tuple:
+    """
+    Everything the rasterization functions need from the given rows, as plain
+    arrays. Classification rows have no extent and are dropped.
+    """
+    rows = rows[store.kinds[rows] != KIND_CLASSIFICATION]
+    return (
+        rows,
+        store.kinds[rows],
+        store.bboxes[rows],
+        store.areas[rows],
+        store.vertex_counts()[rows],
+        store.vertices[store.vertex_indices(rows)],
+        {row: store.get_rle(row) for row in rows[store.kinds[rows] == KIND_MASK].tolist()}
+    )
+
+def mask_boxes(bboxes: np.ndarray, image_dimensions: tuple[int, int]) -> np.ndarray:
+    """
+    Integer `(x, y, width, height)` extents covering the given bboxes and the
+    pixels of their rounded polygons, clipped to the image.
+    """
+    width, height = image_dimensions
+    starts = np.floor(bboxes[:, :2])
+    ends = np.floor(bboxes[:, :2] + bboxes[:, 2:] + 0.5) + 1
+    starts = np.clip(starts, 0, (width, height)).astype(np.int64)
+    ends = np.clip(ends, 0, (width, height)).astype(np.int64)
+    return np.concatenate([starts, np.maximum(ends - starts, 0)], axis=1)
+
+def _draw(target: np.ndarray, origin: tuple[int, int], kind: int, bbox: np.ndarray, polygon: np.ndarray, rle: Optional[dict], value: int) -> None:
+    """
+    Draws one annotation into `target`, whose top-left pixel is `origin` in
+    image coordinates.
+    """
+    x0, y0 = origin
+    if kind == KIND_DETECTION:
+        x, y, width, height = bbox.tolist()
+        target[max(int(y) - y0, 0):max(int(y + height) - y0, 0), max(int(x) - x0, 0):max(int(x + width) - x0, 0)] = value
+    elif kind == KIND_SEGMENTATION:
+        if len(polygon) >= 3:
+            cv2.fillPoly(target, [polygon - np.array([x0, y0], dtype=np.int32)], value)
+    elif kind == KIND_MASK and rle is not None:
+        # Only the extent of `target` is decoded, never the full image.
+        region = decode_rle_region(rle, x0, y0, x0 + target.shape[1], y0 + target.shape[0])
+        target[:region.shape[0], :region.shape[1]][region.astype(bool)] = value
+
+def rasterize_map(columns: tuple, image_dimensions: tuple[int, int], values: np.ndarray, dtype: type = np.int32, background: int = 0) -> np.ndarray:
+    """
+    Draws the given annotations into one `(height, width)` map, writing
+    `values[k]` for annotation `k`. Annotations are drawn from the largest to
+    the smallest so that small objects stay visible. Every polygon is filled
+    with its own `fillPoly` call: a single call fills with the even-odd rule,
+    which would leave the overlap of two annotations unpainted.
+    """
+    rows, kinds, bboxes, areas, vertex_counts, vertices, rles = columns
+    width, height = image_dimensions
+    label_map = np.full((height, width), background, dtype=dtype)
+    vertex_offsets = counts_to_offsets(vertex_counts)
+    points = np.round(vertices).astype(np.int32)
+
+    for index in np.argsort(-areas, kind='stable').tolist():
+        polygon = points[vertex_offsets[index]:vertex_offsets[index + 1]]
+        _draw(label_map, (0, 0), kinds[index], bboxes[index], polygon, rles.get(int(rows[index])), int(values[index]))
+    return label_map
+
+def rasterize_stack(columns: tuple, image_dimensions: tuple[int, int]) -> np.ndarray:
+    """
+    `(N, height, width)` uint8 stack with the binary mask of every annotation,
+    allocated at once.
+    """
+    rows, kinds, bboxes, _, vertex_counts, vertices, rles = columns
+    width, height = image_dimensions
+    stack = np.zeros((len(rows), height, width), dtype=np.uint8)
+    vertex_offsets = counts_to_offsets(vertex_counts)
+    points = np.round(vertices).astype(np.int32)
+    for index, row in enumerate(rows.tolist()):
+        polygon = points[vertex_offsets[index]:vertex_offsets[index + 1]]
+        _draw(stack[index], (0, 0), kinds[index], bboxes[index], polygon, rles.get(row), 1)
+    return stack
+
+def rasterize_cropped(columns: tuple, image_dimensions: tuple[int, int], annotation_ids: np.ndarray) -> CroppedMasks:
+    """
+    Binary mask of every annotation cropped to its extent. Only the extents
+    are allocated, in one buffer.
+    """
+    rows, kinds, bboxes, _, vertex_counts, vertices, rles = columns
+    boxes = mask_boxes(bboxes, image_dimensions)
+    offsets = counts_to_offsets(boxes[:, 2] * boxes[:, 3])
+    data = np.zeros(offsets[-1], dtype=np.uint8)
+    vertex_offsets = counts_to_offsets(vertex_counts)
+    points = np.round(vertices).astype(np.int32)
+    for index, (row, (x, y, width, height)) in enumerate(zip(rows.tolist(), boxes.tolist())):
+        target = data[offsets[index]:offsets[index + 1]].reshape(height, width)
+        if target.size > 0:
+            polygon = points[vertex_offsets[index]:vertex_offsets[index + 1]]
+            _draw(target, (x, y), kinds[index], bboxes[index], polygon, rles.get(row), 1)
+    return CroppedMasks(annotation_ids, boxes, data, offsets)
+
+class MaskEngine:
+    """
+    Per-image masks of a dataset, or of a view of one, drawn in a single pass
+    over the annotation columns of the image instead of one full-image array
+    per annotation. Results are kept in a cache bounded in bytes, keyed by the
+    store version so that edits of the annotations are followed. Returned
+    arrays are shared with the cache and read-only.
+    """
+    def __init__(self, dataset, cache: Optional[ImageCache] = None):
+        self.dataset = dataset
+        self.source = dataset.dataset if isinstance(dataset, DatasetView) else dataset
+        self.cache = cache if cache is not None else ImageCache(DEFAULT_MASK_CACHE_BYTES)
+
+    def _class_filter(self, classes: Optional[Iterable[Union[int, str]]]) -> Optional[tuple[int, ...]]:
+        if classes is None:
+            return None
+        return tuple(sorted({self.source.class2id[value] if isinstance(value, str) else int(value) for value in classes}))
+
+    def rows(self, image_id: int, classes: Optional[Iterable[Union[int, str]]] = None) -> np.ndarray:
+        """
+        Store rows of the annotations of an image that have an extent, in the
+        order used by `instance_map`, `instance_masks` and `cropped_masks`.
+        """
+        store = self.source.annotation_store
+        rows = store.rows_for_image(image_id)
+        if isinstance(self.dataset, DatasetView):
+            rows = rows[np.isin(rows, self.dataset.annotation_rows)]
+        class_filter = self._class_filter(classes)
+        if class_filter is not None:
+            rows = rows[np.isin(store.class_ids[rows], class_filter)]
+        return rows[store.kinds[rows] != KIND_CLASSIFICATION]
+
+    def annotation_ids(self, image_id: int, classes: Optional[Iterable[Union[int, str]]] = None) -> np.ndarray:
+        return self.source.annotation_store.annotation_ids[self.rows(image_id, classes)]
+
+    def _cached(self, mode: str, image_id: int, classes, build):
+        store = self.source.annotation_store
+        key = ('masks', mode, image_id, self._class_filter(classes), id(store), store.version)
+        return self.cache.get(key, lambda: build(mask_columns(store, self.rows(image_id, classes)), self.source.image_id2image_dimensions[image_id]))
+
+    def class_map(self, image_id: int, classes: Optional[Iterable[Union[int, str]]] = None, background: int = -1) -> np.ndarray:
+        """
+        `(height, width)` int32 map of the class id of every pixel, with
+        `background` where there is no annotation.
+        """
+        store = self.source.annotation_store
+        return self._cached(
+            f'classes:{background}', image_id, classes,
+            lambda columns, dimensions: rasterize_map(columns, dimensions, store.class_ids[columns[0]], background=background)
+        )
+
+    def instance_map(self, image_id: int, classes: Optional[Iterable[Union[int, str]]] = None) -> np.ndarray:
+        """
+        `(height, width)` int32 map where pixel value `k + 1` belongs to the
+        `k`-th annotation of `annotation_ids(image_id, classes)` and 0 is the
+        background.
+        """
+        return self._cached(
+            'instances', image_id, classes,
+            lambda columns, dimensions: rasterize_map(columns, dimensions, np.arange(1, len(columns[0]) + 1))
+        )
+
+    def instance_masks(self, image_id: int, classes: Optional[Iterable[Union[int, str]]] = None) -> np.ndarray:
+        """
+        `(N, height, width)` uint8 stack with one binary mask per annotation,
+        in the order of `annotation_ids(image_id, classes)`.
+        """
+        return self._cached('stack', image_id, classes, rasterize_stack)
+
+    def cropped_masks(self, image_id: int, classes: Optional[Iterable[Union[int, str]]] = None) -> CroppedMasks:
+        """
+        Binary mask of every annotation, allocated only over its bbox.
+        """
+        store = self.source.annotation_store
+        return self._cached(
+            'cropped', image_id, classes,
+            lambda columns, dimensions: rasterize_cropped(columns, dimensions, store.annotation_ids[columns[0]])
+        )
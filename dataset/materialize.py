@@ -0,0 +1,189 @@
+import os
+import shutil
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional, Union
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from dataset import Dataset
+from dataset_view import DatasetView
+from index_cache import file_signature
+from snapshot import read_snapshot, write_snapshot
+
+FILE_MODES = ('copy', 'reflink', 'hardlink', 'symlink')
+INDEX_FILE_NAME = '.dataset.snapshot'
+# ioctl request that clones the blocks of a file (Linux, btrfs/XFS/...).
+FICLONE = 0x40049409
+
+def reflink(source: str, destination: str) -> None:
+    """
+    Clones `source` into `destination` so that both share their blocks until
+    one is modified. Falls back to a copy where the file system cannot clone.
+    """
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as reader, open(destination, 'wb') as writer:
+                fcntl.ioctl(writer.fileno(), FICLONE, reader.fileno())
+            shutil.copystat(source, destination)
+            return
+        except OSError:
+            pass
+    shutil.copy2(source, destination)
+
+def is_same_file(source: str, destination: str, mode: str) -> bool:
+    """
+    Whether `destination` already holds `source` as placed by `mode`: the same
+    link target, the same inode, or a regular file with the same size and
+    modification time.
+    """
+    if not os.path.lexists(destination):
+        return False
+    if mode == 'symlink':
+        return os.path.islink(destination) and os.readlink(destination) == source
+    if mode == 'hardlink':
+        return os.path.exists(destination) and os.path.samefile(source, destination)
+    return not os.path.islink(destination) and file_signature(source) == file_signature(destination)
+
+def link_or_copy(source: str, destination: str, mode: str) -> bool:
+    """
+    Places `source` at `destination` with a copy, a reflink, a hardlink or a
+    symlink. Copies are written next to the destination and moved in place,
+    so an interrupted run never leaves a half-written file. Returns False when
+    the destination already held the same file and was left untouched.
+    """
+    if mode not in FILE_MODES:
+        raise ValueError(f"Unknown file mode {mode!r}, expected one of {FILE_MODES}")
+    if is_same_file(source, destination, mode):
+        return False
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    if mode in ('copy', 'reflink'):
+        temporary_path = destination + '.tmp'
+        if mode == 'copy':
+            shutil.copy2(source, temporary_path)
+        else:
+            reflink(source, temporary_path)
+        os.replace(temporary_path, destination)
+        return True
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if mode == 'symlink':
+        os.symlink(source, destination)
+    else:
+        os.link(source, destination)
+    return True
+
+def _place_files(tasks: list[tuple[str, str]], mode: str) -> list[Optional[bool]]:
+    """
+    Places every `(source, destination)` pair and returns, for every pair,
+    whether it was written, or None when it failed.
+    """
+    results = []
+    for source, destination in tasks:
+        try:
+            results.append(link_or_copy(source, destination, mode))
+        except OSError:
+            results.append(None)
+    return results
+
+@dataclass
+class MaterializeReport:
+    placed: int = 0
+    skipped: int = 0
+    failed: list[int] = field(default_factory=list)
+
+class DatasetMaterializer:
+    """
+    Copies a dataset, or a view of one, to `destination_path`: the image files
+    are placed in a thread pool with `mode` (see `FILE_MODES`), skipping those
+    already there, and the annotations are written next to them as a
+    snapshot. The returned dataset memory-maps that snapshot copy-on-write, so
+    it costs no annotation memory until it is edited and edits never reach
+    the source.
+
+    Hardlinks and symlinks share the image files with the source; the crop
+    methods replace files instead of writing into them, so cropping the copy
+    leaves the source images untouched.
+    """
+    def __init__(self,
+                dataset: Union[Dataset, DatasetView],
+                destination_path: str,
+                mode: str = 'copy',
+                workers: Optional[int] = None,
+                chunk_size: int = 256,
+                progress: Optional[Callable[[int, int], None]] = None
+                ):
+        if mode not in FILE_MODES:
+            raise ValueError(f"Unknown file mode {mode!r}, expected one of {FILE_MODES}")
+        self.dataset = dataset
+        self.source = dataset.dataset if isinstance(dataset, DatasetView) else dataset
+        self.destination_path = destination_path
+        self.mode = mode
+        # Placing files mostly waits on the disk, so more threads than cores help.
+        self.workers = workers or min(32, 4 * (os.cpu_count() or 1))
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.index_path = os.path.join(destination_path, INDEX_FILE_NAME)
+
+    def place_images(self) -> MaterializeReport:
+        """
+        Places the image files and calls `progress(done, total)` after every
+        chunk. Images that could not be placed are listed in the report.
+        """
+        source_path = os.path.abspath(self.source.data_path)
+        destination_path = os.path.abspath(self.destination_path)
+        image_ids = list(self.dataset.image_id2image_name.keys())
+        chunks = [image_ids[start:start + self.chunk_size] for start in range(0, len(image_ids), self.chunk_size)]
+        report = MaterializeReport()
+        if source_path == destination_path:
+            report.skipped = len(image_ids)
+            return report
+
+        os.makedirs(destination_path, exist_ok=True)
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            in_flight = deque()
+            next_chunk = 0
+            while next_chunk < len(chunks) or in_flight:
+                while next_chunk < len(chunks) and len(in_flight) < 2 * self.workers:
+                    chunk = chunks[next_chunk]
+                    image_names = [self.source.image_id2image_name[image_id] for image_id in chunk]
+                    tasks = [(os.path.join(source_path, image_name), os.path.join(destination_path, image_name)) for image_name in image_names]
+                    in_flight.append((chunk, executor.submit(_place_files, tasks, self.mode)))
+                    next_chunk += 1
+
+                chunk, future = in_flight.popleft()
+                for image_id, placed in zip(chunk, future.result()):
+                    if placed is None:
+                        report.failed.append(image_id)
+                    elif placed:
+                        report.placed += 1
+                    else:
+                        report.skipped += 1
+                done += len(chunk)
+                if self.progress is not None:
+                    self.progress(done, len(image_ids))
+        return report
+
+    def write_index(self) -> None:
+        """
+        Writes the annotations and image table of the dataset or view as a
+        snapshot pointing at `destination_path`.
+        """
+        dataset = self.dataset.materialize() if isinstance(self.dataset, DatasetView) else self.dataset
+        os.makedirs(self.destination_path, exist_ok=True)
+        write_snapshot(self.index_path, dataset, data_path=os.path.abspath(self.destination_path))
+
+    def run(self) -> tuple[Dataset, MaterializeReport]:
+        """
+        Places the images, writes the index and opens the copy.
+        """
+        report = self.place_images()
+        self.write_index()
+        dataset, _ = read_snapshot(self.index_path)
+        return dataset, report
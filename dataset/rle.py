@@ -0,0 +1,121 @@
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from pycocotools import mask as mask_utils
+
+from image_cache import ImageCache
+
+DECODED_MASK_CACHE_BYTES = 256 * 1024 * 1024
+POLYGON_CACHE_SIZE = 256
+# Past one byte of RLE string per this many pixels, decoding the full mask
+# and slicing it is faster than decoding a region from the runs.
+FULL_DECODE_PIXELS_PER_BYTE = 32
+
+# Bounded in bytes rather than in masks, since a full-resolution mask of a
+# large image weighs tens of megabytes.
+decoded_mask_cache = ImageCache(DECODED_MASK_CACHE_BYTES)
+
+def compress_rle(segmentation: dict) -> dict:
+    """
+    Returns the compressed form `{'size': [height, width], 'counts': bytes}` of a
+    COCO RLE segmentation, which may have either compressed or list counts.
+    The mask is never decoded.
+    """
+    height, width = segmentation['size']
+    counts = segmentation['counts']
+    if isinstance(counts, list):
+        return mask_utils.frPyObjects(segmentation, height, width)
+    if isinstance(counts, str):
+        counts = counts.encode('ascii')
+    return {'size': [height, width], 'counts': counts}
+
+def rle_bbox(rle: dict) -> list[float]:
+    return mask_utils.toBbox(rle).tolist()
+
+def rle_area(rle: dict) -> float:
+    return float(mask_utils.area(rle))
+
+def _decode(counts: bytes, height: int, width: int) -> np.ndarray:
+    return decoded_mask_cache.get(
+        (counts, height, width),
+        lambda: mask_utils.decode({'size': [height, width], 'counts': counts})
+    )
+
+def decode_rle(rle: dict) -> np.ndarray:
+    """
+    Decodes a compressed RLE to a `(height, width)` uint8 mask. Decoded masks are
+    kept in an LRU cache bounded in bytes and returned read-only; copy them
+    before modifying.
+    """
+    height, width = rle['size']
+    return _decode(rle['counts'], int(height), int(width))
+
+@lru_cache(maxsize=POLYGON_CACHE_SIZE)
+def _polygons(counts: bytes, height: int, width: int) -> tuple[np.ndarray, ...]:
+    contours, _ = cv2.findContours(
+        np.ascontiguousarray(_decode(counts, height, width)), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE
+    )
+    polygons = []
+    for contour in contours:
+        polygon = contour.reshape(-1, 2).astype(np.float32)
+        polygon.setflags(write=False)
+        polygons.append(polygon)
+    return tuple(polygons)
+
+def rle_to_polygons(rle: dict) -> list[np.ndarray]:
+    """
+    Polygonizes a compressed RLE. Each contour is returned as its own
+    `(N, 2)` float32 array of x, y vertices.
+    """
+    height, width = rle['size']
+    return list(_polygons(rle['counts'], int(height), int(width)))
+
+def _run_lengths(counts: bytes) -> np.ndarray:
+    """
+    Run lengths of a compressed COCO RLE string, alternating between zeros and
+    ones and starting with zeros (the inverse of the encoding in maskApi.c),
+    decoded for all runs at once.
+    """
+    chars = np.frombuffer(counts, dtype=np.uint8).astype(np.int64) - 48
+    # Every value is a little-endian run of 5-bit groups; the 0x20 bit marks
+    # that more groups follow, and the 0x10 bit of the last one is the sign.
+    ends = np.flatnonzero((chars & 0x20) == 0)
+    if len(ends) == 0:
+        return np.empty(0, dtype=np.int64)
+    chars = chars[:ends[-1] + 1]
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    group_counts = ends - starts + 1
+    shifts = 5 * (np.arange(len(chars)) - np.repeat(starts, group_counts))
+    values = np.add.reduceat((chars & 0x1f) << shifts, starts)
+    negative = (chars[ends] & 0x10) != 0
+    values[negative] -= np.left_shift(1, 5 * group_counts[negative])
+    # From the fourth value on, values are stored as differences with the
+    # value two places before, i.e. separate running sums of the odd and of
+    # the even positions from the second value on.
+    values[1::2] = np.cumsum(values[1::2])
+    values[2::2] = np.cumsum(values[2::2])
+    return values
+
+def decode_rle_region(rle: dict, left: int, top: int, right: int, bottom: int) -> np.ndarray:
+    """
+    Decodes only the `[top:bottom, left:right]` region of a compressed RLE, so
+    that a small object of a large image never allocates a full-image mask.
+    Masks with many runs, e.g. noisy masks, are decoded in full and sliced
+    instead. Unlike `decode_rle`, the result is not cached and is writable.
+    """
+    height, width = (int(size) for size in rle['size'])
+    left, top = min(max(int(left), 0), width), min(max(int(top), 0), height)
+    right, bottom = min(max(int(right), left), width), min(max(int(bottom), top), height)
+    if (left, top, right, bottom) == (0, 0, width, height):
+        return decode_rle(rle).copy()
+    counts = rle['counts'].encode('ascii') if isinstance(rle['counts'], str) else rle['counts']
+    if len(counts) * FULL_DECODE_PIXELS_PER_BYTE > height * width:
+        return mask_utils.decode({'size': [height, width], 'counts': counts})[top:bottom, left:right].copy()
+    # Pixel i (column-major) is set when an odd number of run boundaries are <= i.
+    boundaries = np.cumsum(_run_lengths(counts))[:-1]
+    indices = np.arange(left, right, dtype=np.int64)[np.newaxis, :] * height + np.arange(top, bottom, dtype=np.int64)[:, np.newaxis]
+    return (np.searchsorted(boundaries, indices, side='right') % 2).astype(np.uint8)
+
+def crop_rle(rle: dict, left: int, top: int, right: int, bottom: int) -> dict:
+    return mask_utils.encode(np.asfortranarray(decode_rle_region(rle, left, top, right, bottom)))
@@ -1,10 +1,86 @@
+import os
+import yaml
+from typing import Optional, Union
+
+import numpy as np
+
 from dataset import Dataset
+from dataset_view import DatasetView
+from mask_rasterization import _rasterize_masks, class_values, mask_path_for, rasterize_chunks, run_in_chunks, vectorize_dataset
+
+CLASSES_FILE_NAME = 'classes.yaml'
+
+def selected_rows(dataset: Union[Dataset, DatasetView]) -> tuple[Dataset, np.ndarray, np.ndarray]:
+    """
+    `(dataset, rows, image_ids)` of a dataset or of a view of one.
+    """
+    if isinstance(dataset, DatasetView):
+        return dataset.dataset, dataset.annotation_rows, dataset.image_ids
+    image_ids = np.sort(np.fromiter(dataset.image_id2image_name.keys(), dtype=np.int64, count=len(dataset.image_id2image_name)))
+    return dataset, np.flatnonzero(np.isin(dataset.annotation_store.image_ids, image_ids)), image_ids
+
+def load_class_names(masks_path: str) -> dict[int, str]:
+    classes_path = os.path.join(masks_path, CLASSES_FILE_NAME)
+    if not os.path.exists(classes_path):
+        return {}
+    with open(classes_path, 'r') as reader:
+        return {int(value): name for value, name in (yaml.safe_load(reader) or {}).items()}
 
 class SemanticMasksAdapter:
+    """
+    One single-channel PNG per image in `masks_path`, named after the image,
+    where every pixel holds the value of its class and 0 is the background.
+    The class of every value is kept in `classes.yaml`.
+    """
     @staticmethod
-    def load(images_path: str, masks_path: str) -> Dataset:
-        pass
+    def load(images_path: str, masks_path: str, workers: Optional[int] = None, chunk_size: int = 64) -> Dataset:
+        """
+        Turns every connected region of each class into a polygon annotation,
+        or into a mask annotation when its polygon would not give back its
+        exact pixels (e.g. a region with holes). Masks are read and vectorized
+        in chunks of images by `workers` processes.
+        """
+        image_id2image_name, image_id2image_dimensions, annotation_store = vectorize_dataset(images_path, masks_path, False, workers, chunk_size)
+        id2class = load_class_names(masks_path)
+        for value in np.unique(annotation_store.class_ids).tolist():
+            id2class.setdefault(value, str(value))
+
+        return Dataset.from_annotation_store(
+            id2class = id2class,
+            data_path = images_path,
+            image_id2image_name = image_id2image_name,
+            image_id2image_dimensions = image_id2image_dimensions,
+            annotation_store = annotation_store
+        )
 
     @staticmethod
-    def save(dataset: Dataset, masks_path: str) -> None:
-        pass
\ No newline at end of file
+    def save(dataset: Union[Dataset, DatasetView], masks_path: str, workers: Optional[int] = None, chunk_size: int = 64, compression: int = 3) -> None:
+        """
+        Rasterizes the polygons and masks of every image with `cv2.fillPoly` in
+        `workers` processes, `chunk_size` images at a time, and writes them as
+        PNG files (8 bits, or 16 when a class value is above 255). Boxes and
+        classification annotations are not drawn.
+        """
+        source, rows, image_ids = selected_rows(dataset)
+        store = source.annotation_store
+        values = class_values(source.id2class.keys())
+        rows = rows[np.isin(store.class_ids[rows], np.fromiter(values.keys(), dtype=np.int64, count=len(values)))]
+        pixel_values = np.array([values[class_id] for class_id in store.class_ids[rows].tolist()], dtype=np.int64).reshape(-1, 1)
+
+        os.makedirs(masks_path, exist_ok=True)
+        with open(os.path.join(masks_path, CLASSES_FILE_NAME), 'w') as writer:
+            yaml.safe_dump({value: source.id2class[class_id] for class_id, value in values.items()}, writer)
+
+        payloads = rasterize_chunks(
+            store,
+            rows,
+            pixel_values,
+            image_ids,
+            [mask_path_for(masks_path, source.image_id2image_name[image_id]) for image_id in image_ids.tolist()],
+            np.array([source.image_id2image_dimensions[image_id] for image_id in image_ids.tolist()], dtype=np.int64).reshape(-1, 2),
+            np.uint8 if max(values.values(), default=0) <= 255 else np.uint16,
+            chunk_size,
+            compression
+        )
+        for _ in run_in_chunks(_rasterize_masks, payloads, workers):
+            pass
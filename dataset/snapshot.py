@@ -0,0 +1,185 @@
+import os
+import json
+from collections.abc import MutableMapping
+from typing import Callable
+
+import numpy as np
+
+from dataset import Dataset
+from annotation_store import AnnotationStore, counts_to_offsets
+
+SNAPSHOT_MAGIC = b'DRDSNAP1'
+SNAPSHOT_VERSION = 1
+ALIGNMENT = 64
+
+class ArrayBackedMapping(MutableMapping):
+    """
+    `image_id -> value` mapping read straight from arrays (possibly memory-mapped),
+    so that opening a snapshot does not build a dict per image. It turns into a
+    plain dict the first time it is modified.
+    """
+    def __init__(self, keys: np.ndarray, key_order: np.ndarray, get_value: Callable[[int], object]):
+        self.keys_array = keys
+        self.key_order = key_order
+        self.get_value = get_value
+        self._dict = None
+
+    def _position(self, key) -> int:
+        sorted_position = np.searchsorted(self.keys_array, key, sorter=self.key_order)
+        if sorted_position >= len(self.keys_array):
+            return -1
+        position = int(self.key_order[sorted_position])
+        return position if self.keys_array[position] == key else -1
+
+    def _materialize(self) -> dict:
+        if self._dict is None:
+            self._dict = {key: self.get_value(position) for position, key in enumerate(self.keys_array.tolist())}
+        return self._dict
+
+    def __getitem__(self, key):
+        if self._dict is not None:
+            return self._dict[key]
+        position = self._position(key)
+        if position < 0:
+            raise KeyError(key)
+        return self.get_value(position)
+
+    def __contains__(self, key) -> bool:
+        if self._dict is not None:
+            return key in self._dict
+        return self._position(key) >= 0
+
+    def __setitem__(self, key, value) -> None:
+        self._materialize()[key] = value
+
+    def __delitem__(self, key) -> None:
+        del self._materialize()[key]
+
+    def __iter__(self):
+        if self._dict is not None:
+            return iter(self._dict)
+        return iter(self.keys_array.tolist())
+
+    def __len__(self):
+        if self._dict is not None:
+            return len(self._dict)
+        return len(self.keys_array)
+
+def write_snapshot(path: str, dataset: Dataset, extra_arrays: dict[str, np.ndarray] = None, data_path: str = None) -> None:
+    """
+    Writes a dataset as a single file: a JSON header followed by raw, 64-byte
+    aligned arrays for the image table, every annotation store column and the
+    store lookup tables. The file is replaced atomically. `data_path`
+    overrides the image directory recorded in the header.
+    """
+    image_ids = np.fromiter(dataset.image_id2image_name.keys(), dtype=np.int64, count=len(dataset))
+    encoded_names = [dataset.image_id2image_name[image_id].encode('utf-8') for image_id in image_ids.tolist()]
+    arrays = {
+        'image_ids': image_ids,
+        'image_id_order': np.argsort(image_ids, kind='stable'),
+        'image_dimensions': np.array(
+            [dataset.image_id2image_dimensions[image_id] for image_id in image_ids.tolist()], dtype=np.int64
+        ).reshape(-1, 2),
+        'image_name_offsets': counts_to_offsets(np.fromiter(map(len, encoded_names), dtype=np.int64, count=len(encoded_names))),
+        'image_name_bytes': np.frombuffer(b''.join(encoded_names), dtype=np.uint8)
+    }
+    store = dataset.annotation_store
+    arrays.update({f'store_{name}': column for name, column in store.columns().items()})
+    arrays.update({f'index_{name}': column for name, column in store.lookup_tables().items()})
+    arrays.update({f'extra_{name}': np.asarray(value) for name, value in (extra_arrays or {}).items()})
+
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[name] = array
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header = json.dumps({
+        'version': SNAPSHOT_VERSION,
+        'data_path': data_path or dataset.data_path,
+        'id2class': [[class_id, name] for class_id, name in dataset.id2class.items()],
+        'arrays': layout
+    }).encode('utf-8')
+    data_start = -(-(len(SNAPSHOT_MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temporary_path, 'wb') as writer:
+            writer.write(SNAPSHOT_MAGIC)
+            writer.write(len(header).to_bytes(8, 'little'))
+            writer.write(header)
+            for name, array in arrays.items():
+                writer.seek(data_start + layout[name]['offset'])
+                writer.write(array.tobytes())
+            writer.truncate(data_start + offset)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+def read_snapshot(path: str) -> tuple[Dataset, dict[str, np.ndarray]]:
+    """
+    Opens a file written by `write_snapshot`. Arrays are memory-mapped
+    copy-on-write: processes opening the same file share its pages, and edits
+    only touch private copies of the modified pages. Nothing proportional to
+    the dataset size is read at open time.
+    """
+    with open(path, 'rb') as reader:
+        if reader.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a dataset snapshot")
+        header_length = int.from_bytes(reader.read(8), 'little')
+        header = json.loads(reader.read(header_length).decode('utf-8'))
+    if header['version'] != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {header['version']}")
+    data_start = -(-(len(SNAPSHOT_MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+
+    arrays = {}
+    for name, info in header['arrays'].items():
+        dtype = np.dtype(info['dtype'])
+        shape = tuple(info['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='c', offset=data_start + info['offset'], shape=shape)
+
+    image_ids = arrays['image_ids']
+    image_id_order = arrays['image_id_order']
+    image_dimensions = arrays['image_dimensions']
+    name_offsets = arrays['image_name_offsets']
+    name_bytes = arrays['image_name_bytes']
+
+    store = AnnotationStore(**{name[len('store_'):]: value for name, value in arrays.items() if name.startswith('store_')})
+    store.restore_lookup_tables({name[len('index_'):]: value for name, value in arrays.items() if name.startswith('index_')})
+
+    dataset = Dataset.from_annotation_store(
+        id2class = {class_id: name for class_id, name in header['id2class']},
+        data_path = header['data_path'],
+        image_id2image_name = ArrayBackedMapping(
+            image_ids, image_id_order,
+            lambda position: name_bytes[name_offsets[position]:name_offsets[position + 1]].tobytes().decode('utf-8')
+        ),
+        image_id2image_dimensions = ArrayBackedMapping(
+            image_ids, image_id_order,
+            lambda position: tuple(image_dimensions[position].tolist())
+        ),
+        annotation_store = store
+    )
+    extra_arrays = {name[len('extra_'):]: value for name, value in arrays.items() if name.startswith('extra_')}
+    return dataset, extra_arrays
+
+class SnapshotAdapter:
+    @staticmethod
+    def load(snapshot_path: str) -> Dataset:
+        """
+        Opens a dataset snapshot in constant time, memory-mapping its arrays.
+        """
+        return read_snapshot(snapshot_path)[0]
+
+    @staticmethod
+    def save(dataset: Dataset, snapshot_path: str) -> None:
+        """
+        Saves a dataset as a single memory-mappable snapshot file.
+        """
+        write_snapshot(snapshot_path, dataset)
@@ -0,0 +1,272 @@
+from typing import Iterable, Optional
+
+import cv2
+import numpy as np
+from pycocotools import mask as mask_utils
+
+from annotation_store import AnnotationStore, KIND_CLASSIFICATION, KIND_DETECTION, KIND_MASK, counts_to_offsets
+from rle import decode_rle
+
+def bbox_corners(bboxes: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    `(x0, y0, x1, y1)` columns of `(N, 4)` x, y, width, height boxes.
+    """
+    x0 = bboxes[:, 0]
+    y0 = bboxes[:, 1]
+    return x0, y0, x0 + np.maximum(bboxes[:, 2], 0), y0 + np.maximum(bboxes[:, 3], 0)
+
+def bbox_iou(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """
+    `(N, M)` IoU matrix between two sets of x, y, width, height boxes.
+    """
+    ax0, ay0, ax1, ay1 = (column[:, None] for column in bbox_corners(np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)))
+    bx0, by0, bx1, by1 = (column[None, :] for column in bbox_corners(np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)))
+    intersection = np.clip(np.minimum(ax1, bx1) - np.maximum(ax0, bx0), 0, None) * np.clip(np.minimum(ay1, by1) - np.maximum(ay0, by0), 0, None)
+    union = (ax1 - ax0) * (ay1 - ay0) + (bx1 - bx0) * (by1 - by0) - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(union > 0, intersection / union, 0.0)
+
+def paired_bbox_iou(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """
+    IoU of `boxes_a[i]` and `boxes_b[i]` for every `i`.
+    """
+    ax0, ay0, ax1, ay1 = bbox_corners(np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4))
+    bx0, by0, bx1, by1 = bbox_corners(np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4))
+    intersection = np.clip(np.minimum(ax1, bx1) - np.maximum(ax0, bx0), 0, None) * np.clip(np.minimum(ay1, by1) - np.maximum(ay0, by0), 0, None)
+    union = (ax1 - ax0) * (ay1 - ay0) + (bx1 - bx0) * (by1 - by0) - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(union > 0, intersection / union, 0.0)
+
+def row_to_rle(store: AnnotationStore, row: int, height: int, width: int) -> dict:
+    """
+    Compressed RLE of the shape of an annotation: its mask, its polygon, or its
+    bbox for detections and polygons with less than three vertices.
+    """
+    kind = store.kinds[row]
+    if kind == KIND_MASK:
+        return store.get_rle(row)
+    vertices = store.get_vertices(row)
+    if kind == KIND_DETECTION or len(vertices) < 3:
+        return mask_utils.frPyObjects(store.bboxes[row:row + 1].astype(np.float64), height, width)[0]
+    return mask_utils.frPyObjects([vertices.astype(np.float64).ravel().tolist()], height, width)[0]
+
+def segmentation_iou(store: AnnotationStore, rows_a: np.ndarray, rows_b: np.ndarray) -> np.ndarray:
+    """
+    IoU of the shapes (masks, polygons or boxes) of the annotations in
+    `rows_a[i]` and `rows_b[i]`, computed on run-length encodings at pixel
+    resolution. Both rows of a pair must belong to the same image.
+    """
+    rows_a = np.asarray(rows_a, dtype=np.int64)
+    rows_b = np.asarray(rows_b, dtype=np.int64)
+    ious = np.zeros(len(rows_a), dtype=np.float64)
+    if len(rows_a) == 0:
+        return ious
+
+    # Every RLE of an image must share one canvas: the mask size when the image
+    # has masks, otherwise the extent of its boxes and polygons.
+    rows = np.unique(np.concatenate([rows_a, rows_b]))
+    image_ids = store.image_ids[rows]
+    _, x1, _, y1 = bbox_corners(store.bboxes[rows])
+    canvases = {}
+    for image_id in np.unique(image_ids).tolist():
+        in_image = image_ids == image_id
+        mask_rows = rows[in_image][store.kinds[rows[in_image]] == KIND_MASK]
+        if len(mask_rows) > 0:
+            canvases[image_id] = tuple(int(side) for side in store.mask_sizes[mask_rows[0]])
+        else:
+            canvases[image_id] = (int(np.ceil(y1[in_image].max())) + 1, int(np.ceil(x1[in_image].max())) + 1)
+
+    rles = {}
+    for row, image_id in zip(rows.tolist(), image_ids.tolist()):
+        rles[row] = row_to_rle(store, row, *canvases[image_id])
+
+    order = np.argsort(rows_a, kind='stable')
+    sorted_a = rows_a[order]
+    starts = np.flatnonzero(np.r_[True, sorted_a[1:] != sorted_a[:-1]])
+    for start, end in zip(starts, np.r_[starts[1:], len(sorted_a)]):
+        positions = order[start:end]
+        targets = [rles[row] for row in rows_b[positions].tolist()]
+        ious[positions] = np.asarray(mask_utils.iou([rles[int(sorted_a[start])]], targets, [0] * len(targets))).reshape(-1)
+    return ious
+
+def ranges(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    Concatenation of `arange(starts[i], ends[i])` for every `i`.
+    """
+    counts = np.maximum(ends - starts, 0)
+    return np.arange(int(counts.sum()), dtype=np.int64) + np.repeat(starts - counts_to_offsets(counts)[:-1], counts)
+
+class SpatialIndex:
+    """
+    Uniform grid over the bboxes of an `AnnotationStore`, built with vectorized
+    passes over the bbox columns. Every bbox is registered in the cells it
+    covers; boxes covering more than `MAX_CELLS_PER_BOX` cells are kept apart
+    and tested directly. Classification annotations have no box and are not
+    indexed. The index describes the store at the time it was built (see
+    `is_current`).
+    """
+    MAX_CELLS_PER_BOX = 64
+
+    def __init__(self, store: AnnotationStore, cell_size: Optional[float] = None):
+        self.store = store
+        self.version = store.version
+
+        rows = np.flatnonzero(store.kinds != KIND_CLASSIFICATION)
+        x0, y0, x1, y1 = bbox_corners(store.bboxes[rows])
+        if cell_size is None:
+            sides = np.maximum(x1 - x0, y1 - y0)
+            cell_size = max(2 * float(np.median(sides)), 1.0) if len(rows) > 0 else 1.0
+        self.cell_size = cell_size
+
+        self.image_keys, image_ranks = np.unique(store.image_ids[rows], return_inverse=True)
+        cx0, cy0, cx1, cy1 = (self._cell(values) for values in (x0, y0, x1, y1))
+        cells_x = cx1 - cx0 + 1
+        cells = cells_x * (cy1 - cy0 + 1)
+        large = cells > self.MAX_CELLS_PER_BOX
+
+        large_order = np.argsort(image_ranks[large], kind='stable')
+        self.large_rows = rows[large][large_order]
+        self.large_image_ranks = image_ranks[large][large_order]
+
+        small = ~large
+        self.grid_width = int(cx1[small].max()) + 1 if small.any() else 1
+        self.grid_height = int(cy1[small].max()) + 1 if small.any() else 1
+        counts = cells[small]
+        owners = np.repeat(np.arange(int(small.sum())), counts)
+        local = np.arange(len(owners)) - np.repeat(counts_to_offsets(counts)[:-1], counts)
+        cell_x = cx0[small][owners] + local % cells_x[small][owners]
+        cell_y = cy0[small][owners] + local // cells_x[small][owners]
+        keys = self._key(image_ranks[small][owners], cell_x, cell_y)
+
+        order = np.argsort(keys, kind='stable')
+        self.cell_keys = keys[order]
+        self.cell_rows = rows[small][owners][order]
+
+    def _cell(self, values: np.ndarray) -> np.ndarray:
+        return np.floor(np.maximum(values, 0) / self.cell_size).astype(np.int64)
+
+    def _key(self, image_ranks: np.ndarray, cell_x: np.ndarray, cell_y: np.ndarray) -> np.ndarray:
+        return (image_ranks * self.grid_height + cell_y) * self.grid_width + cell_x
+
+    def _image_rank(self, image_id: int) -> int:
+        rank = int(np.searchsorted(self.image_keys, image_id))
+        if rank >= len(self.image_keys) or self.image_keys[rank] != image_id:
+            return -1
+        return rank
+
+    def is_current(self, store: AnnotationStore) -> bool:
+        return store is self.store and store.version == self.version
+
+    def query_rect(self, image_id: int, x0: float, y0: float, x1: float, y1: float) -> np.ndarray:
+        """
+        Rows of the annotations of an image whose bbox intersects the
+        rectangle `(x0, y0)`-`(x1, y1)`, sorted.
+        """
+        rank = self._image_rank(image_id)
+        if rank < 0:
+            return np.empty(0, dtype=np.int64)
+
+        cx0, cy0, cx1, cy1 = (int(self._cell(np.array([value]))[0]) for value in (x0, y0, x1, y1))
+        cx1 = min(cx1, self.grid_width - 1)
+        cy1 = min(cy1, self.grid_height - 1)
+        candidates = [self.large_rows[np.searchsorted(self.large_image_ranks, rank):np.searchsorted(self.large_image_ranks, rank, side='right')]]
+        if cx0 <= cx1 and cy0 <= cy1:
+            cell_y = np.arange(cy0, cy1 + 1)
+            starts = np.searchsorted(self.cell_keys, self._key(rank, cx0, cell_y))
+            ends = np.searchsorted(self.cell_keys, self._key(rank, cx1, cell_y), side='right')
+            candidates.append(self.cell_rows[ranges(starts, ends)])
+        candidates = np.unique(np.concatenate(candidates))
+
+        bx0, by0, bx1, by1 = bbox_corners(self.store.bboxes[candidates])
+        hits = (bx0 <= x1) & (bx1 >= x0) & (by0 <= y1) & (by1 >= y0)
+        return candidates[hits]
+
+    def query_point(self, image_id: int, x: float, y: float) -> np.ndarray:
+        return self.query_rect(image_id, x, y, x, y)
+
+    def pick(self, image_id: int, x: float, y: float) -> np.ndarray:
+        """
+        Rows of the annotations under a point, tested against the actual
+        polygon or mask, smallest area first (the order in which a click should
+        select overlapping objects).
+        """
+        store = self.store
+        picked = []
+        for row in self.query_point(image_id, x, y).tolist():
+            kind = store.kinds[row]
+            if kind == KIND_MASK:
+                mask = decode_rle(store.get_rle(row))
+                if not (0 <= int(y) < mask.shape[0] and 0 <= int(x) < mask.shape[1] and mask[int(y), int(x)]):
+                    continue
+            elif kind != KIND_DETECTION:
+                vertices = store.get_vertices(row)
+                if len(vertices) >= 3 and cv2.pointPolygonTest(vertices.reshape(-1, 1, 2), (float(x), float(y)), False) < 0:
+                    continue
+            picked.append(row)
+        picked = np.asarray(picked, dtype=np.int64)
+        return picked[np.argsort(store.areas[picked], kind='stable')]
+
+    def overlapping_pairs(self, image_ids: Iterable[int] = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns `(rows_a, rows_b)`, with `rows_a < rows_b`, for every pair of
+        annotations of the same image whose bboxes intersect. Each pair is
+        reported once: only by the cell holding the top-left corner of the
+        intersection of the two boxes.
+        """
+        store = self.store
+        starts = np.flatnonzero(np.r_[True, self.cell_keys[1:] != self.cell_keys[:-1]]) if len(self.cell_keys) > 0 else np.empty(0, dtype=np.int64)
+        sizes = np.diff(np.r_[starts, len(self.cell_keys)])
+        positions = np.arange(len(self.cell_keys))
+        local = positions - np.repeat(starts, sizes)
+        partners = np.repeat(sizes, sizes) - local - 1
+        first = np.repeat(positions, partners)
+        second = first + 1 + (np.arange(len(first)) - np.repeat(counts_to_offsets(partners)[:-1], partners))
+
+        rows_a = self.cell_rows[first]
+        rows_b = self.cell_rows[second]
+        ax0, ay0, ax1, ay1 = bbox_corners(store.bboxes[rows_a])
+        bx0, by0, bx1, by1 = bbox_corners(store.bboxes[rows_b])
+        intersects = (ax0 <= bx1) & (bx0 <= ax1) & (ay0 <= by1) & (by0 <= ay1)
+        cell_x = self.cell_keys[first] % self.grid_width
+        cell_y = self.cell_keys[first] // self.grid_width % self.grid_height
+        reference = (self._cell(np.maximum(ax0, bx0)) == cell_x) & (self._cell(np.maximum(ay0, by0)) == cell_y)
+        keep = intersects & reference
+        pairs_a = [rows_a[keep]]
+        pairs_b = [rows_b[keep]]
+
+        # Large boxes are tested against every other box of their image.
+        large = np.zeros(len(store), dtype=bool)
+        large[self.large_rows] = True
+        for row in self.large_rows.tolist():
+            others = store.rows_for_image(int(store.image_ids[row]))
+            others = others[(store.kinds[others] != KIND_CLASSIFICATION) & (others != row) & (~large[others] | (others > row))]
+            ox0, oy0, ox1, oy1 = bbox_corners(store.bboxes[others])
+            x0, y0, x1, y1 = (value[0] for value in bbox_corners(store.bboxes[row:row + 1]))
+            others = others[(ox0 <= x1) & (x0 <= ox1) & (oy0 <= y1) & (y0 <= oy1)]
+            pairs_a.append(np.full(len(others), row, dtype=np.int64))
+            pairs_b.append(others)
+
+        pairs_a = np.concatenate(pairs_a)
+        pairs_b = np.concatenate(pairs_b)
+        rows_a = np.minimum(pairs_a, pairs_b)
+        rows_b = np.maximum(pairs_a, pairs_b)
+        if image_ids is not None:
+            selected = np.isin(store.image_ids[rows_a], np.asarray(list(image_ids), dtype=np.int64))
+            rows_a, rows_b = rows_a[selected], rows_b[selected]
+        order = np.lexsort((rows_b, rows_a))
+        return rows_a[order], rows_b[order]
+
+    def overlaps(self, min_iou: float = 0.0, image_ids: Iterable[int] = None, use_segmentation: bool = False) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns `(rows_a, rows_b, ious)` for the overlapping pairs with an IoU
+        above `min_iou`. With `use_segmentation`, the IoU of the masks and
+        polygons is computed instead of the bbox IoU, for every pair whose
+        bboxes intersect.
+        """
+        rows_a, rows_b = self.overlapping_pairs(image_ids)
+        if use_segmentation:
+            ious = segmentation_iou(self.store, rows_a, rows_b)
+        else:
+            ious = paired_bbox_iou(self.store.bboxes[rows_a], self.store.bboxes[rows_b])
+        keep = ious > min_iou
+        return rows_a[keep], rows_b[keep], ious[keep]
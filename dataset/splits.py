@@ -0,0 +1,141 @@
+from typing import Callable, Hashable, Mapping, Optional, Sequence, Union
+
+import numpy as np
+
+from annotation_store import AnnotationStore, counts_to_offsets, ragged_indices
+
+def cut_by_weight(weights: np.ndarray, quotas: np.ndarray) -> np.ndarray:
+    """
+    Assigns consecutive items to bins so that the total weight of bin `i` is
+    close to `quotas[i]`. Each item goes to the bin that holds its midpoint.
+    """
+    quotas = np.asarray(quotas, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    if len(weights) == 0:
+        return np.empty(0, dtype=np.int64)
+    bounds = np.cumsum(quotas) / max(quotas.sum(), 1e-12) * weights.sum()
+    midpoints = np.cumsum(weights) - weights / 2
+    return np.minimum(np.searchsorted(bounds, midpoints, side='right'), len(quotas) - 1)
+
+def group_items(
+        image_ids: np.ndarray,
+        image_id2image_name: Mapping[int, str],
+        groups: Union[Mapping[int, Hashable], Callable[[str], Hashable], None]
+        ) -> np.ndarray:
+    """
+    Index of the group of every image, numbered in order of first appearance.
+    Without `groups`, every image is its own group.
+    """
+    if groups is None:
+        return np.arange(len(image_ids))
+    if callable(groups):
+        keys = (groups(image_id2image_name[image_id]) for image_id in image_ids.tolist())
+    else:
+        keys = (groups.get(image_id, ('image', image_id)) for image_id in image_ids.tolist())
+    key_index: dict[Hashable, int] = {}
+    return np.fromiter((key_index.setdefault(key, len(key_index)) for key in keys), dtype=np.int64, count=len(image_ids))
+
+def item_labels(store: AnnotationStore, image_ids: np.ndarray, item_of_image: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns `(items, labels, weights)`: for every item and every class present
+    in it, the number of its images that contain that class.
+    """
+    in_dataset = np.isin(store.image_ids, image_ids)
+    image_positions = np.searchsorted(image_ids, store.image_ids[in_dataset])
+    classes, labels = np.unique(store.class_ids[in_dataset], return_inverse=True)
+    image_pairs = np.unique(image_positions * len(classes) + labels.reshape(-1))
+    item_pairs, weights = np.unique(item_of_image[image_pairs // max(len(classes), 1)] * len(classes) + image_pairs % max(len(classes), 1), return_counts=True)
+    return item_pairs // max(len(classes), 1), item_pairs % max(len(classes), 1), weights
+
+def stratified_assignment(
+        item_sizes: np.ndarray,
+        pair_items: np.ndarray,
+        pair_labels: np.ndarray,
+        pair_weights: np.ndarray,
+        ratios: np.ndarray,
+        rng: np.random.Generator
+        ) -> np.ndarray:
+    """
+    Iterative stratification (Sechidis et al., 2011) over items with several
+    labels. Labels are processed from the rarest to the most common; the
+    unassigned items carrying a label are shuffled and shared between the
+    splits in proportion to how many of that label each split still needs,
+    and the needs of every other label of those items are updated. Items
+    without labels fill the remaining capacity.
+    """
+    items = len(item_sizes)
+    labels = int(pair_labels.max()) + 1 if len(pair_labels) > 0 else 0
+    label_totals = np.bincount(pair_labels, weights=pair_weights, minlength=labels)
+    desired = ratios[:, None] * label_totals[None, :]
+    capacity = ratios * item_sizes.sum()
+    assignment = np.full(items, -1, dtype=np.int64)
+
+    by_item = np.argsort(pair_items, kind='stable')
+    item_offsets = counts_to_offsets(np.bincount(pair_items, minlength=items))
+    by_label = np.argsort(pair_labels, kind='stable')
+    label_offsets = counts_to_offsets(np.bincount(pair_labels, minlength=labels))
+
+    for label in np.argsort(label_totals, kind='stable').tolist():
+        label_items = pair_items[by_label[label_offsets[label]:label_offsets[label + 1]]]
+        label_items = rng.permutation(label_items[assignment[label_items] < 0])
+        if len(label_items) == 0:
+            continue
+
+        needs = np.clip(desired[:, label], 0, None)
+        if needs.sum() <= 0:
+            needs = np.clip(capacity, 0, None)
+        if needs.sum() <= 0:
+            needs = ratios
+        splits = cut_by_weight(item_sizes[label_items], needs)
+        assignment[label_items] = splits
+
+        pairs = by_item[ragged_indices(item_offsets, label_items)]
+        np.subtract.at(desired, (assignment[pair_items[pairs]], pair_labels[pairs]), pair_weights[pairs])
+        capacity -= np.bincount(splits, weights=item_sizes[label_items], minlength=len(ratios))
+
+    remaining = rng.permutation(np.flatnonzero(assignment < 0))
+    needs = np.clip(capacity, 0, None)
+    assignment[remaining] = cut_by_weight(item_sizes[remaining], needs if needs.sum() > 0 else ratios)
+    return assignment
+
+def split_image_ids(
+        image_ids: np.ndarray,
+        ratios: Sequence[float],
+        seed: Optional[int] = 0,
+        store: Optional[AnnotationStore] = None,
+        image_id2image_name: Optional[Mapping[int, str]] = None,
+        groups: Union[Mapping[int, Hashable], Callable[[str], Hashable], None] = None
+        ) -> list[np.ndarray]:
+    """
+    Splits image ids according to `ratios`. The result is deterministic for a
+    given `seed`. With `store`, the splits are stratified by the classes
+    present in each image; with `groups` (an `image_id -> key` mapping, or a
+    function of the image name), images with the same key always land in the
+    same split.
+
+    The splits are returned as sorted slices of a single array, so they take
+    no more memory than the list of image ids itself.
+    """
+    image_ids = np.sort(np.asarray(image_ids, dtype=np.int64))
+    ratios = np.asarray(ratios, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+
+    if callable(groups) and image_id2image_name is None:
+        raise ValueError("image_id2image_name is needed to group images by name")
+    item_of_image = group_items(image_ids, image_id2image_name, groups)
+    item_sizes = np.bincount(item_of_image).astype(np.float64)
+
+    if store is not None:
+        pair_items, pair_labels, pair_weights = item_labels(store, image_ids, item_of_image)
+        assignment = stratified_assignment(item_sizes, pair_items, pair_labels, pair_weights.astype(np.float64), ratios, rng)
+    else:
+        order = rng.permutation(len(item_sizes))
+        assignment = np.empty(len(item_sizes), dtype=np.int64)
+        assignment[order] = cut_by_weight(item_sizes[order], ratios)
+
+    image_splits = assignment[item_of_image]
+    order = np.argsort(image_splits, kind='stable')
+    split_image_ids = image_ids[order]
+    bounds = counts_to_offsets(np.bincount(image_splits, minlength=len(ratios)))
+    # Image ids were sorted and the sort is stable, so every slice is sorted.
+    return [split_image_ids[bounds[split]:bounds[split + 1]] for split in range(len(ratios))]
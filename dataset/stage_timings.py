@@ -0,0 +1,57 @@
+import time
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+class StageTimings:
+    """
+    Wall time and number of calls of every named stage, e.g. `coco.parse`.
+    """
+    def __init__(self):
+        self.seconds: dict[str, float] = {}
+        self.calls: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def as_dict(self) -> dict[str, dict[str, float]]:
+        return {name: {'seconds': seconds, 'calls': self.calls[name]} for name, seconds in self.seconds.items()}
+
+_active: Optional[StageTimings] = None
+
+@contextmanager
+def timed_stages() -> Iterator[StageTimings]:
+    """
+    Collects the timings of the stages run inside the block, such as those of
+    the loaders:
+
+        with timed_stages() as timings:
+            COCOAdapter.load(json_path, images_path)
+        print(timings.as_dict())
+    """
+    global _active
+    previous = _active
+    _active = StageTimings()
+    try:
+        yield _active
+    finally:
+        _active = previous
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Times the block as stage `name` when timings are being collected, and does
+    nothing otherwise.
+    """
+    timings = _active
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
@@ -0,0 +1,186 @@
+import io
+import os
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+from PIL import Image
+
+from file_signatures import file_signature
+
+DEFAULT_SIZES = (64, 128, 256)
+
+INDEX_DTYPE = np.dtype([
+    ('key', '<u8'),
+    ('file_size', '<i8'),
+    ('mtime_ns', '<i8'),
+    ('size', '<i4'),
+    ('width', '<i4'),
+    ('height', '<i4'),
+    ('offset', '<i8'),
+    ('length', '<i8')
+])
+
+def name_key(image_name: str) -> int:
+    return int.from_bytes(hashlib.blake2b(image_name.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def render_thumbnails(image_path: str, sizes: Iterable[int], quality: int = 85) -> list[tuple[int, int, int, bytes]]:
+    """
+    Decodes an image once, at the resolution needed for the largest size, and
+    returns `(size, width, height, jpeg_bytes)` for every size of the pyramid.
+    """
+    sizes = sorted(sizes, reverse=True)
+    thumbnails = []
+    with Image.open(image_path) as image:
+        image.draft('RGB', (sizes[0], sizes[0]))
+        image = image.convert('RGB')
+        for size in sizes:
+            image.thumbnail((size, size))
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=quality)
+            thumbnails.append((size, image.width, image.height, buffer.getvalue()))
+    return thumbnails
+
+class ThumbnailStore:
+    """
+    Persistent thumbnail pyramid. The JPEG thumbnails of each size are packed
+    one after the other into a single `thumbnails_<size>.pack` file, and one
+    fixed-size record per thumbnail is appended to `thumbnails.index`, so
+    adding thumbnails never rewrites existing data. The whole index is kept in
+    memory: `lookup` never touches the disk.
+    """
+    def __init__(self, directory: str, sizes: Iterable[int] = DEFAULT_SIZES, quality: int = 85):
+        self.directory = directory
+        self.sizes = tuple(sorted(sizes))
+        self.quality = quality
+        self._entries: dict[tuple[int, int], np.void] = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, 'thumbnails.index')
+        if os.path.exists(self.index_path):
+            records = np.fromfile(self.index_path, dtype=INDEX_DTYPE)
+            # Records are appended, so later records replace earlier ones.
+            for record in records:
+                self._entries[(int(record['key']), int(record['size']))] = record
+
+    def pack_path(self, size: int) -> str:
+        return os.path.join(self.directory, f'thumbnails_{size}.pack')
+
+    def lookup(self, image_name: str, size: int, signature: Optional[tuple[int, int]] = None) -> Optional[np.void]:
+        """
+        Returns the index record of a thumbnail, or None. With `signature`
+        (`file_signature` of the image), stale thumbnails are ignored.
+        """
+        record = self._entries.get((name_key(image_name), size))
+        if record is None:
+            return None
+        if signature is not None and (int(record['file_size']), int(record['mtime_ns'])) != signature:
+            return None
+        return record
+
+    def is_current(self, image_name: str, signature: tuple[int, int]) -> bool:
+        return all(self.lookup(image_name, size, signature) is not None for size in self.sizes)
+
+    def add(self, image_name: str, signature: tuple[int, int], thumbnails: list[tuple[int, int, int, bytes]]) -> None:
+        key = name_key(image_name)
+        with self._lock:
+            records = np.zeros(len(thumbnails), dtype=INDEX_DTYPE)
+            for index, (size, width, height, data) in enumerate(thumbnails):
+                with open(self.pack_path(size), 'ab') as writer:
+                    offset = writer.tell()
+                    writer.write(data)
+                records[index] = (key, signature[0], signature[1], size, width, height, offset, len(data))
+            with open(self.index_path, 'ab') as writer:
+                records.tofile(writer)
+            for record in records:
+                self._entries[(key, int(record['size']))] = record
+
+    def read(self, image_name: str, size: int) -> Optional[Image.Image]:
+        """
+        Reads and decodes one thumbnail. This touches the disk and should not be
+        called from a UI thread.
+        """
+        record = self.lookup(image_name, size)
+        if record is None:
+            return None
+        with open(self.pack_path(size), 'rb') as reader:
+            reader.seek(int(record['offset']))
+            data = reader.read(int(record['length']))
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        return image
+
+class ThumbnailGenerator:
+    """
+    Builds missing or stale thumbnails of a set of images in background worker
+    processes. Images passed to `prioritize` (e.g. the visible cells of a
+    gallery) are generated first. `on_ready(image_name)` is called from the
+    background thread whenever the thumbnails of an image become available.
+    """
+    def __init__(self,
+                store: ThumbnailStore,
+                data_path: str,
+                image_names: Iterable[str],
+                workers: Optional[int] = None,
+                on_ready: Callable[[str], None] = None
+                ):
+        self.store = store
+        self.data_path = data_path
+        self.workers = workers or os.cpu_count() or 1
+        self.on_ready = on_ready
+        self._pending = deque(image_names)
+        self._priority = deque()
+        self._done: set[str] = set()
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='thumbnail-generator', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped = True
+
+    def prioritize(self, image_names: Iterable[str]) -> None:
+        with self._lock:
+            self._priority.extendleft(name for name in image_names if name not in self._done)
+
+    def _next_name(self) -> Optional[str]:
+        with self._lock:
+            while self._priority or self._pending:
+                name = self._priority.popleft() if self._priority else self._pending.popleft()
+                if name not in self._done:
+                    self._done.add(name)
+                    return name
+            return None
+
+    def _run(self) -> None:
+        in_flight = {}
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            while not self._stopped:
+                while len(in_flight) < 2 * self.workers:
+                    name = self._next_name()
+                    if name is None:
+                        break
+                    path = os.path.join(self.data_path, name)
+                    signature = file_signature(path)
+                    if signature == (-1, -1) or self.store.is_current(name, signature):
+                        continue
+                    in_flight[executor.submit(render_thumbnails, path, self.store.sizes, self.store.quality)] = (name, signature)
+
+                if not in_flight:
+                    break
+
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, signature = in_flight.pop(future)
+                    try:
+                        self.store.add(name, signature, future.result())
+                    except Exception:
+                        continue
+                    if self.on_ready is not None:
+                        self.on_ready(name)
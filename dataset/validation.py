@@ -0,0 +1,260 @@
+import os
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+from PIL import Image
+
+from annotation_store import KIND_CLASSIFICATION, KIND_MASK, KIND_SEGMENTATION, polygon_areas
+
+MISSING_IMAGE = 'missing_image'
+NOT_USED_IMAGE = 'not_used_image'
+ANNOTATION_WITHOUT_IMAGE = 'annotation_without_image'
+UNKNOWN_CLASS = 'unknown_class'
+DEGENERATE_ANNOTATION = 'degenerate_annotation'
+OUT_OF_BOUNDS = 'out_of_bounds'
+CORRUPT_IMAGE = 'corrupt_image'
+DIMENSION_MISMATCH = 'dimension_mismatch'
+
+ANNOTATION_CHECKS = (NOT_USED_IMAGE, ANNOTATION_WITHOUT_IMAGE, UNKNOWN_CLASS, DEGENERATE_ANNOTATION, OUT_OF_BOUNDS)
+# Checks that open the image files, run in worker processes.
+IMAGE_CHECKS = (CORRUPT_IMAGE, DIMENSION_MISMATCH)
+ALL_CHECKS = (MISSING_IMAGE,) + ANNOTATION_CHECKS + IMAGE_CHECKS
+
+PROGRESS_VERSION = 1
+
+@dataclass
+class ValidationIssue:
+    check: str
+    image_id: Optional[int] = None
+    annotation_id: Optional[int] = None
+    message: str = ''
+
+def list_existing_files(data_path: str, image_names: Iterable[str]) -> set[str]:
+    """
+    Returns the image names that exist under `data_path`, listing each directory
+    once instead of checking every file, which is much faster on network
+    storage.
+    """
+    directories: dict[str, list[str]] = {}
+    for image_name in image_names:
+        directories.setdefault(os.path.dirname(image_name), []).append(image_name)
+
+    existing = set()
+    for directory, names in directories.items():
+        try:
+            with os.scandir(os.path.join(data_path, directory)) as entries:
+                listed = {entry.name for entry in entries if not entry.is_dir()}
+        except OSError:
+            continue
+        existing.update(name for name in names if os.path.basename(name) in listed)
+    return existing
+
+def _check_image_files(
+        image_paths: list[str],
+        image_ids: list[int],
+        declared_dimensions: list[Optional[tuple[int, int]]],
+        checks: tuple[str, ...]
+        ) -> list[tuple[str, int, str]]:
+    issues = []
+    for image_path, image_id, dimensions in zip(image_paths, image_ids, declared_dimensions):
+        try:
+            with Image.open(image_path) as image:
+                size = image.size
+                if CORRUPT_IMAGE in checks:
+                    image.load()
+        except Exception as error:
+            if CORRUPT_IMAGE in checks:
+                issues.append((CORRUPT_IMAGE, image_id, str(error)))
+            continue
+        if DIMENSION_MISMATCH in checks and dimensions is not None and tuple(dimensions) != size:
+            issues.append((DIMENSION_MISMATCH, image_id, f"declared {tuple(dimensions)}, actual {size}"))
+    return issues
+
+class DatasetValidator:
+    """
+    Runs every dataset check in one pass and yields issues as they are found.
+
+    Annotation checks are vectorized over the annotation store, missing images
+    are found with one directory listing per directory, and the checks that
+    open image files run over chunks of images in a process pool. With
+    `progress_path`, every finished stage is appended to a JSON lines file; an
+    interrupted run started again with the same file replays the issues of
+    the finished stages and only runs the remaining ones.
+    """
+    def __init__(self,
+                dataset,
+                checks: Iterable[str] = ALL_CHECKS,
+                workers: Optional[int] = None,
+                chunk_size: int = 256,
+                progress_path: Optional[str] = None,
+                tolerance: float = 1.0
+                ):
+        self.dataset = dataset
+        self.checks = tuple(check for check in ALL_CHECKS if check in set(checks))
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.progress_path = progress_path
+        self.tolerance = tolerance
+
+    def _header(self, image_ids: np.ndarray) -> dict:
+        return {
+            'version': PROGRESS_VERSION,
+            'data_path': self.dataset.data_path,
+            'images': len(image_ids),
+            'annotations': len(self.dataset.annotation_store),
+            'chunk_size': self.chunk_size,
+            'checks': list(self.checks)
+        }
+
+    def _load_progress(self, header: dict) -> dict[str, list[ValidationIssue]]:
+        if self.progress_path is None or not os.path.exists(self.progress_path):
+            return {}
+        finished = {}
+        with open(self.progress_path, 'r') as reader:
+            lines = reader.read().splitlines()
+        try:
+            if len(lines) == 0 or json.loads(lines[0]) != header:
+                return {}
+            for line in lines[1:]:
+                record = json.loads(line)
+                finished[record['stage']] = [ValidationIssue(**issue) for issue in record['issues']]
+        except (ValueError, KeyError, TypeError):
+            # A line cut short by the interruption ends the usable progress.
+            pass
+        return finished
+
+    def _record(self, writer, stage: str, issues: list[ValidationIssue]) -> None:
+        if writer is None:
+            return
+        writer.write(json.dumps({'stage': stage, 'issues': [asdict(issue) for issue in issues]}) + '\n')
+        writer.flush()
+
+    def annotation_issues(self) -> list[ValidationIssue]:
+        dataset = self.dataset
+        store = dataset.annotation_store
+        image_ids = np.sort(np.fromiter(dataset.image_id2image_name.keys(), dtype=np.int64, count=len(dataset.image_id2image_name)))
+        annotation_ids = store.annotation_ids
+        issues = []
+
+        if NOT_USED_IMAGE in self.checks:
+            for image_id in np.setdiff1d(image_ids, store.annotated_image_ids()).tolist():
+                issues.append(ValidationIssue(NOT_USED_IMAGE, image_id=image_id, message="image has no annotations"))
+
+        with_image = np.isin(store.image_ids, image_ids)
+        if ANNOTATION_WITHOUT_IMAGE in self.checks:
+            for row in np.flatnonzero(~with_image).tolist():
+                issues.append(ValidationIssue(ANNOTATION_WITHOUT_IMAGE, int(store.image_ids[row]), int(annotation_ids[row]), "image not in dataset"))
+
+        if UNKNOWN_CLASS in self.checks:
+            known = np.fromiter(dataset.id2class.keys(), dtype=np.int64, count=len(dataset.id2class))
+            for row in np.flatnonzero(~np.isin(store.class_ids, known)).tolist():
+                issues.append(ValidationIssue(UNKNOWN_CLASS, int(store.image_ids[row]), int(annotation_ids[row]), f"unknown class id {int(store.class_ids[row])}"))
+
+        if DEGENERATE_ANNOTATION in self.checks:
+            has_box = store.kinds != KIND_CLASSIFICATION
+            empty_box = has_box & ((store.bboxes[:, 2] <= 0) | (store.bboxes[:, 3] <= 0))
+            segmentation = store.kinds == KIND_SEGMENTATION
+            vertex_counts = store.vertex_counts()
+            areas = np.abs(polygon_areas(store.vertices, store.vertex_offsets))
+            few_vertices = segmentation & (vertex_counts < 3)
+            flat_polygon = segmentation & (vertex_counts >= 3) & (areas <= 0)
+            empty_mask = (store.kinds == KIND_MASK) & (store.areas <= 0)
+            for rows, message in (
+                    (empty_box, "empty bbox"),
+                    (few_vertices, "polygon with less than 3 vertices"),
+                    (flat_polygon, "polygon with zero area"),
+                    (empty_mask, "empty mask")):
+                for row in np.flatnonzero(rows).tolist():
+                    issues.append(ValidationIssue(DEGENERATE_ANNOTATION, int(store.image_ids[row]), int(annotation_ids[row]), message))
+
+        if OUT_OF_BOUNDS in self.checks and len(image_ids) > 0:
+            dimensions = np.array([dataset.image_id2image_dimensions.get(image_id, (np.inf, np.inf)) for image_id in image_ids.tolist()], dtype=np.float64).reshape(-1, 2)
+            rows = np.flatnonzero(with_image & (store.kinds != KIND_CLASSIFICATION))
+            widths, heights = dimensions[np.searchsorted(image_ids, store.image_ids[rows])].T
+            x0, y0, width, height = store.bboxes[rows].T
+            outside = (x0 < -self.tolerance) | (y0 < -self.tolerance) | (x0 + width > widths + self.tolerance) | (y0 + height > heights + self.tolerance)
+
+            # Vertices are checked too: a polygon can leave the image even when its bbox was clipped.
+            vertex_rows = store.vertex_rows()
+            vertex_row_position = np.full(len(store), -1, dtype=np.int64)
+            vertex_row_position[rows] = np.arange(len(rows))
+            positions = vertex_row_position[vertex_rows]
+            checked = positions >= 0
+            x, y = store.vertices[checked].T
+            vertex_outside = (x < -self.tolerance) | (y < -self.tolerance) | (x > widths[positions[checked]] + self.tolerance) | (y > heights[positions[checked]] + self.tolerance)
+            outside[np.unique(positions[checked][vertex_outside])] = True
+            for row in rows[outside].tolist():
+                issues.append(ValidationIssue(OUT_OF_BOUNDS, int(store.image_ids[row]), int(annotation_ids[row]), "annotation outside of the image"))
+        return issues
+
+    def run(self) -> Iterator[ValidationIssue]:
+        dataset = self.dataset
+        image_ids = np.sort(np.fromiter(dataset.image_id2image_name.keys(), dtype=np.int64, count=len(dataset.image_id2image_name)))
+        header = self._header(image_ids)
+        finished = self._load_progress(header)
+
+        writer = None
+        if self.progress_path is not None:
+            # The file is rewritten from the records that were read back, which
+            # drops a last line cut short by the interruption.
+            writer = open(self.progress_path, 'w')
+            writer.write(json.dumps(header) + '\n')
+            for stage, issues in finished.items():
+                self._record(writer, stage, issues)
+            writer.flush()
+
+        try:
+            for stage, issues in finished.items():
+                if stage != 'listing' or MISSING_IMAGE in self.checks:
+                    yield from issues
+
+            if 'annotations' not in finished and any(check in self.checks for check in ANNOTATION_CHECKS):
+                issues = self.annotation_issues()
+                self._record(writer, 'annotations', issues)
+                yield from issues
+
+            if 'listing' in finished:
+                missing = {issue.image_id for issue in finished['listing']}
+            else:
+                existing = list_existing_files(dataset.data_path, dataset.image_id2image_name.values())
+                missing = {image_id for image_id, image_name in dataset.image_id2image_name.items() if image_name not in existing}
+                issues = [ValidationIssue(MISSING_IMAGE, image_id=image_id, message="image file not found") for image_id in sorted(missing)]
+                self._record(writer, 'listing', issues)
+                if MISSING_IMAGE in self.checks:
+                    yield from issues
+
+            image_checks = tuple(check for check in self.checks if check in IMAGE_CHECKS)
+            if len(image_checks) == 0:
+                return
+            chunks = [
+                (f'images_{start}', image_ids[start:start + self.chunk_size].tolist())
+                for start in range(0, len(image_ids), self.chunk_size)
+                if f'images_{start}' not in finished
+            ]
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                in_flight = deque()
+                next_chunk = 0
+                while next_chunk < len(chunks) or in_flight:
+                    while next_chunk < len(chunks) and len(in_flight) < 2 * self.workers:
+                        stage, chunk_ids = chunks[next_chunk]
+                        chunk_ids = [image_id for image_id in chunk_ids if image_id not in missing]
+                        in_flight.append((stage, executor.submit(
+                            _check_image_files,
+                            [os.path.join(dataset.data_path, dataset.image_id2image_name[image_id]) for image_id in chunk_ids],
+                            chunk_ids,
+                            [dataset.image_id2image_dimensions.get(image_id) for image_id in chunk_ids],
+                            image_checks
+                        )))
+                        next_chunk += 1
+
+                    stage, future = in_flight.popleft()
+                    issues = [ValidationIssue(check, image_id=image_id, message=message) for check, image_id, message in future.result()]
+                    self._record(writer, stage, issues)
+                    yield from issues
+        finally:
+            if writer is not None:
+                writer.close()
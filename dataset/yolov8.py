@@ -1,84 +1,434 @@
 import os
-import glob
+import cv2
 import yaml
+import hashlib
+from collections.abc import Iterable, Mapping
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain
+from typing import Optional, Union
+
+import numpy as np
 from PIL import Image
 
-from dataset import Dataset, Point, SegmentationAnnotation
+from dataset import Dataset
+from dataset_view import DatasetView
+from rle import rle_to_polygons
+from index_cache import cache_path_for, file_signature, load_dataset_index, save_dataset_index
+from materialize import link_or_copy
+from stage_timings import stage
+from annotation_store import (
+    AnnotationStore,
+    AnnotationStoreBuilder,
+    KIND_CLASSIFICATION,
+    KIND_DETECTION,
+    KIND_MASK,
+    KIND_SEGMENTATION,
+    counts_to_offsets,
+    polygon_areas,
+    polygon_bboxes,
+    ragged_indices
+)
+
+IMAGE_MODES = ('symlink', 'hardlink', 'reflink', 'copy', None)
+EXPORT_INDEX_FILE_NAME = '.export_index.npz'
+LABEL_DIGEST_SIZE = 16
+
+IMAGE_EXTENSIONS = {extension.lower() for extension in Image.registered_extensions()}
+
+def find_label_path(image_path: str) -> str:
+    """
+    Returns the label file of an image: next to the image, or in the sibling
+    `labels` directory of the standard `images`/`labels` YOLO layout.
+    """
+    label_path = os.path.splitext(image_path)[0] + '.txt'
+    if os.path.exists(label_path):
+        return label_path
+    directory, file_name = os.path.split(label_path)
+    parent, leaf = os.path.split(directory)
+    if leaf == 'images':
+        return os.path.join(parent, 'labels', file_name)
+    return label_path
+
+def _is_numeric(tokens: list[str]) -> bool:
+    try:
+        np.array(tokens, dtype=np.float64)
+    except ValueError:
+        return False
+    return True
+
+def parse_label_file(label_path: str, image_size: tuple[int, int]) -> dict[str, np.ndarray]:
+    """
+    Parses a YOLOv8 label file into pixel coordinates. Each line is either a box
+    (`class cx cy w h`) or a polygon (`class x0 y0 x1 y1 ...`), all normalized.
+    All numbers of the file are converted in a single NumPy call. Malformed
+    lines (an odd number of coordinates, fewer than three vertices or a token
+    that is not a number) are skipped.
+    """
+    try:
+        with open(label_path, 'r') as reader:
+            lines = [line.split() for line in reader.read().splitlines()]
+    except FileNotFoundError:
+        lines = []
+    lines = [tokens for tokens in lines if len(tokens) == 5 or (len(tokens) >= 7 and len(tokens) % 2 == 1)]
+
+    try:
+        values = np.array(list(chain.from_iterable(lines)), dtype=np.float64)
+    except ValueError:
+        lines = [tokens for tokens in lines if _is_numeric(tokens)]
+        values = np.array(list(chain.from_iterable(lines)), dtype=np.float64)
+    token_counts = np.fromiter((len(tokens) for tokens in lines), dtype=np.int64, count=len(lines))
+    line_offsets = counts_to_offsets(token_counts)
+
+    class_ids = values[line_offsets[:-1]].astype(np.int64)
+    is_box = token_counts == 5
+    coordinates = np.ones(len(values), dtype=bool)
+    coordinates[line_offsets[:-1]] = False
+    coordinates = values[coordinates].reshape(-1, 2) * np.asarray(image_size, dtype=np.float64)
+
+    coordinate_counts = (token_counts - 1) // 2
+    coordinate_offsets = counts_to_offsets(coordinate_counts)
+
+    # Boxes are stored as (cx, cy) and (w, h); turn them into their two corners.
+    box_starts = coordinate_offsets[:-1][is_box]
+    centers = coordinates[box_starts].copy()
+    sizes = coordinates[box_starts + 1].copy()
+    coordinates[box_starts] = centers - sizes / 2
+    coordinates[box_starts + 1] = centers + sizes / 2
+
+    bboxes = polygon_bboxes(coordinates, coordinate_offsets)
+    areas = np.where(is_box, bboxes[:, 2] * bboxes[:, 3], polygon_areas(coordinates, coordinate_offsets))
+
+    polygon_vertices = np.repeat(~is_box, coordinate_counts)
+    return {
+        'class_ids': class_ids,
+        'bboxes': bboxes,
+        'areas': areas,
+        'kinds': np.where(is_box, KIND_DETECTION, KIND_SEGMENTATION).astype(np.int8),
+        'vertex_counts': np.where(is_box, 0, coordinate_counts),
+        'vertices': coordinates[polygon_vertices].astype(np.float32)
+    }
+
+def read_image_and_labels(image_path: str) -> tuple[tuple[int, int], dict[str, np.ndarray]]:
+    """
+    Reads the dimensions of an image from its header only and parses its labels.
+    """
+    with Image.open(image_path) as image:
+        image_size = image.size
+    return image_size, parse_label_file(find_label_path(image_path), image_size)
+
+def label_values(store: AnnotationStore, rows: np.ndarray, dimensions: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Normalized YOLOv8 values of the given rows, as a ragged buffer: `(cx, cy,
+    w, h)` for boxes and `x0, y0, x1, y1, ...` for polygons. Masks are written
+    as the polygon of their largest contour. `dimensions` holds the `(width,
+    height)` of the image of every row. Returns `(values, offsets)`.
+    """
+    kinds = store.kinds[rows]
+    scale = 1 / np.asarray(dimensions, dtype=np.float64).reshape(-1, 2)
+    mask_polygons = {}
+    for position in np.flatnonzero(kinds == KIND_MASK).tolist():
+        polygons = rle_to_polygons(store.get_rle(rows[position]))
+        if len(polygons) > 0:
+            mask_polygons[position] = max(polygons, key=lambda polygon: abs(cv2.contourArea(polygon)))
+
+    counts = np.where(kinds == KIND_DETECTION, 4, 0)
+    counts = np.where(kinds == KIND_SEGMENTATION, 2 * store.vertex_counts()[rows], counts)
+    for position, polygon in mask_polygons.items():
+        counts[position] = 2 * len(polygon)
+    offsets = counts_to_offsets(counts)
+    values = np.empty(offsets[-1], dtype=np.float64)
+
+    boxes = np.flatnonzero(kinds == KIND_DETECTION)
+    x, y, width, height = store.bboxes[rows[boxes]].T
+    box_values = np.stack([x + width / 2, y + height / 2, width, height], axis=1) * np.tile(scale[boxes], 2)
+    values[ragged_indices(offsets, boxes)] = box_values.ravel()
+
+    polygons = np.flatnonzero(kinds == KIND_SEGMENTATION)
+    vertex_scale = np.repeat(scale[polygons], store.vertex_counts()[rows[polygons]], axis=0)
+    values[ragged_indices(offsets, polygons)] = (store.vertices[store.vertex_indices(rows[polygons])] * vertex_scale).ravel()
+
+    for position, polygon in mask_polygons.items():
+        values[offsets[position]:offsets[position + 1]] = (polygon * scale[position]).ravel()
+    return np.clip(values, 0, 1), offsets
+
+def format_label_file(class_indices: list[int], values: np.ndarray, offsets: list[int]) -> str:
+    """
+    Text of one label file, one line per annotation. Rows without values (empty
+    masks) are skipped.
+    """
+    lines = []
+    for line, class_index in enumerate(class_indices):
+        count = offsets[line + 1] - offsets[line]
+        if count > 0:
+            lines.append(f'{class_index}' + ' %.6f' * count)
+    if len(lines) == 0:
+        return ''
+    return '\n'.join(lines) % tuple(values[offsets[0]:offsets[-1]].tolist()) + '\n'
+
+def write_text_file(path: str, text: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as writer:
+        writer.write(text)
+
+def remove_if_exists(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
 class YOLOv8Adapter:
     @staticmethod
-    def load(yaml_path: str) -> Dataset:
+    def load(yaml_path: str, workers: int = None, use_processes: bool = False, use_cache: bool = True) -> Dataset:
         """
-        TODO: Add documentation
+        Loads a YOLOv8 dataset. Images of any format supported by PIL are
+        found in the `path` directory of the yaml file; their dimensions are
+        probed from the headers and the label files are parsed in parallel, by
+        `workers` threads (or processes when `use_processes` is set).
+
+        With `use_cache`, the parsed index is stored in a sidecar file next to the
+        yaml together with the size and modification time of every image and
+        label file. On later loads only the images whose files changed are
+        probed and parsed again.
+
+        Reports the `yolo.scan`, `yolo.cache_read`, `yolo.parse`, `yolo.build`
+        and `yolo.cache_write` stages (see `stage_timings.timed_stages`).
         """
         yolov8_yaml = None
         with open(yaml_path, 'r') as reader:
             yolov8_yaml = yaml.safe_load(reader)
 
         id2class = yolov8_yaml['names']
-        image_id2image_name = {}
-        image_id2image_dimensions = {}
-        annotation_id2image_id = {}
-        annotation_id2annotation = {}
-
-        for image_path in glob.glob(os.path.join(yolov8_yaml['path'], '*.jpg')):
-            image_name = os.path.basename(image_path)
-            image_id = len(image_id2image_name)
-            image_id2image_name.update({
-                image_id: image_name
-            })
+        if isinstance(id2class, list):
+            id2class = dict(enumerate(id2class))
 
-            image = Image.open(image_path)
-            image_id2image_dimensions.update({
-                image_id: image.size
-            })
+        # Datasets written by `save` keep their images in an `images` directory.
+        images_path = yolov8_yaml['path']
+        if os.path.isdir(os.path.join(images_path, 'images')):
+            images_path = os.path.join(images_path, 'images')
+
+        with stage('yolo.scan'):
+            image_paths = sorted(
+                entry.path for entry in os.scandir(images_path)
+                if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS
+            )
+            signatures = np.array(
+                [file_signature(image_path) + file_signature(find_label_path(image_path)) for image_path in image_paths],
+                dtype=np.int64
+            ).reshape(-1, 4)
+            yaml_signature = np.array(file_signature(yaml_path), dtype=np.int64)
 
-            txt_file_path = image_path.replace('.jpg', '.txt')
-            if not os.path.exists(txt_file_path):
-                continue
-
-            txt_file = None
-            with open(txt_file_path, 'r') as reader:
-                txt_file = reader.readlines()
-
-            for line in txt_file:
-                class_id, *poly = line.split(' ')
-                poly = list(map(float, poly))
-                poly = [int(poly[i] * image.size[i % 2]) for i in range(len(poly))]
-
-                x_values = [poly[i] for i in range(0, len(poly), 2)]
-                y_values = [poly[i] for i in range(1, len(poly), 2)]
-                x = min(x_values)
-                y = min(y_values)
-                width = max(x_values) - x
-                height = max(y_values) - y
-
-                annotation = SegmentationAnnotation(
-                    class_id = class_id,
-                    x = x,
-                    y = y,
-                    width = width,
-                    height = height,
-                    points = [Point(poly[i], poly[i+1]) for i in range(4, len(poly), 2)]
+        # For every image, the id it had in the cached index if its files are unchanged, else -1.
+        cached_image_ids = np.full(len(image_paths), -1, dtype=np.int64)
+        cached_dataset = None
+        cache_path = cache_path_for(yaml_path)
+        if use_cache:
+            with stage('yolo.cache_read'):
+                cached = load_dataset_index(cache_path)
+            if cached is not None and np.array_equal(cached[1].get('yaml_signature'), yaml_signature):
+                cached_dataset, extra_arrays = cached
+                candidates = np.array(
+                    [cached_dataset.image_path2image_id.get(os.path.basename(image_path), -1) for image_path in image_paths],
+                    dtype=np.int64
                 )
+                found = np.flatnonzero(candidates >= 0)
+                unchanged = (extra_arrays['image_signatures'][candidates[found]] == signatures[found]).all(axis=1)
+                cached_image_ids[found[unchanged]] = candidates[found[unchanged]]
 
-                annotation_id = len(annotation_id2image_id)
-                annotation_id2image_id.update({
-                    annotation_id: image_id
+        image_id2image_name = {}
+        image_id2image_dimensions = {}
+        builder = AnnotationStoreBuilder()
+        paths_to_parse = [image_path for image_path, cached_image_id in zip(image_paths, cached_image_ids) if cached_image_id < 0]
+
+        executor_class: type[Executor] = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with stage('yolo.parse'), executor_class(max_workers=workers) as executor:
+            chunksize = 64 if use_processes else 1
+            results = iter(executor.map(read_image_and_labels, paths_to_parse, chunksize=chunksize))
+            for image_id, (image_path, cached_image_id) in enumerate(zip(image_paths, cached_image_ids.tolist())):
+                image_id2image_name.update({
+                    image_id: os.path.basename(image_path)
                 })
-                annotation_id2annotation.update({
-                    annotation_id: annotation
+                if cached_image_id >= 0:
+                    image_id2image_dimensions.update({
+                        image_id: cached_dataset.image_id2image_dimensions[cached_image_id]
+                    })
+                    continue
+
+                image_size, labels = next(results)
+                image_id2image_dimensions.update({
+                    image_id: image_size
                 })
+                builder.add_batch(
+                    annotation_ids = np.zeros(len(labels['class_ids']), dtype=np.int64),
+                    image_ids = image_id,
+                    **labels
+                )
+
+        with stage('yolo.build'):
+            annotation_store = builder.build()
+            reused = cached_image_ids >= 0
+            if reused.any():
+                new_image_ids = np.full(len(cached_dataset), -1, dtype=np.int64)
+                new_image_ids[cached_image_ids[reused]] = np.flatnonzero(reused)
+
+                cached_store = cached_dataset.annotation_store
+                reused_store = cached_store.take(np.flatnonzero(new_image_ids[cached_store.image_ids] >= 0))
+                reused_store = AnnotationStore(**{**reused_store.columns(), 'image_ids': new_image_ids[reused_store.image_ids]})
+                reused_store.extend(annotation_store)
+                annotation_store = reused_store.take(np.argsort(reused_store.image_ids, kind='stable'))
+
+            # Annotation ids follow image order, as if every label file had been parsed now.
+            annotation_store = AnnotationStore(**{
+                **annotation_store.columns(),
+                'annotation_ids': np.arange(len(annotation_store), dtype=np.int64)
+            })
+
+            dataset = Dataset.from_annotation_store(
+                id2class = id2class,
+                data_path = images_path,
+                image_id2image_name = image_id2image_name,
+                image_id2image_dimensions = image_id2image_dimensions,
+                annotation_store = annotation_store
+            )
+        if use_cache and (not reused.all() or cached_dataset is None or len(cached_dataset) != len(image_paths)):
+            with stage('yolo.cache_write'):
+                save_dataset_index(cache_path, dataset, image_signatures=signatures, yaml_signature=yaml_signature)
+        return dataset
+
+    @staticmethod
+    def _label_digests(store: AnnotationStore, rows: np.ndarray, row_offsets: np.ndarray, dimensions: np.ndarray, class_indices: np.ndarray) -> np.ndarray:
+        """
+        `(N, LABEL_DIGEST_SIZE)` digest of the annotations of every image, over
+        the columns the label file is written from. `rows` are grouped by image
+        and `row_offsets` delimits the rows of each image.
+        """
+        kinds = store.kinds[rows].tobytes()
+        classes = class_indices.astype(np.int64).tobytes()
+        bboxes = store.bboxes[rows].tobytes()
+        vertex_offsets = counts_to_offsets(store.vertex_counts()[rows]) * 8
+        vertices = store.vertices[store.vertex_indices(rows)].tobytes()
+        rle_offsets = counts_to_offsets(np.diff(store.rle_offsets)[rows])
+        rle_counts = store.rle_counts[ragged_indices(store.rle_offsets, rows)].tobytes()
+        dimensions = np.ascontiguousarray(dimensions, dtype=np.int64)
 
-        return Dataset(
-            id2class = id2class,
-            data_path = yolov8_yaml['path'],
-            image_id2image_name = image_id2image_name,
-            image_id2image_dimensions = image_id2image_dimensions,
-            annotation_id2image_id = annotation_id2image_id,
-            annotation_id2annotation = annotation_id2annotation
-        )
+        digests = np.empty((len(dimensions), LABEL_DIGEST_SIZE), dtype=np.uint8)
+        for image, (start, end) in enumerate(zip(row_offsets[:-1].tolist(), row_offsets[1:].tolist())):
+            digest = hashlib.blake2b(dimensions[image].tobytes(), digest_size=LABEL_DIGEST_SIZE)
+            digest.update(kinds[start:end])
+            digest.update(classes[start * 8:end * 8])
+            digest.update(bboxes[start * 32:end * 32])
+            digest.update(vertices[vertex_offsets[start]:vertex_offsets[end]])
+            digest.update(rle_counts[rle_offsets[start]:rle_offsets[end]])
+            digests[image] = np.frombuffer(digest.digest(), dtype=np.uint8)
+        return digests
 
     @staticmethod
-    def save(dataset: Dataset, json_path: str) -> None:
-        pass
\ No newline at end of file
+    def save(dataset: Union[Dataset, DatasetView],
+                output_path: str,
+                splits: Optional[Mapping[str, Union[DatasetView, Iterable[int]]]] = None,
+                images: Optional[str] = 'symlink',
+                workers: int = None,
+                batch_size: int = 4096
+                ) -> None:
+        """
+        Exports a dataset in the YOLOv8 layout: `images/` with the images,
+        `labels/` with one label file per image, a `<split>.txt` image list
+        per split (e.g. the views returned by `split_dataset`) and `data.yaml`.
+        Classes are numbered from 0 in the order of their ids.
+
+        Images are symlinked, hardlinked, reflinked or copied as set by
+        `images` (None skips them). Polygons are normalized in batches with
+        NumPy and the files are written by `workers` threads. The export is incremental: a digest of
+        the annotations of every image is kept in the output directory, and
+        only the label files whose annotations changed since the last export
+        are written again.
+        """
+        if images not in IMAGE_MODES:
+            raise ValueError(f"images must be one of {IMAGE_MODES}")
+        if isinstance(dataset, DatasetView):
+            source = dataset.dataset
+            rows = dataset.annotation_rows
+        else:
+            source = dataset
+            rows = np.flatnonzero(np.isin(source.annotation_store.image_ids, np.fromiter(source.image_id2image_name.keys(), dtype=np.int64, count=len(source.image_id2image_name))))
+        store = source.annotation_store
+
+        class_ids = np.array(sorted(source.id2class.keys()), dtype=np.int64)
+        rows = rows[np.isin(store.class_ids[rows], class_ids) & (store.kinds[rows] != KIND_CLASSIFICATION)]
+        rows = rows[np.argsort(store.image_ids[rows], kind='stable')]
+        class_indices = np.searchsorted(class_ids, store.class_ids[rows])
+
+        image_ids = np.sort(np.fromiter(dataset.image_id2image_name.keys(), dtype=np.int64, count=len(dataset.image_id2image_name)))
+        image_names = [source.image_id2image_name[image_id] for image_id in image_ids.tolist()]
+        dimensions = np.array([source.image_id2image_dimensions[image_id] for image_id in image_ids.tolist()], dtype=np.int64).reshape(-1, 2)
+        row_offsets = counts_to_offsets(np.bincount(np.searchsorted(image_ids, store.image_ids[rows]), minlength=len(image_ids)))
+        label_paths = [os.path.join(output_path, 'labels', os.path.splitext(image_name)[0] + '.txt') for image_name in image_names]
+        digests = YOLOv8Adapter._label_digests(store, rows, row_offsets, dimensions, class_indices)
+
+        index_path = os.path.join(output_path, EXPORT_INDEX_FILE_NAME)
+        previous = {}
+        if os.path.exists(index_path):
+            try:
+                with np.load(index_path) as data:
+                    previous = {name: digest.tobytes() for name, digest in zip(data['names'].tolist(), data['digests'])}
+            except (OSError, ValueError, KeyError):
+                previous = {}
+        changed = [
+            image for image, (image_name, digest) in enumerate(zip(image_names, digests))
+            if previous.get(image_name) != digest.tobytes() or not os.path.exists(label_paths[image])
+        ]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for start in range(0, len(changed), batch_size):
+                batch = np.asarray(changed[start:start + batch_size], dtype=np.int64)
+                batch_rows = ragged_indices(row_offsets, batch)
+                values, value_offsets = label_values(store, rows[batch_rows], np.repeat(dimensions[batch], np.diff(row_offsets)[batch], axis=0))
+                batch_row_offsets = counts_to_offsets(np.diff(row_offsets)[batch]).tolist()
+                batch_class_indices = class_indices[batch_rows].tolist()
+                value_offsets = value_offsets.tolist()
+                for position, image in enumerate(batch.tolist()):
+                    first, last = batch_row_offsets[position], batch_row_offsets[position + 1]
+                    text = format_label_file(batch_class_indices[first:last], values, value_offsets[first:last + 1])
+                    futures.append(executor.submit(write_text_file, label_paths[image], text))
+
+            if images is not None:
+                for image_name in image_names:
+                    futures.append(executor.submit(
+                        link_or_copy,
+                        os.path.abspath(os.path.join(source.data_path, image_name)),
+                        os.path.join(output_path, 'images', image_name),
+                        images
+                    ))
+
+            removed = set(previous.keys()).difference(image_names)
+            for image_name in removed:
+                futures.append(executor.submit(remove_if_exists, os.path.join(output_path, 'labels', os.path.splitext(image_name)[0] + '.txt')))
+            for future in futures:
+                future.result()
+
+        data_yaml = {'path': os.path.abspath(output_path)}
+        if splits:
+            for split_name, split_image_ids in splits.items():
+                split_image_ids = split_image_ids.image_ids if isinstance(split_image_ids, DatasetView) else split_image_ids
+                write_text_file(
+                    os.path.join(output_path, f'{split_name}.txt'),
+                    ''.join(f'./images/{source.image_id2image_name[image_id]}\n' for image_id in split_image_ids)
+                )
+                data_yaml.update({
+                    split_name: f'{split_name}.txt'
+                })
+        else:
+            data_yaml.update({
+                'train': 'images',
+                'val': 'images'
+            })
+        data_yaml.update({
+            'names': {index: source.id2class[class_id] for index, class_id in enumerate(class_ids.tolist())}
+        })
+        with open(os.path.join(output_path, 'data.yaml'), 'w') as writer:
+            yaml.safe_dump(data_yaml, writer, sort_keys=False)
+
+        temporary_path = index_path + '.tmp'
+        with open(temporary_path, 'wb') as writer:
+            np.savez(writer, names = np.array(image_names, dtype=str), digests = digests)
+        os.replace(temporary_path, index_path)
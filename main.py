@@ -1,5 +1,21 @@
+import os
+import sys
+import queue
+import hashlib
+import threading
 import tkinter
-from tkinter import Tk, Label, Button, Entry, StringVar, Frame, Menu
+from tkinter import Tk, Label, Button, Entry, StringVar, Frame, Menu, Canvas, Scrollbar, filedialog, messagebox
+from typing import Callable, NamedTuple, Optional
+from PIL import ImageTk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dataset'))
+
+from coco import COCOAdapter
+from dataset import Dataset
+from yolov8 import YOLOv8Adapter
+from thumbnails import ThumbnailGenerator, ThumbnailStore
+
+THUMBNAILS_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'deeprad_dataset_explorer', 'thumbnails')
 
 class DatasetExplorerGUI(Tk):
     def __init__(self):
@@ -10,7 +26,8 @@ class DatasetExplorerGUI(Tk):
         self.title("Dataset Explorer")
         self.geometry("800x400")
 
-        self.photo_gallery = PhotoGallery()
+        self.photo_gallery = PhotoGallery(self)
+        self.photo_gallery.pack(fill=tkinter.BOTH, expand=True)
 
         self.menu_bar = self._build_menu_bar()
         self.config(menu=self.menu_bar)
@@ -19,19 +36,215 @@ class DatasetExplorerGUI(Tk):
         menu_bar = Menu(self)
 
         file_menu = Menu(menu_bar, tearoff=0)
+        file_menu.add_command(label="Open COCO dataset...", command=self._open_coco)
+        file_menu.add_command(label="Open YOLOv8 dataset...", command=self._open_yolov8)
+        file_menu.add_separator()
         file_menu.add_command(label="Exit", command=self.quit)
         menu_bar.add_cascade(label="File", menu=file_menu)
 
         return menu_bar
 
+    def _open_coco(self):
+        json_path = filedialog.askopenfilename(filetypes=[("COCO annotations", "*.json")])
+        if not json_path:
+            return
+        images_path = filedialog.askdirectory(title="Images directory")
+        if not images_path:
+            return
+        self.photo_gallery.load_dataset(lambda: COCOAdapter.load(json_path, images_path))
+
+    def _open_yolov8(self):
+        yaml_path = filedialog.askopenfilename(filetypes=[("YOLOv8 dataset", "*.yaml")])
+        if yaml_path:
+            self.photo_gallery.load_dataset(lambda: YOLOv8Adapter.load(yaml_path))
+
+class LoadedDataset(NamedTuple):
+    # Sent by the dataset loader thread through the `_ready` queue.
+    request: int
+    dataset: Optional[Dataset]
+    error: Optional[Exception]
+
 class PhotoGallery(Frame):
-    def __init__(self):
-        super().__init__()
+    """
+    Virtually scrolled grid of thumbnails. Only the visible cells are drawn.
+    Thumbnails come from a persistent `ThumbnailStore` that is filled in the
+    background; disk reads and decodes happen in a loader thread, so the Tk
+    thread only does in-memory lookups and shows a placeholder until a
+    thumbnail is ready.
+    """
+    THUMBNAIL_SIZE = 128
+    PADDING = 8
+    POLL_INTERVAL_MS = 30
+    MAX_PHOTOS = 512
+
+    def __init__(self, master=None):
+        super().__init__(master)
         self._build()
 
     def _build(self):
-        pass
+        self.dataset = None
+        self.image_names: list[str] = []
+        self.thumbnail_store: ThumbnailStore = None
+        self.thumbnail_generator: ThumbnailGenerator = None
+        self._photos: dict[str, ImageTk.PhotoImage] = {}
+        self._requested: set[str] = set()
+        self._load_requests = queue.Queue()
+        self._loaded = queue.Queue()
+        self._ready = queue.Queue()
+        self._load_request = 0
+
+        self.canvas = Canvas(self, background='#202020', highlightthickness=0)
+        self.scrollbar = Scrollbar(self, orient=tkinter.VERTICAL, command=self._on_scroll)
+        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+        self.scrollbar.pack(side=tkinter.RIGHT, fill=tkinter.Y)
+        self.canvas.pack(side=tkinter.LEFT, fill=tkinter.BOTH, expand=True)
+
+        self.canvas.bind('<Configure>', lambda _: self._refresh())
+        self.canvas.bind('<MouseWheel>', lambda event: self._on_scroll('scroll', -event.delta // 120, 'units'))
+        self.canvas.bind('<Button-4>', lambda _: self._on_scroll('scroll', -1, 'units'))
+        self.canvas.bind('<Button-5>', lambda _: self._on_scroll('scroll', 1, 'units'))
+
+        threading.Thread(target=self._load_thumbnails, name='thumbnail-loader', daemon=True).start()
+        self.after(self.POLL_INTERVAL_MS, self._poll)
+
+    def load_dataset(self, load: Callable[[], Dataset]) -> None:
+        """
+        Runs `load` in a worker thread and shows the dataset it returns once it
+        is done, so the Tk thread never blocks on reading the annotations. Only
+        the result of the latest request is shown.
+        """
+        self._load_request += 1
+
+        def run(request=self._load_request):
+            try:
+                self._ready.put(LoadedDataset(request, load(), None))
+            except Exception as error:
+                self._ready.put(LoadedDataset(request, None, error))
+
+        threading.Thread(target=run, name='dataset-loader', daemon=True).start()
+
+    def set_dataset(self, dataset):
+        if self.thumbnail_generator is not None:
+            self.thumbnail_generator.stop()
+
+        self.dataset = dataset
+        self.image_names = list(dataset.image_id2image_name.values())
+        self.thumbnail_store = None
+        self._photos.clear()
+        self._requested.clear()
+        self.canvas.yview_moveto(0)
+
+        # Opening the store reads its index, so it happens off the Tk thread too.
+        def open_store(data_path=dataset.data_path, image_names=self.image_names):
+            directory = os.path.join(THUMBNAILS_PATH, hashlib.blake2b(os.path.abspath(data_path).encode('utf-8'), digest_size=8).hexdigest())
+            store = ThumbnailStore(directory)
+            generator = ThumbnailGenerator(store, data_path, image_names, on_ready=self._ready.put)
+            self._ready.put((store, generator))
+
+        threading.Thread(target=open_store, name='thumbnail-store', daemon=True).start()
+        self._refresh()
+
+    def _cell_size(self) -> int:
+        return self.THUMBNAIL_SIZE + self.PADDING
+
+    def _columns(self) -> int:
+        return max(self.canvas.winfo_width() // self._cell_size(), 1)
+
+    def _visible_indices(self) -> range:
+        rows = -(-len(self.image_names) // self._columns())
+        total_height = max(rows * self._cell_size(), 1)
+        top, bottom = self.canvas.yview()
+        first_row = int(top * total_height) // self._cell_size()
+        last_row = int(bottom * total_height) // self._cell_size() + 1
+        return range(first_row * self._columns(), min((last_row + 1) * self._columns(), len(self.image_names)))
+
+    def _on_scroll(self, *args):
+        self.canvas.yview(*args)
+        self._refresh()
+
+    def _refresh(self):
+        rows = -(-len(self.image_names) // self._columns())
+        self.canvas.configure(scrollregion=(0, 0, self.canvas.winfo_width(), rows * self._cell_size()))
+        self.canvas.delete('cell')
+
+        visible = self._visible_indices()
+        missing = []
+        for index in visible:
+            name = self.image_names[index]
+            row, column = divmod(index, self._columns())
+            x = column * self._cell_size() + self.PADDING // 2
+            y = row * self._cell_size() + self.PADDING // 2
+            photo = self._photos.get(name)
+            if photo is not None:
+                self.canvas.create_image(
+                    x + self.THUMBNAIL_SIZE // 2, y + self.THUMBNAIL_SIZE // 2, image=photo, tags='cell'
+                )
+                continue
+
+            self.canvas.create_rectangle(
+                x, y, x + self.THUMBNAIL_SIZE, y + self.THUMBNAIL_SIZE, fill='#404040', outline='', tags='cell'
+            )
+            if self.thumbnail_store is None:
+                continue
+            if self.thumbnail_store.lookup(name, self.THUMBNAIL_SIZE) is not None:
+                if name not in self._requested:
+                    self._requested.add(name)
+                    self._load_requests.put((self.thumbnail_store, name))
+            else:
+                missing.append(name)
+
+        if missing and self.thumbnail_generator is not None:
+            self.thumbnail_generator.prioritize(missing)
+
+    def _load_thumbnails(self):
+        while True:
+            store, name = self._load_requests.get()
+            try:
+                image = store.read(name, self.THUMBNAIL_SIZE)
+            except OSError:
+                image = None
+            if image is not None:
+                self._loaded.put((store, name, image))
+
+    def _poll(self):
+        changed = False
+        while not self._ready.empty():
+            item = self._ready.get_nowait()
+            if isinstance(item, LoadedDataset):
+                if item.request != self._load_request:
+                    continue
+                if item.error is not None:
+                    messagebox.showerror("Dataset Explorer", f"Could not load the dataset:\n{item.error}")
+                    continue
+                self.set_dataset(item.dataset)
+            elif isinstance(item, tuple):
+                store, generator = item
+                if self.dataset is None or generator.data_path != self.dataset.data_path:
+                    generator.stop()
+                    continue
+                self.thumbnail_store, self.thumbnail_generator = store, generator
+                generator.start()
+            else:
+                self._requested.discard(item)
+                self._photos.pop(item, None)
+            changed = True
+
+        while not self._loaded.empty():
+            store, name, image = self._loaded.get_nowait()
+            if store is not self.thumbnail_store:
+                continue
+            if len(self._photos) >= self.MAX_PHOTOS:
+                visible = {self.image_names[index] for index in self._visible_indices()}
+                for stale in [key for key in self._photos if key not in visible]:
+                    self._photos.pop(stale)
+                    self._requested.discard(stale)
+            self._photos[name] = ImageTk.PhotoImage(image)
+            changed = True
+
+        if changed:
+            self._refresh()
+        self.after(self.POLL_INTERVAL_MS, self._poll)
 
 if __name__ == "__main__":
     window = DatasetExplorerGUI()
-    window.mainloop()
\ No newline at end of file
+    window.mainloop()
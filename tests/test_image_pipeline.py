@@ -0,0 +1,40 @@
+import os
+import sys
+import subprocess
+
+import numpy as np
+from PIL import Image
+
+DATASET_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataset')
+
+# Run in a subprocess: reading an unmapped batch crashes the interpreter.
+KEEP_VIEWS_SCRIPT = """
+import gc
+import sys
+
+sys.path.insert(0, sys.argv[1])
+from image_pipeline import iter_image_batches
+
+paths = sys.argv[2:]
+views = []
+for batch in iter_image_batches(paths, list(range(len(paths))), batch_size=2, workers=1):
+    views.append(batch.image(0))
+    views.append(batch.images)
+del batch
+gc.collect()
+print(' '.join(str(int(view[0, 0, 0])) for view in views[::2]))
+"""
+
+def test_batch_views_outlive_the_batch(tmp_path):
+    paths = []
+    for index in range(3):
+        path = os.path.join(tmp_path, f'{index}.png')
+        Image.fromarray(np.full((20, 30, 3), 40 * index, dtype=np.uint8)).save(path)
+        paths.append(path)
+
+    result = subprocess.run(
+        [sys.executable, '-c', KEEP_VIEWS_SCRIPT, DATASET_PATH, *paths],
+        capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split() == ['0', '80']